@@ -2,71 +2,794 @@ from http.server import BaseHTTPRequestHandler
 import json
 import os
 import sys
-import requests
-from bs4 import BeautifulSoup
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Add the parent directory to the Python path to import modules
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'price_comparison_system'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'price_comparison_system'))
 
-# Import backend modules
-try:
-    from amazon_sp_api_client import search_amazon_products
-    from price_comparator import compare_prices
-except ImportError as e:
-    print(f"Import error: {e}")
-    search_amazon_products = None
-    compare_prices = None
+# Stage timers and counters (no-ops unless a request is being traced)
+from metrics import stage, count, bind, tracing, METRICS_ENABLED
+
+# --- Backend modules (loaded on first use) --- #
+# requests and the backend modules are imported by _load_backend() the first
+# time a request needs them, not at cold start: amazon_sp_api_client reads .env
+# and builds the SP-API credentials on import, which OPTIONS preflights and 400
+# responses never use. Set LAZY_BACKEND=0 to load everything at import instead.
+LAZY_BACKEND = os.getenv('LAZY_BACKEND', '1') == '1'
+
+search_amazon_products = None
+get_amazon_competitive_prices = None
+MISSING_PRICE_REASONS = frozenset()
+compare_pairs = None
+get_session = None
+AMAZON = None
+ResponseCache = None
+make_etag = None
+etag_matches = None
+cache_control = None
+TokenBucket = None
+parse_costco_html = None
+rank_page = None
+annotate_unit_prices = None
+encode_response = None
+negotiate_encoding = None
+negotiate_media_type = None
+compress = None
+CONTENT_TYPES = None
+
+# Optional price-history store (PRICE_HISTORY_DB); kept open across warm invocations
+price_history = None
+
+# Keyword-keyed response cache shared by concurrent and repeated requests.
+# Partial responses (deadline-truncated or missing results after an upstream
+# failure) are returned but never cached.
+response_cache = None
+
+_backend_loaded = False
+_backend_lock = threading.Lock()
+
+
+def normalize_keywords(keywords):
+    # Replaced by search_cache.normalize_keywords once the backend is loaded
+    return ' '.join(str(keywords).lower().split())
+
+
+def dumps_json(data):
+    # Replaced by wire_format.dumps_json once the backend is loaded
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _load_backend():
+    """Import the backend modules and open the shared stores, once per container."""
+    global search_amazon_products, get_amazon_competitive_prices, MISSING_PRICE_REASONS, compare_pairs, get_session, AMAZON
+    global ResponseCache, make_etag, etag_matches, cache_control, normalize_keywords, TokenBucket
+    global parse_costco_html, rank_page, annotate_unit_prices, price_history, response_cache, _backend_loaded
+    global dumps_json, encode_response, negotiate_encoding, negotiate_media_type, compress, CONTENT_TYPES
+    if _backend_loaded:
+        return
+    with _backend_lock:
+        if _backend_loaded:
+            return
+        with stage('backend_import'):
+            try:
+                from amazon_sp_api_client import search_amazon_products, get_amazon_competitive_prices, MISSING_PRICE_REASONS
+                from price_comparator import compare_pairs
+                from http_session import get_session
+                from price_history import AMAZON, open_store_from_env
+                from response_cache import ResponseCache, make_etag, etag_matches, cache_control
+                from search_cache import normalize_keywords
+                from rate_limiter import TokenBucket
+                from costco_html_parser import parse_costco_html
+                from result_ranking import rank_page, annotate_unit_prices
+                from wire_format import (dumps_json, encode_response, negotiate_encoding, negotiate_media_type,
+                                         compress, CONTENT_TYPES)
+            except ImportError as e:
+                # Not marked as loaded: the request gets a 500 and the next one retries the import
+                print(f"Import error: {e}")
+                raise RuntimeError(f"backend unavailable: {e}") from e
+            price_history = open_store_from_env()
+            response_cache = ResponseCache(cacheable=lambda response: not response['partial'])
+        _backend_loaded = True
+
+# --- Amazon lookup fan-out settings --- #
+# Maximum number of concurrent SP-API lookups per request
+AMAZON_LOOKUP_CONCURRENCY = int(os.getenv('AMAZON_LOOKUP_CONCURRENCY', '8'))
+# Seconds after the request starts before we answer with whatever has completed
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', '8'))
+
+# --- Batch mode settings --- #
+# Maximum number of keywords accepted in one batch request
+BATCH_MAX_KEYWORDS = int(os.getenv('BATCH_MAX_KEYWORDS', '200'))
+# Worker threads shared by every Costco scrape and Amazon lookup of a batch
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', str(AMAZON_LOOKUP_CONCURRENCY)))
+# Seconds a batch may run before we answer with whatever has completed
+BATCH_DEADLINE_SECONDS = float(os.getenv('BATCH_DEADLINE_SECONDS', '25'))
+# Costco search pages per second across the whole batch
+COSTCO_REQUESTS_PER_SECOND = float(os.getenv('COSTCO_REQUESTS_PER_SECOND', '2'))
+
+# Costco search page; overridable so benchmarks can point at a local stub server
+COSTCO_SEARCH_URL = os.getenv('COSTCO_SEARCH_URL', 'https://www.costco.co.jp/search/')
 
 # --- Costco Scraper (requests + BeautifulSoup) --- #
-def scrape_costco_products(keyword):
-    base_url = "https://www.costco.co.jp/search/" # This might need to be adjusted based on actual search URL structure
+def scrape_costco_products(keyword, errors=None):
+    """Scrape one Costco search page. A failed fetch returns [] and, if
+    ``errors`` is a list, is recorded in it so the response is marked partial."""
+    import requests
+
+    base_url = COSTCO_SEARCH_URL # This might need to be adjusted based on actual search URL structure
     search_url = f"{base_url}{keyword}"
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
     }
     
     try:
-        response = requests.get(search_url, headers=headers, timeout=10)
+        # Reuse the pooled keep-alive session across warm invocations when available
+        http = get_session() if get_session else requests
+        with stage('costco_fetch'):
+            response = http.get(search_url, headers=headers, timeout=10)
+        count('costco.requests')
+        count('costco.bytes', len(response.content))
         response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
         
-        soup = BeautifulSoup(response.text, 'html.parser')
-        products = []
-        
-        # Adjust these selectors based on actual Costco website structure
-        # This is a generic example and will likely need fine-tuning
-        product_cards = soup.select('div.product-card') # Example selector
-        
-        for card in product_cards:
-            name_element = card.select_one('a.product-card-name')
-            price_element = card.select_one('span.price')
-            link_element = card.select_one('a.product-card-link')
-            
-            name = name_element.text.strip() if name_element else 'N/A'
-            price_text = price_element.text.strip() if price_element else 'N/A'
-            url = link_element['href'] if link_element and 'href' in link_element.attrs else 'N/A'
-            
-            # Clean and convert price to float
-            price = None
-            if price_text != 'N/A':
-                try:
-                    price = float(price_text.replace('¥', '').replace(',', '').strip())
-                except ValueError:
-                    pass
-            
-            if name != 'N/A' and price is not None and url != 'N/A':
-                products.append({
-                    'name': name,
-                    'price': price,
-                    'url': url
-                })
-        return products
+        with stage('costco_parse'):
+            return _parse_costco_html(response.text)
         
     except requests.exceptions.RequestException as e:
         print(f"Costco scraping error: {e}")
+        if errors is not None:
+            errors.append({'error': f'costco: {e}'})
         return []
 
 
+def _parse_costco_html(html):
+    """Extract product_name/price/url products from a Costco search results page."""
+    if parse_costco_html:
+        # Single-pass extractor (lxml + compiled XPath when available)
+        return parse_costco_html(html)
+
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    products = []
+    
+    # Adjust these selectors based on actual Costco website structure
+    # This is a generic example and will likely need fine-tuning
+    product_cards = soup.select('div.product-card') # Example selector
+    
+    for card in product_cards:
+        name_element = card.select_one('a.product-card-name')
+        price_element = card.select_one('span.price')
+        link_element = card.select_one('a.product-card-link')
+        
+        name = name_element.text.strip() if name_element else 'N/A'
+        price_text = price_element.text.strip() if price_element else 'N/A'
+        url = link_element['href'] if link_element and 'href' in link_element.attrs else 'N/A'
+        
+        # Clean and convert price to float
+        price = None
+        if price_text != 'N/A':
+            try:
+                price = float(price_text.replace('¥', '').replace(',', '').strip())
+            except ValueError:
+                pass
+        
+        if name != 'N/A' and price is not None and url != 'N/A':
+            products.append({
+                'product_name': name,
+                'price': price,
+                'url': url
+            })
+    return products
+
+
+# --- Amazon lookups (bounded thread pool) --- #
+def _iter_amazon_lookups(costco_products, max_workers, deadline, errors=None):
+    """Yield (index, amazon_results) for each Costco product as its lookup completes.
+
+    Lookups still running when ``deadline`` (a time.monotonic() value) passes
+    are abandoned: they are not yielded and queued ones are cancelled.
+    Failed lookups (an exception, or None from search_amazon_products) yield
+    None and, if ``errors`` is a list, are recorded in it.
+    """
+    for completed in _iter_amazon_lookup_batches(costco_products, max_workers, deadline, errors):
+        yield from completed
+
+
+def _iter_amazon_lookup_batches(costco_products, max_workers, deadline, errors=None):
+    """Like _iter_amazon_lookups, but yield every lookup completed so far as one list.
+
+    Callers that price as they go can then make one batched pricing request
+    per wake-up instead of one per product.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    try:
+        pending = {
+            executor.submit(bind(search_amazon_products), c_product['product_name'], deadline=deadline): index
+            for index, c_product in enumerate(costco_products)
+        }
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            completed = []
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    result = future.result()
+                    error = None if result is not None else 'no response'
+                except Exception as e:
+                    print(f"Amazon lookup error: {e}")
+                    result, error = None, str(e)
+                if error and errors is not None:
+                    errors.append({'index': index, 'error': f'amazon search: {error}'})
+                completed.append((index, result))
+            yield completed
+    finally:
+        # Don't block the response on lookups that missed the deadline
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def lookup_amazon_products(costco_products, max_workers=AMAZON_LOOKUP_CONCURRENCY, deadline=None, errors=None):
+    """Search Amazon for every Costco product concurrently.
+
+    Returns (amazon_results, complete) where amazon_results is aligned with
+    costco_products (None for failed or timed-out lookups) and complete is
+    False when the deadline cut the fan-out short. Failed lookups are
+    recorded in ``errors`` when it is a list.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + REQUEST_DEADLINE_SECONDS
+
+    amazon_results = [None] * len(costco_products)
+    completed = 0
+    for index, result in _iter_amazon_lookups(costco_products, max_workers, deadline, errors):
+        amazon_results[index] = result
+        completed += 1
+    return amazon_results, completed == len(costco_products)
+
+
+def fill_amazon_prices(amazon_results, errors=None, deadline=None):
+    """Fill in prices for the Amazon products we compare against, 20 ASINs per call.
+
+    Catalog search does not return prices, so the first result of every
+    lookup is priced through one batched competitive-pricing request per
+    chunk instead of one request per product. ASINs left without a price
+    because a pricing call failed are recorded in ``errors`` when it is a
+    list; ASINs that simply have no competitive price are not errors.
+    Pricing stops at ``deadline`` (a time.monotonic() value): nothing is
+    requested once it has passed, and calls in flight are cut off by it.
+    """
+    targets = [
+        results[0] for results in amazon_results
+        if results and results[0].get('asin') and results[0].get('price') is None
+    ]
+    if not targets or not get_amazon_competitive_prices:
+        return
+
+    if deadline is not None and time.monotonic() >= deadline:
+        if errors is not None:
+            errors.extend({'asin': a_product['asin'], 'error': 'pricing: deadline exceeded'} for a_product in targets)
+        return
+
+    asins = [a_product['asin'] for a_product in targets]
+    failed = {}
+
+    def fetch(batch):
+        prices, batch_errors = get_amazon_competitive_prices(batch, deadline=deadline)
+        failed.update(batch_errors)
+        return prices
+
+    if price_history:
+        # Only ASINs whose stored price has gone stale are re-fetched
+        prices = price_history.refresh_stale(AMAZON, asins, fetch)
+    else:
+        prices = fetch(asins)
+    for a_product in targets:
+        priced = prices.get(a_product['asin'])
+        if priced:
+            a_product['price'] = priced['price']
+        elif errors is not None and failed.get(a_product['asin']) not in (None, *MISSING_PRICE_REASONS):
+            errors.append({'asin': a_product['asin'], 'error': f"pricing: {failed[a_product['asin']]}"})
+
+
+def _compare_with_amazon(c_product, amazon_results):
+    # For simplicity, we'll take the first Amazon result for comparison
+    # In a real scenario, more sophisticated matching would be needed
+    if not amazon_results or not compare_pairs:
+        return []
+    # The search already picked the Amazon product from the Costco name, so the
+    # pair is compared as-is, without another product-name check
+    results = compare_pairs([(c_product, amazon_results[0])])
+    # Costco price per roll/sheet/100g etc., read from the product name
+    return annotate_unit_prices(results) if annotate_unit_prices else results
+
+
+def build_comparison(keyword):
+    """Run the full Costco scrape + Amazon comparison for one keyword.
+
+    A failed Costco scrape or Amazon search is listed in 'errors' and makes
+    the response partial, so an upstream outage is never cached as a
+    complete (empty or short) answer.
+    """
+    _load_backend()
+    deadline = time.monotonic() + REQUEST_DEADLINE_SECONDS
+    errors = []
+
+    # 1. Scrape Costco products
+    costco_products = scrape_costco_products(keyword, errors)
+
+    # 2. Search Amazon products concurrently and compare (in Costco order)
+    final_results = []
+    complete = True
+    if search_amazon_products:
+        amazon_results, complete = lookup_amazon_products(costco_products, deadline=deadline, errors=errors)
+        fill_amazon_prices(amazon_results, errors, deadline)
+        for c_product, a_results in zip(costco_products, amazon_results):
+            final_results.extend(_compare_with_amazon(c_product, a_results))
+
+    return {
+        'keyword': keyword,
+        'results': final_results,
+        'partial': not complete or bool(errors),
+        'errors': errors
+    }
+
+
+def _render(response_data):
+    # UTF-8 without \uXXXX escapes: Japanese product names take a third of the bytes
+    body = dumps_json(response_data)
+    return {'body': body, 'etag': make_etag(body) if ResponseCache else None, 'partial': response_data['partial']}
+
+
+def _render_comparison(keyword):
+    return _render(build_comparison(keyword))
+
+
+def parse_page_params(sort=None, limit=None, cursor=None, unit=None):
+    """Validate ?sort=&limit=&cursor=&unit=; None when the request did not ask for a page.
+
+    unit restricts sort=unit_price to one unit (e.g. g, ml, ロール), so yen per
+    gram is never ranked against yen per roll; it implies sort=unit_price.
+    Raises ValueError (answered with 400) for an unknown sort, a non-positive
+    limit, a unit with another sort or a cursor issued for another sort or unit.
+    """
+    if sort is None and limit is None and cursor is None and not unit:
+        return None
+    # Stdlib only, so a bad request still does not load the backend
+    from result_ranking import SORT_KEYS, DEFAULT_SORT, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, normalize_unit
+
+    sort = sort or ('unit_price' if unit else DEFAULT_SORT)
+    if sort not in SORT_KEYS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_KEYS)}")
+    if unit and sort != 'unit_price':
+        raise ValueError('unit can only be used with sort=unit_price')
+    unit = normalize_unit(unit) if unit else None
+    try:
+        limit = DEFAULT_PAGE_SIZE if limit in (None, '') else int(limit)
+    except (TypeError, ValueError):
+        raise ValueError('limit must be an integer')
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+    if cursor:
+        decode_cursor(cursor, sort, unit)
+    return {'sort': sort, 'limit': min(limit, MAX_PAGE_SIZE), 'cursor': cursor or None, 'unit': unit}
+
+
+def render_page(response, page):
+    """Render one page of a full comparison response, best deals first.
+
+    The full response stays the unit of caching; each page is cut from it with a
+    bounded top-K heap, so a large keyword result set costs one comparison and
+    small payloads after that. next_cursor is null on the last page.
+    """
+    data = json.loads(response['body'])
+    results, next_cursor, total = rank_page(data['results'], page['sort'], page['limit'], page['cursor'], page['unit'])
+    page_data = {
+        'keyword': data['keyword'],
+        'results': results,
+        'partial': data['partial'],
+        'sort': page['sort'],
+        'unit': page['unit'],
+        'total': total,
+        'next_cursor': next_cursor,
+    }
+    body = dumps_json(page_data)
+    return {'body': body, 'etag': make_etag(body) if response['etag'] else None, 'partial': response['partial']}
+
+
+# Same values as wire_format.LAYOUTS. Kept here so validating ?layout= does not
+# import wire_format (and brotli/msgpack with it) for a request answered with 400
+LAYOUTS = ('rows', 'columns')
+
+
+def parse_layout(layout=None):
+    """Validate ?layout=rows|columns (columns sends each result field once as a list)."""
+    layout = layout or LAYOUTS[0]
+    if layout not in LAYOUTS:
+        raise ValueError(f"layout must be one of {', '.join(LAYOUTS)}")
+    return layout
+
+
+def get_comparison_response(keyword):
+    """Return (rendered response, cache status), sharing one computation per keyword."""
+    _load_backend()
+    if not response_cache:
+        return _render_comparison(keyword), 'BYPASS'
+    response, cache_status = response_cache.get_or_compute(normalize_keywords(keyword), lambda: _render_comparison(keyword))
+    count('response_cache.' + cache_status.lower())
+    return response, cache_status
+
+
+# --- Batch mode (many keywords, shared work) --- #
+def build_batch_comparison(keywords, deadline=None):
+    """Compare many keywords in one pass, sharing work between them.
+
+    Keywords that normalize to the same string are computed once, and fresh
+    cached responses are reused. Every Costco scrape and Amazon lookup runs on
+    one shared pool of BATCH_CONCURRENCY workers, with Costco requests paced
+    by one token bucket. A Costco product that shows up under several
+    keywords (or several times) is looked up on Amazon only once, and all
+    found products are priced in one batched competitive-pricing pass.
+    Amazon lookups start as soon as their keyword's Costco scrape returns.
+    """
+    _load_backend()
+    started = time.monotonic()
+    if deadline is None:
+        deadline = started + BATCH_DEADLINE_SECONDS
+
+    unique_keywords = {}  # normalized keyword -> keyword as first given
+    for keyword in keywords:
+        unique_keywords.setdefault(normalize_keywords(keyword), keyword)
+
+    responses = {}  # normalized keyword -> response data
+    to_compute = []
+    for key, keyword in unique_keywords.items():
+        cached = response_cache.peek(key) if response_cache else None
+        if cached is not None:
+            responses[key] = json.loads(cached['body'])
+        else:
+            to_compute.append(key)
+
+    costco_by_keyword = {}  # normalized keyword -> scraped Costco products
+    amazon_by_name = {}  # normalized product name -> Amazon results (None until done or failed)
+    lookups_done = set()
+    lookup_errors = {}  # normalized product name -> why its Amazon search failed
+    keyword_errors = {key: [] for key in to_compute}
+    costco_products_seen = 0
+    bucket = TokenBucket(COSTCO_REQUESTS_PER_SECOND, max(1, int(COSTCO_REQUESTS_PER_SECOND))) if TokenBucket else None
+
+    def scrape(keyword):
+        if bucket:
+            bucket.acquire()
+        scrape_errors = []
+        return scrape_costco_products(keyword, scrape_errors), scrape_errors
+
+    executor = ThreadPoolExecutor(max_workers=max(1, BATCH_CONCURRENCY))
+    try:
+        pending = {executor.submit(bind(scrape), unique_keywords[key]): ('costco', key) for key in to_compute}
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, key = pending.pop(future)
+                try:
+                    value = future.result()
+                    error = None
+                except Exception as e:
+                    print(f"Batch {kind} error for {key}: {e}")
+                    value, error = None, str(e)
+
+                if kind == 'amazon':
+                    amazon_by_name[key] = value
+                    lookups_done.add(key)
+                    if value is None:
+                        lookup_errors[key] = f'amazon search: {error or "no response"}'
+                    continue
+
+                costco_by_keyword[key], scrape_errors = value if value else ([], [{'error': f'costco: {error}'}])
+                keyword_errors[key].extend(scrape_errors)
+                costco_products_seen += len(costco_by_keyword[key])
+                if not search_amazon_products:
+                    continue
+                for c_product in costco_by_keyword[key]:
+                    name_key = normalize_keywords(c_product['product_name'])
+                    if name_key not in amazon_by_name:
+                        amazon_by_name[name_key] = None
+                        pending[executor.submit(bind(search_amazon_products), c_product['product_name'],
+                                                deadline=deadline)] = ('amazon', name_key)
+    finally:
+        # Don't block the response on work that missed the deadline
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    pricing_errors = []
+    fill_amazon_prices([amazon_by_name[name_key] for name_key in lookups_done], pricing_errors, deadline)
+    pricing_errors = {error['asin']: error for error in pricing_errors}
+
+    for key in to_compute:
+        costco_products = costco_by_keyword.get(key)
+        final_results = []
+        errors = keyword_errors[key]
+        complete = costco_products is not None
+        for c_product in costco_products or []:
+            name_key = normalize_keywords(c_product['product_name'])
+            if search_amazon_products and name_key not in lookups_done:
+                complete = False
+                continue
+            a_results = amazon_by_name.get(name_key)
+            if name_key in lookup_errors:
+                errors.append({'product_name': c_product['product_name'], 'error': lookup_errors[name_key]})
+            elif a_results and a_results[0].get('asin') in pricing_errors:
+                errors.append(pricing_errors[a_results[0]['asin']])
+            final_results.extend(_compare_with_amazon(c_product, a_results))
+        complete = complete and not errors
+        responses[key] = {
+            'keyword': unique_keywords[key],
+            'results': final_results,
+            'partial': not complete,
+            'errors': errors
+        }
+        if response_cache and complete:
+            response_cache.put(key, _render(responses[key]))
+
+    return {
+        'results': [dict(responses[normalize_keywords(keyword)], keyword=keyword) for keyword in keywords],
+        'partial': any(response['partial'] for response in responses.values()),
+        'stats': {
+            'keywords': len(keywords),
+            'unique_keywords': len(unique_keywords),
+            'cached_keywords': len(unique_keywords) - len(to_compute),
+            'costco_requests': len(costco_by_keyword),
+            'costco_products': costco_products_seen,
+            'amazon_lookups': len(amazon_by_name),
+            'amazon_lookups_completed': len(lookups_done),
+            'errors': [dict(error, keyword=unique_keywords[key]) for key in to_compute for error in keyword_errors[key]],
+            'elapsed_ms': round((time.monotonic() - started) * 1000, 1)
+        }
+    }
+
+
+# --- Streaming mode (NDJSON / server-sent events) --- #
+STREAM_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream'
+}
+
+
+def stream_format(accept, flag=None):
+    """Pick 'ndjson', 'sse' or None (a single JSON body) from the Accept header or a stream flag."""
+    accept = accept or ''
+    if flag == 'sse' or 'text/event-stream' in accept:
+        return 'sse'
+    if flag in (True, 'true', '1', 'ndjson') or 'application/x-ndjson' in accept:
+        return 'ndjson'
+    return None
+
+
+def iter_comparison_events(keyword):
+    """Yield comparison events for one keyword as soon as each is known.
+
+    Each {'type': 'result', 'result': ...} event is sent as soon as the Amazon
+    lookup for its Costco product completes and is priced, so results arrive
+    in completion order rather than Costco order. Lookups that finish together
+    share one batched pricing request, and none is started after the deadline.
+    A final {'type': 'summary', ...} trailer carries counts, lookup and
+    pricing errors and whether the deadline cut the request short.
+    Pricing is bounded by the same deadline as the lookups.
+    A fresh cached response is replayed instead of being recomputed, and a
+    complete live run is stored in the response cache.
+    """
+    _load_backend()
+    started = time.monotonic()
+    cache_key = normalize_keywords(keyword) if response_cache else None
+    cached = response_cache.peek(cache_key) if response_cache else None
+    if cached is not None:
+        response_data = json.loads(cached['body'])
+        for result in response_data['results']:
+            yield {'type': 'result', 'result': result}
+        yield {
+            'type': 'summary',
+            'keyword': keyword,
+            'count': len(response_data['results']),
+            'partial': response_data['partial'],
+            'errors': response_data.get('errors', []),
+            'cache': 'HIT',
+            'elapsed_ms': round((time.monotonic() - started) * 1000, 1)
+        }
+        return
+
+    deadline = started + REQUEST_DEADLINE_SECONDS
+    costco_products = []
+    errors = []
+    ordered = []  # (costco index, result) for the cached, Costco-ordered response
+    completed = 0
+    try:
+        costco_products = scrape_costco_products(keyword, errors)
+        if search_amazon_products:
+            lookups = _iter_amazon_lookup_batches(costco_products, AMAZON_LOOKUP_CONCURRENCY, deadline, errors)
+            for batch in lookups:
+                completed += len(batch)
+                # One batched pricing call for every lookup that finished since the last one
+                fill_amazon_prices([a_results for _, a_results in batch], errors, deadline)
+                for index, a_results in batch:
+                    for result in _compare_with_amazon(costco_products[index], a_results):
+                        ordered.append((index, result))
+                        yield {'type': 'result', 'result': result}
+        else:
+            completed = len(costco_products)
+    except Exception as e:
+        errors.append({'error': str(e)})
+
+    # Failed scrapes, searches or pricing calls leave gaps just like the deadline does
+    partial = completed < len(costco_products) or bool(errors)
+    if response_cache and not partial:
+        ordered.sort(key=lambda item: item[0])
+        response_cache.put(cache_key, _render({
+            'keyword': keyword,
+            'results': [result for _, result in ordered],
+            'partial': False,
+            'errors': []
+        }))
+    yield {
+        'type': 'summary',
+        'keyword': keyword,
+        'count': len(ordered),
+        'costco_products': len(costco_products),
+        'amazon_lookups': completed,
+        'partial': partial,
+        'errors': errors,
+        'cache': 'MISS' if response_cache else 'BYPASS',
+        'elapsed_ms': round((time.monotonic() - started) * 1000, 1)
+    }
+
+
+def encode_event(event, fmt):
+    data = json.dumps(event, ensure_ascii=False, separators=(',', ':'))
+    if fmt == 'sse':
+        return f"event: {event['type']}\ndata: {data}\n\n".encode('utf-8')
+    return (data + '\n').encode('utf-8')
+
+
+def wants_debug(flag):
+    return flag in (True, 'true', '1')
+
+
 class handler(BaseHTTPRequestHandler):
+    # Trace returned in the 'debug' field when the request asked for it
+    debug_trace = None
+
+    def _traced(self, debug, respond, *args):
+        """Run respond(*args) under a trace when debugging or METRICS_ENABLED is set."""
+        with tracing('compare', enabled=debug or METRICS_ENABLED) as trace:
+            self.debug_trace = trace if debug else None
+            respond(*args)
+        if trace is not None and METRICS_ENABLED:
+            print(f"[METRICS] {trace.to_json()}")
+
+    def _send_json(self, status, data):
+        body = dumps_json(data)
+        # Batch results are compressed; 400s sent before the backend loads are not
+        encoding = negotiate_encoding(self.headers.get('Accept-Encoding'), len(body)) if negotiate_encoding else None
+        if encoding:
+            body = compress(body, encoding)
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json; charset=utf-8')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream_comparison(self, keyword, fmt):
+        # Load before the 200 goes out, so a backend failure is still answered with a 500
+        _load_backend()
+        self.send_response(200)
+        self.send_header('Content-type', STREAM_CONTENT_TYPES[fmt] + '; charset=utf-8')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-store')
+        # Ask proxies not to buffer the stream
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+        for event in iter_comparison_events(keyword):
+            if event['type'] == 'summary' and self.debug_trace:
+                event['debug'] = self.debug_trace.to_dict()
+            self.wfile.write(encode_event(event, fmt))
+            self.wfile.flush()
+
+    def _respond_with_comparison(self, keyword, stream_flag=None, page_params=(), layout=None):
+        if not keyword:
+            self._send_json(400, {'error': 'Keyword is required'})
+            return
+        try:
+            page = parse_page_params(*page_params)
+            layout = parse_layout(layout)
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        # A page is cut from the complete result set, so it is never streamed
+        fmt = None if page else stream_format(self.headers.get('Accept'), stream_flag)
+        if fmt:
+            self._stream_comparison(keyword, fmt)
+            return
+
+        response, cache_status = get_comparison_response(keyword)
+        if page and rank_page:
+            response = render_page(response, page)
+        if self.debug_trace:
+            # Timings describe this request only: never cache or revalidate them
+            response_data = json.loads(response['body'])
+            response_data['debug'] = dict(self.debug_trace.to_dict(), cache=cache_status)
+            response = {'body': dumps_json(response_data), 'etag': None, 'partial': True}
+        if response['partial']:
+            # Incomplete results must not be reused by the edge or the browser
+            caching = 'no-store'
+        else:
+            caching = cache_control(response_cache.ttl, response_cache.stale_ttl) if response_cache else 'no-cache'
+
+        # JSON or MessagePack (Accept), rows or columns (layout), gzip/br (Accept-Encoding)
+        if encode_response:
+            media_type = negotiate_media_type(self.headers.get('Accept'))
+            body, etag, encoding = encode_response(response, media_type, layout, self.headers.get('Accept-Encoding'))
+        else:
+            media_type, body, etag, encoding = 'json', response['body'], response['etag'], None
+
+        not_modified = bool(etag) and etag_matches(self.headers.get('If-None-Match'), etag)
+        if not_modified:
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header('Content-type', CONTENT_TYPES[media_type] if CONTENT_TYPES else 'application/json')
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag, X-Cache')
+        self.send_header('Cache-Control', caching)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('X-Cache', cache_status)
+        # Streaming, MessagePack and compressed responses share the URL
+        self.send_header('Vary', 'Accept, Accept-Encoding')
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(body)
+
+    def _respond_with_batch(self, keywords):
+        if not isinstance(keywords, list) or not all(isinstance(keyword, str) for keyword in keywords):
+            self._send_json(400, {'error': 'keywords must be a list of strings'})
+            return
+        keywords = [keyword.strip() for keyword in keywords if keyword.strip()]
+        if not keywords:
+            self._send_json(400, {'error': 'Keyword is required'})
+            return
+        if len(keywords) > BATCH_MAX_KEYWORDS:
+            self._send_json(400, {'error': f'At most {BATCH_MAX_KEYWORDS} keywords per batch'})
+            return
+        response_data = build_batch_comparison(keywords)
+        if self.debug_trace:
+            response_data['debug'] = self.debug_trace.to_dict()
+        self._send_json(200, response_data)
+
+    def do_GET(self):
+        # GET /api/compare?keyword=... is cacheable by the Vercel edge and the browser
+        try:
+            query = parse_qs(urlparse(self.path).query)
+            keyword = query.get('keyword', [''])[0].strip()
+            debug = wants_debug(query.get('debug', [None])[0])
+            page_params = [query.get(name, [None])[0] for name in ('sort', 'limit', 'cursor', 'unit')]
+            self._traced(debug, self._respond_with_comparison, keyword, query.get('stream', [None])[0], page_params,
+                         query.get('layout', [None])[0])
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+
     def do_POST(self):
         try:
             # Parse request body
@@ -74,68 +797,29 @@ class handler(BaseHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             request_data = json.loads(post_data.decode('utf-8'))
             
-            keyword = request_data.get('keyword', '')
-            
-            if not keyword:
-                self.send_response(400)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({
-                    'error': 'Keyword is required'
-                }).encode('utf-8'))
+            debug = wants_debug(request_data.get('debug'))
+            if 'keywords' in request_data:
+                self._traced(debug, self._respond_with_batch, request_data['keywords'])
                 return
-            
-            # 1. Scrape Costco products
-            costco_products = scrape_costco_products(keyword)
-            
-            # 2. Search Amazon products and compare
-            final_results = []
-            for c_product in costco_products:
-                if search_amazon_products:
-                    amazon_results = search_amazon_products(keyword=c_product['name'])
-                    
-                    if amazon_results and compare_prices:
-                        # Assuming amazon_results is a list of dicts with 'name', 'price', 'url'
-                        # For simplicity, we'll take the first Amazon result for comparison
-                        # In a real scenario, more sophisticated matching would be needed
-                        a_product = amazon_results[0]
-                        
-                        comparison = compare_prices(
-                            costco_name=c_product['name'],
-                            costco_price=c_product['price'],
-                            costco_url=c_product['url'],
-                            amazon_name=a_product['name'],
-                            amazon_price=a_product['price'],
-                            amazon_url=a_product['url']
-                        )
-                        if comparison:
-                            final_results.append(comparison)
-            
-            response_data = {
-                'keyword': keyword,
-                'results': final_results
-            }
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(response_data).encode('utf-8'))
+
+            keyword = request_data.get('keyword', '')
+            page_params = [request_data.get(name) for name in ('sort', 'limit', 'cursor', 'unit')]
+            self._traced(debug, self._respond_with_comparison, keyword, request_data.get('stream'), page_params,
+                         request_data.get('layout'))
             
         except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({
-                'error': str(e)
-            }).encode('utf-8'))
+            self._send_json(500, {'error': str(e)})
     
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, If-None-Match')
         self.end_headers()
 
+
+if not LAZY_BACKEND:
+    try:
+        _load_backend()
+    except RuntimeError:
+        pass  # Already logged; the first request retries and answers 500 if it still fails
@@ -1,11 +1,25 @@
 import json
 import os
+import time
 from dotenv import load_dotenv
 import requests
-import datetime
-import hashlib
-import hmac
-import urllib.parse
+
+try:
+    from .http_session import get_session, register_host
+    from .sigv4_signer import SigV4Signer
+    from .lwa_token import LwaTokenManager
+    from .sp_api_scheduler import SpApiScheduler, DeadlineExceeded
+    from .metrics import stage, count
+    from .product_records import AmazonProduct, json_default
+    from . import search_cache
+except ImportError:
+    from http_session import get_session, register_host
+    from sigv4_signer import SigV4Signer
+    from lwa_token import LwaTokenManager
+    from sp_api_scheduler import SpApiScheduler, DeadlineExceeded
+    from metrics import stage, count
+    from product_records import AmazonProduct, json_default
+    import search_cache
 
 # .envファイルから環境変数を読み込む
 # このスクリプトが存在するディレクトリ内の.envファイルを指定
@@ -23,158 +37,196 @@ AWS_ROLE_ARN = os.getenv("AWS_ROLE_ARN")
 MARKETPLACE_ID = os.getenv("SP_API_MARKETPLACE_ID", "A1VC38T7YXB528")
 REGION = os.getenv("AWS_REGION", "us-west-2")
 HOST = os.getenv("SP_API_ENDPOINT", "sellingpartnerapi-na.amazon.com").replace("https://", "")
+# ローカルのスタブサーバーに向ける場合のみhttpにする
+SCHEME = os.getenv("SP_API_SCHEME", "https")
+# 並列検索に合わせてSP-APIホストのコネクションプールを広めに確保する
+register_host(HOST, int(os.getenv("SP_API_POOL_SIZE", "16")))
 
-# --- グローバル変数 (LWAトークンキャッシュ用) --- #
-_lwa_access_token = None
-_lwa_token_expiry = None
+# --- LWAトークン管理 (スレッドセーフ・ファイルキャッシュ付き) --- #
+_token_manager = LwaTokenManager(LWA_CLIENT_ID, LWA_CLIENT_SECRET, REFRESH_TOKEN)
 
 def _get_lwa_access_token():
     """LWAアクセストークンを取得または更新する。"""
-    global _lwa_access_token, _lwa_token_expiry
-
-    if _lwa_access_token and _lwa_token_expiry and _lwa_token_expiry > datetime.datetime.now():
-        return _lwa_access_token
-
-    print("[INFO] LWAアクセストークンを更新しています...")
-    token_url = "https://api.amazon.com/auth/o2/token"
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    data = {
-        "grant_type": "refresh_token",
-        "refresh_token": REFRESH_TOKEN,
-        "client_id": LWA_CLIENT_ID,
-        "client_secret": LWA_CLIENT_SECRET
-    }
+    with stage("lwa_token"):
+        return _token_manager.get_token()
 
-    try:
-        response = requests.post(token_url, headers=headers, data=data)
-        response.raise_for_status()
-        token_data = response.json()
-        _lwa_access_token = token_data["access_token"]
-        expires_in = token_data["expires_in"]
-        _lwa_token_expiry = datetime.datetime.now() + datetime.timedelta(seconds=expires_in - 60)
-        print("[INFO] LWAアクセストークンの更新に成功しました。")
-        return _lwa_access_token
-    except requests.exceptions.RequestException as e:
-        print(f"[ERROR] LWAアクセストークンの取得に失敗しました: {e}")
-        return None
+# SigV4署名器 (署名キーを日付ごとにキャッシュする)
+_signer = SigV4Signer(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, REGION, HOST)
 
 def _sign_request(method, path, query_params, body):
     """AWS SigV4署名を生成してリクエストヘッダーを返す。"""
-    service = "execute-api"
-    t = datetime.datetime.utcnow()
-    amz_date = t.strftime("%Y%m%dT%H%M%SZ")
-    date_stamp = t.strftime("%Y%m%d")
-
-    # 1. Canonical Requestの作成
-    canonical_uri = urllib.parse.quote(path)
-    
-    sorted_query = sorted(query_params.items())
-    canonical_querystring = "&".join([urllib.parse.quote(k, safe="~") + "=" + urllib.parse.quote(str(v), safe="~") for k, v in sorted_query])
+    with stage("sigv4_sign"):
+        headers = _signer.sign(method, path, query_params, body)
+    # ロールARNが設定されている場合のみx-amz-security-tokenヘッダーを追加
+    if AWS_ROLE_ARN and AWS_ROLE_ARN != "YOUR_AWS_ROLE_ARN":
+        headers["x-amz-security-token"] = AWS_ROLE_ARN
 
-    canonical_headers = f"host:{HOST}\nuser-agent:PriceComparisonSystem/1.0 (Language=Python)\nx-amz-date:{amz_date}\n"
-    signed_headers = "host;user-agent;x-amz-date"
+    return headers
 
-    payload_hash = hashlib.sha256(body.encode("utf-8")).hexdigest() if body else hashlib.sha256(b"").hexdigest()
+# --- レート制限スケジューラー (オペレーションごとのトークンバケット) --- #
+_scheduler = SpApiScheduler()
 
-    canonical_request = f'{method}\n{canonical_uri}\n{canonical_querystring}\n{canonical_headers}\n{signed_headers}\n{payload_hash}'
+def sp_api_scheduler_stats():
+    """オペレーションごとの待ち行列の深さ・待ち時間・429の回数を返す。"""
+    return _scheduler.stats()
 
-    # 2. String to Signの作成
-    algorithm = "AWS4-HMAC-SHA256"
-    credential_scope = f'{date_stamp}/{REGION}/{service}/aws4_request'
-    string_to_sign = f'{algorithm}\n{amz_date}\n{credential_scope}\n{hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()}'
+def _remaining(deadline):
+    """deadline (time.monotonic()の値) までの残り秒数。期限なしならNone。"""
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("request deadline passed")
+    return remaining
+
+def _send_sp_api_request(operation, path, query_params, access_token, deadline=None):
+    """署名付きGETリクエストをスケジューラー経由で送り、レスポンスを返す。
+
+    トークンバケットの順番待ち・429のリトライはスケジューラーが行う。
+    リトライごとに署名し直す。deadlineを渡すと順番待ち・リトライ・
+    HTTPのタイムアウトをその時刻までに収める。
+    """
+    api_url = f"{SCHEME}://{HOST}{path}"
+
+    def send():
+        # SigV4署名付きヘッダーを取得
+        signed_headers = _sign_request("GET", path, query_params, "")
+        # LWAトークンをヘッダーに追加
+        signed_headers["x-amz-access-token"] = access_token
+        signed_headers["Content-Type"] = "application/json"
+        return get_session().get(api_url, headers=signed_headers, params=query_params, timeout=_remaining(deadline))
+
+    return _scheduler.submit(operation, send, deadline=deadline)
+
+# getCompetitivePricingは1リクエストあたり最大20件のASINを受け付ける
+COMPETITIVE_PRICE_BATCH_SIZE = 20
+# errorsの理由のうち、取得に失敗したのではなく価格がないと分かったもの
+NOT_FOUND = "not found"
+NO_COMPETITIVE_PRICE = "no competitive price"
+MISSING_PRICE_REASONS = frozenset({NOT_FOUND, NO_COMPETITIVE_PRICE})
+
+def _parse_competitive_price(item_data):
+    """getCompetitivePricingのpayload要素から商品情報を取り出す。価格がなければNoneを返す。"""
+    asin = item_data.get("ASIN")
+    competitive_prices = item_data.get("Product", {}).get("CompetitivePricing", {}).get("CompetitivePrices")
+    if not competitive_prices:
+        return None
 
-    # 3. 署名の計算
-    def sign(key, msg):
-        return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+    return {
+        "source": "Amazon",
+        "product_name": f"Amazon Product (ASIN: {asin})",
+        "price": competitive_prices[0]["Price"]["LandedPrice"]["Amount"],
+        "asin": asin,
+        "url": f"https://www.amazon.co.jp/dp/{asin}"
+    }
 
-    signing_key = sign(f"AWS4{AWS_SECRET_ACCESS_KEY}".encode("utf-8"), date_stamp)
-    signing_key = sign(signing_key, REGION)
-    signing_key = sign(signing_key, service)
-    signing_key = sign(signing_key, "aws4_request")
+def _fetch_competitive_price_batch(asins, access_token, deadline=None):
+    """最大20件のASINを1回の署名付きリクエストで問い合わせ、payloadを返す。"""
+    path = "/pricing/v0/competitivePrice"
+    query_params = {
+        "MarketplaceId": MARKETPLACE_ID,
+        "ItemType": "Asin",
+        "Asins": ",".join(asins)
+    }
 
-    signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    response = _send_sp_api_request("getCompetitivePricing", path, query_params, access_token, deadline)
+    response.raise_for_status()
+    return response.json().get("payload") or []
 
-    # 4. ヘッダーの構築
-    authorization_header = f'{algorithm} Credential={AWS_ACCESS_KEY_ID}/{credential_scope}, SignedHeaders={signed_headers}, Signature={signature}'
-    
-    headers = {
-        "host": HOST,
-        "user-agent": "PriceComparisonSystem/1.0 (Language=Python)",
-        "x-amz-date": amz_date,
-        "Authorization": authorization_header
-    }
-    # ロールARNが設定されている場合のみx-amz-security-tokenヘッダーを追加
-    if AWS_ROLE_ARN and AWS_ROLE_ARN != "YOUR_AWS_ROLE_ARN":
-        headers["x-amz-security-token"] = AWS_ROLE_ARN
+def get_amazon_competitive_prices(asins, deadline=None):
+    """複数ASINの競合価格情報を最大20件ずつまとめて取得する。
 
-    return headers
+    (prices, errors) のタプルを返す。pricesはASIN→商品情報、errorsは価格を
+    取得できなかったASIN→理由。一部のASINやバッチが失敗しても残りの結果は返す。
+    理由がMISSING_PRICE_REASONSのものは失敗ではなく、価格がないことが分かったASIN。
+    deadline (time.monotonic()の値) を過ぎたら残りのバッチは問い合わせない。
+    """
+    # 重複を除きつつ入力順を保つ
+    asins = list(dict.fromkeys(asin for asin in asins if asin))
+    prices = {}
+    errors = {}
 
-def get_amazon_competitive_price(asin):
-    """ASINに基づいてAmazonの競合価格情報を取得する。"""
     if any(val is None or "dummy" in str(val) for val in [LWA_CLIENT_ID, LWA_CLIENT_SECRET, REFRESH_TOKEN, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY]):
         print("[ERROR] Amazon SP-APIの認証情報が不足しています。環境変数を設定してください。")
-        return None
+        return prices, {asin: "credentials missing" for asin in asins}
 
     access_token = _get_lwa_access_token()
     if not access_token:
-        return None
+        return prices, {asin: "LWA access token unavailable" for asin in asins}
+
+    for i in range(0, len(asins), COMPETITIVE_PRICE_BATCH_SIZE):
+        batch = asins[i:i + COMPETITIVE_PRICE_BATCH_SIZE]
+        if deadline is not None and time.monotonic() >= deadline:
+            errors.update({asin: "deadline exceeded" for asin in asins[i:]})
+            break
+        try:
+            with stage("pricing"):
+                payload = _fetch_competitive_price_batch(batch, access_token, deadline)
+        except requests.exceptions.HTTPError as e:
+            print(f'[ERROR] Amazon SP-APIからの商品情報取得中にHTTPエラーが発生しました: {e.response.status_code} - {e.response.text}')
+            errors.update({asin: f"HTTP {e.response.status_code}" for asin in batch})
+            continue
+        except requests.exceptions.RequestException as e:
+            print(f"[ERROR] Amazon SP-APIからの商品情報取得中にリクエストエラーが発生しました: {e}")
+            errors.update({asin: str(e) for asin in batch})
+            continue
+        except Exception as e:
+            print(f"[ERROR] 予期せぬエラーが発生しました: {e}")
+            errors.update({asin: str(e) for asin in batch})
+            continue
+
+        # payloadをASINごとに振り分ける
+        for item_data in payload:
+            asin = item_data.get("ASIN")
+            if asin not in batch:
+                continue
+            if item_data.get("status", "Success") != "Success":
+                error = item_data.get("error") or {}
+                errors[asin] = error.get("message") or item_data.get("status")
+                continue
+            product = _parse_competitive_price(item_data)
+            if product:
+                prices[asin] = product
+            else:
+                print(f"[WARNING] Amazonで商品ASIN: {asin} の価格情報が見つかりませんでした。")
+                errors[asin] = NO_COMPETITIVE_PRICE
 
-    path = "/pricing/v0/competitivePrice"
-    query_params = {
-        "MarketplaceId": MARKETPLACE_ID,
-        "Asins": asin
-    }
+        for asin in batch:
+            if asin not in prices and asin not in errors:
+                print(f"[WARNING] Amazonで商品ASIN: {asin} が見つかりませんでした。")
+                errors[asin] = NOT_FOUND
 
-    # SigV4署名付きヘッダーを取得
-    signed_headers = _sign_request("GET", path, query_params, "")
-    # LWAトークンをヘッダーに追加
-    signed_headers["x-amz-access-token"] = access_token
-    signed_headers["Content-Type"] = "application/json"
+    return prices, errors
 
-    api_url = f"https://{HOST}{path}"
+def get_amazon_competitive_price(asin):
+    """ASINに基づいてAmazonの競合価格情報を取得する。"""
+    prices, _ = get_amazon_competitive_prices([asin])
+    return prices.get(asin)
 
-    try:
-        response = requests.get(api_url, headers=signed_headers, params=query_params)
-        response.raise_for_status()
-        data = response.json()
+# --- キーワード検索結果キャッシュ --- #
+_search_cache = search_cache.create_cache_from_env()
 
-        if data and data.get("payload") and len(data["payload"]) > 0:
-            item_data = data["payload"][0]
-            if item_data.get("Product", {}).get("CompetitivePricing", {}).get("CompetitivePrices"):
-                competitive_price = item_data["Product"]["CompetitivePricing"]["CompetitivePrices"][0]["Price"]["LandedPrice"]["Amount"]
-                product_title = f"Amazon Product (ASIN: {asin})"
-                product_url = f"https://www.amazon.co.jp/dp/{asin}"
-
-                return {
-                    "source": "Amazon",
-                    "product_name": product_title,
-                    "price": competitive_price,
-                    "asin": asin,
-                    "url": product_url
-                }
-            else:
-                print(f"[WARNING] Amazonで商品ASIN: {asin} の価格情報が見つかりませんでした。")
-                return None
-        else:
-            print(f"[WARNING] Amazonで商品ASIN: {asin} が見つかりませんでした。")
-            return None
+def search_cache_stats():
+    """キーワード検索キャッシュのヒット・ミス数を返す。"""
+    return _search_cache.stats()
 
-    except requests.exceptions.HTTPError as e:
-        print(f'[ERROR] Amazon SP-APIからの商品情報取得中にHTTPエラーが発生しました: {e.response.status_code} - {e.response.text}')
-        return None
-    except requests.exceptions.RequestException as e:
-        print(f"[ERROR] Amazon SP-APIからの商品情報取得中にリクエストエラーが発生しました: {e}")
-        return None
-    except Exception as e:
-        print(f"[ERROR] 予期せぬエラーが発生しました: {e}")
-        return None
+def search_amazon_products(keywords, page_size=10, deadline=None):
+    """Catalog Items APIを使用してキーワードで商品を検索する。
 
-def search_amazon_products(keywords, page_size=10):
-    """Catalog Items APIを使用してキーワードで商品を検索する。"""
+    deadline (time.monotonic()の値) を渡すと、レート制限の順番待ちとリトライを
+    その時刻で打ち切る。失敗したらNoneを返す。
+    """
     if any(val is None or "dummy" in str(val) for val in [LWA_CLIENT_ID, LWA_CLIENT_SECRET, REFRESH_TOKEN, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY]):
         print("[ERROR] Amazon SP-APIの認証情報が不足しています。環境変数を設定してください。")
         return None
 
+    cache_key = search_cache.make_key(keywords, MARKETPLACE_ID, page_size)
+    cached = _search_cache.get(cache_key)
+    if cached is not None:
+        count("search_cache.hit")
+        return [AmazonProduct.from_dict(product) for product in cached]
+    count("search_cache.miss")
+
     access_token = _get_lwa_access_token()
     if not access_token:
         return None
@@ -187,16 +239,9 @@ def search_amazon_products(keywords, page_size=10):
         "pageSize": page_size
     }
 
-    # SigV4署名付きヘッダーを取得
-    signed_headers = _sign_request("GET", path, query_params, "")
-    # LWAトークンをヘッダーに追加
-    signed_headers["x-amz-access-token"] = access_token
-    signed_headers["Content-Type"] = "application/json"
-
-    api_url = f"https://{HOST}{path}"
-
     try:
-        response = requests.get(api_url, headers=signed_headers, params=query_params)
+        with stage("catalog_search"):
+            response = _send_sp_api_request("searchCatalogItems", path, query_params, access_token, deadline)
         response.raise_for_status()
         data = response.json()
 
@@ -205,19 +250,23 @@ def search_amazon_products(keywords, page_size=10):
             for item in data["items"]:
                 asin = item.get("asin")
                 summary = item.get("summaries", [{}])[0]
-                product_info = {
-                    "source": "Amazon",
-                    "asin": asin,
-                    "product_name": summary.get("itemName"),
-                    "url": f"https://www.amazon.co.jp/dp/{asin}",
-                    "price": None  # Catalog Items APIは価格を返さない
-                }
+                product_info = AmazonProduct(
+                    source="Amazon",
+                    asin=asin,
+                    product_name=summary.get("itemName"),
+                    url=f"https://www.amazon.co.jp/dp/{asin}",
+                    price=None  # Catalog Items APIは価格を返さない
+                )
                 products.append(product_info)
+        _search_cache.set(cache_key, products)
         return products
 
     except requests.exceptions.HTTPError as e:
         print(f'[ERROR] Amazon SP-API商品検索中にHTTPエラー: {e.response.status_code} - {e.response.text}')
         return None
+    except requests.exceptions.RequestException as e:
+        print(f"[ERROR] Amazon SP-API商品検索中にリクエストエラー: {e}")
+        return None
     except Exception as e:
         print(f"[ERROR] 予期せぬエラー: {e}")
         return None
@@ -244,7 +293,7 @@ if __name__ == "__main__":
         if search_results:
             print("\n--- 商品検索結果 ---")
             for product in search_results:
-                print(json.dumps(product, indent=2, ensure_ascii=False))
+                print(json.dumps(product, indent=2, ensure_ascii=False, default=json_default))
         else:
             print("検索結果がありませんでした。")
     else:
@@ -0,0 +1,547 @@
+import argparse
+import glob
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+# オフラインのベンチマーク。markdown_chunks/ の商品を元に合成したカタログを
+# ローカルのスタブHTTPサーバーから返し、コストコ・SP-APIに接続せずに
+# パーサー・マッチング・比較・署名・/api/compareハンドラーを計測する。
+#
+#   python benchmark.py --sizes 1000,10000 --iterations 20 --json bench.json
+
+CHUNK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "markdown_chunks")
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+
+
+# --- フィクスチャ --- #
+def load_seed_markdown():
+    contents = []
+    for path in sorted(glob.glob(os.path.join(CHUNK_DIR, "*.md"))):
+        with open(path, encoding="utf-8") as f:
+            contents.append(f.read())
+    return "\n".join(contents)
+
+
+def load_seed_products():
+    from costco_parser import parse_costco_markdown
+    return parse_costco_markdown(load_seed_markdown())
+
+
+def make_catalog(size, seed=0):
+    """シード商品からsize件のコストコ商品と、名前で対応するAmazon商品を合成する。"""
+    rng = random.Random(seed)
+    seeds = load_seed_products()
+    costco_products = []
+    amazon_products = []
+    for i in range(size):
+        base = seeds[i % len(seeds)]
+        name = f"{base['product_name']} モデル{i:06d}"
+        price = round(base["price"] * rng.uniform(0.8, 1.2))
+        asin = f"B{i:09d}"
+        costco_products.append({"product_name": name, "price": price, "url": f"https://www.costco.co.jp/c/bench/p/{i}"})
+        amazon_products.append({
+            "product_name": f"{name} Amazon限定",
+            "price": round(price * rng.uniform(0.6, 1.5)),
+            "asin": asin,
+            "url": f"https://www.amazon.co.jp/dp/{asin}",
+        })
+    return costco_products, amazon_products
+
+
+def render_costco_html(products):
+    """コストコ検索結果ページに似せたHTML (ヘッダー・フッター・画像・評価などを含む)。"""
+    header = (
+        '<header class="site-header"><nav>'
+        + "".join(f'<ul class="menu"><li><a href="/c/{i}">カテゴリ{i}</a><span class="badge">新着</span></li></ul>' for i in range(40))
+        + "</nav></header>"
+    )
+    cards = [
+        '<div class="product-card" data-product-id="{i}">'
+        '<div class="thumb"><a href="{url}"><img src="/img/{i}.jpg" alt="{name}" loading="lazy"></a></div>'
+        '<div class="product-card-body">'
+        '<a class="product-card-name" href="{url}">{name}</a>'
+        '<div class="rating"><span class="stars" style="width: 80%"></span><span class="count">(123)</span></div>'
+        '<div class="price-panel"><span class="price">¥{price:,}</span><span class="unit">税込</span></div>'
+        '<a class="product-card-link" href="{url}">詳細を見る</a>'
+        '<button class="add-to-cart" type="button">カートに追加</button>'
+        "</div></div>".format(i=i, name=p["product_name"], price=p["price"], url=p["url"])
+        for i, p in enumerate(products)
+    ]
+    footer = '<footer><script>window.dataLayer = window.dataLayer || [];</script><p>&copy; Costco</p></footer>'
+    return "<html><head><title>検索結果</title></head><body>" + header + "".join(cards) + footer + "</body></html>"
+
+
+class FixtureServer:
+    """コストコ検索・Costco検索API・LWA・SP-APIを模したスタブHTTPサーバー。
+
+    latencyで1リクエストごとの遅延 (ネットワーク往復の代わり) を与える。
+    """
+
+    def __init__(self, costco_products, amazon_products, page_size=24, latency=0.0):
+        self.page_size = page_size
+        self.latency = latency
+        self.requests = 0
+        self.set_catalog(costco_products, amazon_products)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def set_catalog(self, costco_products, amazon_products):
+        self.costco_products = costco_products
+        self.amazon_by_name = {p["product_name"]: p for p in amazon_products}
+        self.amazon_by_costco_name = {c["product_name"]: a for c, a in zip(costco_products, amazon_products)}
+        self.amazon_by_asin = {p["asin"]: p for p in amazon_products}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _search_page(self, keyword, start=0):
+        # キーワードごとに決まった位置からpage_size件を返す
+        offset = (sum(map(ord, keyword)) * 7919 + start) % max(1, len(self.costco_products))
+        page = self.costco_products[offset:offset + self.page_size]
+        return page + self.costco_products[:self.page_size - len(page)]
+
+    def _make_handler(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # ヘッダーと本文を別々に書くので、Nagle + 遅延ACKの40ms待ちを避ける
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, body, content_type="application/json", headers=None):
+                data = body.encode("utf-8") if isinstance(body, str) else body
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                fixture.requests += 1
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(fixture.latency)
+                # LWAトークン
+                self._reply(json.dumps({"access_token": "bench-token", "expires_in": 3600}))
+
+            def do_GET(self):
+                fixture.requests += 1
+                time.sleep(fixture.latency)
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                sp_api_headers = {"x-amzn-RateLimit-Limit": "1000"}
+
+                if url.path.startswith("/search/"):
+                    keyword = unquote(url.path[len("/search/"):])
+                    self._reply(render_costco_html(fixture._search_page(keyword)), "text/html; charset=utf-8")
+                elif url.path.startswith("/api/apps/"):
+                    start = int(query.get("start", ["0"])[0])
+                    docs = [{
+                        "item_product_name": p["product_name"],
+                        "item_location_pricing_salePrice": p["price"],
+                        "item_number": p["url"].rsplit("/", 1)[-1],
+                    } for p in fixture._search_page(query.get("q", [""])[0], start)]
+                    self._reply(json.dumps({"response": {"numFound": len(fixture.costco_products), "docs": docs}}))
+                elif url.path == "/catalog/2020-12-01/items":
+                    keywords = query.get("keywords", [""])[0]
+                    item = fixture.amazon_by_costco_name.get(keywords) or fixture.amazon_by_name.get(keywords)
+                    items = [{"asin": item["asin"], "summaries": [{"itemName": item["product_name"]}]}] if item else []
+                    self._reply(json.dumps({"items": items}, ensure_ascii=False), headers=sp_api_headers)
+                elif url.path == "/pricing/v0/competitivePrice":
+                    payload = []
+                    for asin in query.get("Asins", [""])[0].split(","):
+                        item = fixture.amazon_by_asin.get(asin)
+                        if item:
+                            payload.append({"ASIN": asin, "status": "Success", "Product": {"CompetitivePricing": {
+                                "CompetitivePrices": [{"Price": {"LandedPrice": {"Amount": item["price"]}}}]}}})
+                    self._reply(json.dumps({"payload": payload}), headers=sp_api_headers)
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+
+# --- 計測 --- #
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(fn, iterations, units=1, warmup=1):
+    """fnをiterations回実行し、p50/p99 (ms)・スループット (units/秒)・ピークメモリ (KiB) を返す。
+
+    ピークメモリは計時とは別にtracemallocを有効にした1回の実行で測る。
+    """
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    mean = statistics.fmean(timings)
+    return {
+        "iterations": iterations,
+        "p50_ms": round(percentile(timings, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+        "mean_ms": round(mean * 1000, 3),
+        "throughput_per_s": round(units / mean, 1) if mean else None,
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def bench_parser(size, iterations):
+    from costco_parser import _parse_costco_markdown_regex, iter_costco_markdown_file, parse_costco_markdown
+    seed = load_seed_markdown()
+    seed_items = len(parse_costco_markdown(seed))
+    repeat = max(1, size // max(1, seed_items))
+    content = "\n".join([seed] * repeat)
+    result = measure(lambda: parse_costco_markdown(content), iterations, units=seed_items * repeat)
+    result["input_mb"] = round(len(content.encode("utf-8")) / 1e6, 2)
+    # 旧実装 (正規表現) との比較。正しい入力ではCの正規表現エンジンの方が速い
+    legacy = measure(lambda: _parse_costco_markdown_regex(content), iterations)
+    result["legacy_regex_p50_ms"] = legacy["p50_ms"]
+    # ファイルから逐次読み込む場合のピークメモリ (入力サイズによらず一定に収まる)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "costco.md")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        streaming = measure(lambda: sum(1 for _ in iter_costco_markdown_file(path)), 1, warmup=0)
+    result["streaming_peak_kib"] = streaming["peak_kib"]
+    return result
+
+
+def bench_parser_malformed(size, iterations):
+    """壊れた入力 (商品リンクのない画像・閉じていない'![') を100バイトずつ流し込む。
+
+    旧実装はリンクのない画像の後の行数に対して指数的にバックトラックするため、
+    新しいパーサーの時間が行数 (size) に比例することだけを確認する。
+    """
+    from costco_parser import CostcoMarkdownStream
+
+    def feed():
+        for prefix in ("![orphan](https://example.com/a.jpg)\n", "![never closed", "![a](x)\n[never closed"):
+            stream = CostcoMarkdownStream()
+            stream.feed(prefix)
+            for _ in range(size):
+                stream.feed("y" * 99 + "\n")
+            stream.close()
+
+    result = measure(feed, iterations, units=size * 3)
+    result["input_mb"] = round(size * 3 * 100 / 1e6, 2)
+    return result
+
+
+def bench_html(size, iterations):
+    from costco_html_parser import parse_costco_html
+    html = render_costco_html(make_catalog(size)[0])
+    result = measure(lambda: parse_costco_html(html), iterations, units=size)
+    result["input_mb"] = round(len(html.encode("utf-8")) / 1e6, 2)
+    return result
+
+
+def bench_matcher(size, iterations):
+    from product_matcher import ProductIndex
+    costco_products, amazon_products = make_catalog(size)
+    index = ProductIndex.from_products(amazon_products)
+    queries = [p["product_name"] for p in random.Random(1).sample(costco_products, min(200, size))]
+    result = measure(lambda: [index.find_substring_matches(q) for q in queries], iterations, units=len(queries))
+    result["build_ms"] = round(measure(lambda: ProductIndex.from_products(amazon_products), 3, warmup=0)["mean_ms"], 3)
+    return result
+
+
+def bench_comparator(size, iterations):
+    from price_comparator import compare_prices
+    costco_products, amazon_products = make_catalog(size)
+    return measure(lambda: compare_prices(costco_products, amazon_products), iterations, units=size)
+
+
+def bench_ranking(size, iterations):
+    """比較結果size件から価格差の大きい順に上位20件 (1ページ目) を選ぶ。"""
+    from price_comparator import compare_prices
+    from result_ranking import annotate_unit_prices, rank_page
+    costco_products, amazon_products = make_catalog(size)
+    results = annotate_unit_prices(compare_prices(costco_products, amazon_products))
+    result = measure(lambda: rank_page(results, "percentage", 20), iterations, units=len(results))
+    result["results"] = len(results)
+    return result
+
+
+def bench_wire(size, iterations):
+    """比較結果size件のレスポンスのシリアライズ+gzip (既定の経路) と、形式ごとの転送バイト数。"""
+    from price_comparator import compare_prices
+    from result_ranking import annotate_unit_prices
+    from wire_format import COLUMNS, JSON, MSGPACK, apply_layout, compress, dumps_json, msgpack, serialize
+    costco_products, amazon_products = make_catalog(size * 5)
+    results = annotate_unit_prices(compare_prices(costco_products, amazon_products))[:size]
+    data = {"keyword": "ティッシュ", "results": results, "partial": False}
+    result = measure(lambda: compress(dumps_json(data), "gzip"), iterations, units=len(results))
+    result["results"] = len(results)
+    result["bytes_ascii_json"] = len(json.dumps(data).encode("utf-8"))
+    for media_type in (JSON, MSGPACK) if msgpack else (JSON,):
+        for layout in ("rows", COLUMNS):
+            body = serialize(apply_layout(data, layout), media_type)
+            result[f"bytes_{media_type}_{layout}"] = len(body)
+            result[f"bytes_{media_type}_{layout}_gzip"] = len(compress(body, "gzip"))
+    return result
+
+
+def bench_vectorized(size, iterations):
+    from vectorized_comparator import compare_price_arrays
+    costco_products, amazon_products = make_catalog(size)
+    costco_prices = [p["price"] for p in costco_products]
+    amazon_prices = [p["price"] for p in amazon_products]
+    return measure(lambda: compare_price_arrays(costco_prices, amazon_prices), iterations, units=size)
+
+
+def bench_signer(size, iterations):
+    from sigv4_signer import SigV4Signer
+    signer = SigV4Signer("AKIDEXAMPLE", "secret", "us-west-2", "sellingpartnerapi-fe.amazon.com")
+    params = {"keywords": "カークランド トイレットペーパー", "marketplaceIds": "A1VC38T7YXB528", "pageSize": 10}
+    return measure(lambda: [signer.sign("GET", "/catalog/2020-12-01/items", params) for _ in range(size)], iterations, units=size)
+
+
+# --- コールドスタート --- #
+# コールドスタートで読み込まれてはいけない重いモジュール (最初のリクエストで遅延読み込みする)
+COLD_START_DEFERRED_MODULES = ("requests", "bs4", "dotenv", "lxml", "numpy", "amazon_sp_api_client", "price_comparator")
+
+
+def import_time_report(module="compare", cwd=API_DIR, code=None):
+    """新しいPythonプロセスでmoduleを読み込み、-X importtimeの結果を返す。
+
+    {"total_ms": 全体, "modules": {モジュール名: 累積ms}} を返す。codeを渡すと
+    import後にそのコードも実行する (遅延読み込みの所要時間を測る場合など)。
+    """
+    script = f"import {module}" + (f"; {code}" if code else "")
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        cwd=cwd, capture_output=True, text=True, check=True,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"),
+    )
+    # 出力は読み込みが終わった順 (子が先) で、インデントが入れ子の深さを表す。
+    # インタープリター起動時の読み込みは除き、moduleの配下だけを集める
+    modules = {}
+    subtree = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, field = line.split("|")
+        cumulative = cumulative.strip()
+        if not cumulative.isdigit():
+            continue
+        name = field.strip()
+        subtree[name] = round(int(cumulative) / 1000, 3)
+        if field[1:2] != " ":  # 最上位のimport
+            if name == module:
+                modules = subtree
+            subtree = {}
+    return {"total_ms": modules.get(module), "modules": modules, "stdout": completed.stdout}
+
+
+def bench_cold_start(size, iterations):
+    """api/compare.pyのコールドスタート (import) と、最初のリクエストでのバックエンド読み込みの時間。"""
+    runs = [import_time_report() for _ in range(max(1, iterations))]
+    totals = sorted(run["total_ms"] for run in runs)
+    modules = runs[-1]["modules"]
+    backend = import_time_report(code="import time; start = time.perf_counter(); compare._load_backend(); "
+                                      "print((time.perf_counter() - start) * 1000)")
+    mean = statistics.fmean(totals)
+    return {
+        "iterations": len(totals),
+        "p50_ms": round(percentile(totals, 0.5), 3),
+        "p99_ms": round(percentile(totals, 0.99), 3),
+        "mean_ms": round(mean, 3),
+        "throughput_per_s": round(1000 / mean, 1) if mean else None,
+        "peak_kib": 0.0,
+        "backend_load_ms": round(float(backend["stdout"].strip().splitlines()[-1]), 3),
+        "slowest_modules": dict(sorted(modules.items(), key=lambda item: -item[1])[1:11]),
+        "eager_deferred_modules": [name for name in COLD_START_DEFERRED_MODULES if name in modules],
+    }
+
+
+# APIモジュールは接続先を読み込み時に決めるので、スタブサーバーとAPIサーバーは1回だけ起動する
+_handler_env = None
+
+
+def _start_handler_env(costco_products, amazon_products, latency):
+    global _handler_env
+    if _handler_env is not None:
+        fixture, url = _handler_env
+        fixture.set_catalog(costco_products, amazon_products)
+        fixture.latency = latency
+        return _handler_env
+
+    fixture = FixtureServer(costco_products, amazon_products, latency=latency).start()
+    os.environ.update({
+        "COSTCO_SEARCH_URL": fixture.base_url + "/search/",
+        "COSTCO_API_URL": fixture.base_url + "/api/apps/bench",
+        "LWA_TOKEN_URL": fixture.base_url + "/auth/o2/token",
+        "SP_API_ENDPOINT": fixture.host,
+        "SP_API_SCHEME": "http",
+        "SP_API_TOKEN_CACHE": "",
+        "SP_API_CLIENT_ID": "bench", "SP_API_CLIENT_SECRET": "bench", "SP_API_REFRESH_TOKEN": "bench",
+        "AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench",
+    })
+    if API_DIR not in sys.path:
+        sys.path.insert(0, API_DIR)
+    import compare
+    import amazon_sp_api_client
+    from sp_api_scheduler import SpApiScheduler
+    # スタブは上限を1000/秒と返すが、最初のバケットも同じ値から始めて計測をレート制限待ちにしない
+    amazon_sp_api_client._scheduler = SpApiScheduler(limits={"searchCatalogItems": (1000.0, 100), "getCompetitivePricing": (1000.0, 100)})
+
+    class QuietHandler(compare.handler):
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), QuietHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    _handler_env = fixture, f"http://127.0.0.1:{server.server_port}/api/compare"
+    return _handler_env
+
+
+def bench_handler(size, iterations, latency=0.0):
+    """スタブサーバーに向けた /api/compare のエンドツーエンド (1リクエスト = 1キーワード)。"""
+    import requests
+
+    costco_products, amazon_products = make_catalog(size)
+    fixture, url = _start_handler_env(costco_products, amazon_products, latency)
+    # 環境変数を設定してから読み込む
+    import compare
+    import amazon_sp_api_client
+    session = requests.Session()
+    counter = iter(range(10 ** 9))
+
+    def one_request():
+        # キャッシュに当たらないよう毎回別のキーワードにする
+        keyword = f"bench-{next(counter)}"
+        if compare.response_cache:
+            compare.response_cache.clear()
+        amazon_sp_api_client._search_cache.clear()
+        response = session.post(url, json={"keyword": keyword})
+        response.raise_for_status()
+        return response.json()
+
+    results = one_request()["results"]
+    before = fixture.requests
+    result = measure(one_request, iterations)
+    # measure()はウォームアップ1回 + 計時 + メモリ計測1回を実行する
+    result["upstream_requests_per_call"] = round((fixture.requests - before) / (iterations + 2), 1)
+    result["results_per_call"] = len(results)
+    return result
+
+
+BENCHMARKS = {
+    "parser": bench_parser,
+    "malformed": bench_parser_malformed,
+    "html": bench_html,
+    "matcher": bench_matcher,
+    "comparator": bench_comparator,
+    "ranking": bench_ranking,
+    "wire": bench_wire,
+    "vectorized": bench_vectorized,
+    "signer": bench_signer,
+    "handler": bench_handler,
+    "cold_start": bench_cold_start,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="price_comparison_system offline benchmarks")
+    parser.add_argument("--sizes", default="1000,10000", help="合成カタログの商品数 (カンマ区切り)")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="実行するベンチマーク (カンマ区切り)")
+    parser.add_argument("--latency", type=float, default=0.0, help="スタブサーバーの1リクエストあたりの遅延 (秒)")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    parser.add_argument("--max-import-ms", type=float, help="cold_startのp50がこれを超えたら終了コード1にする")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    names = [name for name in args.only.split(",") if name]
+    report = []
+    failures = []
+    print(f"{'benchmark':<12} {'size':>7} {'p50 ms':>10} {'p99 ms':>10} {'throughput/s':>14} {'peak KiB':>10}")
+    for name in names:
+        for size in sizes:
+            if name == "handler":
+                result = bench_handler(size, args.iterations, args.latency)
+            else:
+                result = BENCHMARKS[name](size, args.iterations)
+            result.update(benchmark=name, size=size)
+            report.append(result)
+            print(f"{name:<12} {size:>7} {result['p50_ms']:>10.3f} {result['p99_ms']:>10.3f}"
+                  f" {result['throughput_per_s']:>14,.1f} {result['peak_kib']:>10.1f}")
+            if name == "parser":
+                print(f"    legacy regex p50 {result['legacy_regex_p50_ms']:.3f} ms,"
+                      f" streaming file peak {result['streaming_peak_kib']:.1f} KiB")
+            if name == "cold_start":
+                failures.extend(check_cold_start(result, args.max_import_ms))
+                break  # 商品数に依存しない
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "results": report}, f, ensure_ascii=False, indent=2)
+        print(f"[INFO] 結果を {args.json} に保存しました。")
+    for failure in failures:
+        print(f"[ERROR] {failure}")
+    if failures:
+        sys.exit(1)
+    return report
+
+
+def check_cold_start(result, max_import_ms=None):
+    """コールドスタートの退行 (重いモジュールの即時読み込み・時間の超過) を列挙する。"""
+    print(f"    backend load on first request: {result['backend_load_ms']:.1f} ms")
+    for module_name, elapsed in result["slowest_modules"].items():
+        print(f"    {elapsed:>9.3f} ms  {module_name}")
+    failures = [f"cold start imports {name} eagerly" for name in result["eager_deferred_modules"]]
+    if max_import_ms is not None and result["p50_ms"] > max_import_ms:
+        failures.append(f"cold start import p50 {result['p50_ms']:.1f} ms exceeds {max_import_ms:.1f} ms")
+    return failures
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
@@ -0,0 +1,243 @@
+import os
+from html.parser import HTMLParser
+
+try:
+    from .product_records import CostcoProduct
+except ImportError:
+    from product_records import CostcoProduct
+
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+# コストコ検索結果ページの商品カードと、カード内で取り出す要素
+# (api/compare.pyのCSSセレクター div.product-card / a.product-card-name /
+#  span.price / a.product-card-link と同じもの)
+CARD_CLASS = "product-card"
+_FIELD_SELECTORS = {
+    ("a", "product-card-name"): "name",
+    ("span", "price"): "price",
+    ("a", "product-card-link"): "url",
+}
+# 0にするとlxmlがあっても標準ライブラリのパーサーを使う
+USE_LXML = os.getenv("COSTCO_HTML_LXML", "1") == "1" and lxml_html is not None
+
+
+def _to_price(price_text):
+    try:
+        return float(price_text.replace("¥", "").replace(",", "").strip())
+    except ValueError:
+        return None
+
+
+def _make_product(name, price_text, url):
+    """api/compare.pyの従来の抽出と同じ規則でCostcoProductにする。欠けていればNone。
+
+    compare_pricesが読むproduct_name / price / urlのレコードなので、比較の前に
+    辞書へ詰め直す必要はない。
+    """
+    if name is None or price_text is None or url is None:
+        return None
+    name = name.strip()
+    price = _to_price(price_text)
+    if price is None:
+        return None
+    return CostcoProduct(name, price, url)
+
+
+class _ProductCardParser(HTMLParser):
+    """商品カードの中だけを見て名前・価格・URLを1パスで取り出すパーサー。
+
+    ツリーは作らない。カードの外のタグはクラスを1回見るだけで読み飛ばし、
+    カードの中では対象の要素のテキストだけを集める。
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.products = []
+        self._card = None  # 現在のカードのフィールド -> 値
+        self._card_depth = 0  # カード内のdivの入れ子の深さ
+        self._collectors = []  # [フィールド名, タグ, 入れ子の深さ, テキスト片のリスト]
+
+    def handle_starttag(self, tag, attrs):
+        if self._card is None:
+            if tag == "div":
+                for name, value in attrs:
+                    if name == "class" and value and CARD_CLASS in value.split():
+                        self._card = {}
+                        self._card_depth = 1
+                        break
+            return
+
+        if tag == "div":
+            self._card_depth += 1
+        for collector in self._collectors:
+            if collector[1] == tag:
+                collector[2] += 1
+        if tag != "a" and tag != "span":
+            return
+
+        classes = href = None
+        for name, value in attrs:
+            if name == "class":
+                classes = value
+            elif name == "href" and href is None:
+                href = value
+        if not classes:
+            return
+        for css_class in classes.split():
+            field = _FIELD_SELECTORS.get((tag, css_class))
+            # select_oneと同じく、カード内で最初に一致した要素だけを使う
+            if field is None or field in self._card:
+                continue
+            if field == "url":
+                self._card[field] = href
+            else:
+                self._card[field] = None
+                self._collectors.append([field, tag, 1, []])
+
+    def handle_endtag(self, tag):
+        if self._card is None:
+            return
+        for collector in self._collectors[:]:
+            if collector[1] == tag:
+                collector[2] -= 1
+                if collector[2] == 0:
+                    self._finish(collector)
+        if tag == "div":
+            self._card_depth -= 1
+            if self._card_depth == 0:
+                self._close_card()
+
+    def handle_data(self, data):
+        for collector in self._collectors:
+            collector[3].append(data)
+
+    def _finish(self, collector):
+        self._collectors.remove(collector)
+        self._card[collector[0]] = "".join(collector[3])
+
+    def _close_card(self):
+        for collector in self._collectors[:]:
+            self._finish(collector)
+        card, self._card = self._card, None
+        product = _make_product(card.get("name"), card.get("price"), card.get("url"))
+        if product is not None:
+            self.products.append(product)
+
+    def close(self):
+        super().close()
+        if self._card is not None:
+            self._close_card()
+
+
+def _has_class(css_class):
+    return f'contains(concat(" ", normalize-space(@class), " "), " {css_class} ")'
+
+
+if lxml_html is not None:
+    # セレクターはXPathとして一度だけコンパイルしておく
+    _CARD_XPATH = etree.XPath(f"//div[{_has_class(CARD_CLASS)}]")
+    _FIELD_XPATHS = {
+        field: etree.XPath(f"(.//{tag}[{_has_class(css_class)}])[1]")
+        for (tag, css_class), field in _FIELD_SELECTORS.items()
+    }
+
+
+def _parse_with_lxml(html):
+    root = lxml_html.fromstring(html)
+    products = []
+    for card in _CARD_XPATH(root):
+        fields = {}
+        for field, xpath in _FIELD_XPATHS.items():
+            found = xpath(card)
+            if not found:
+                fields[field] = None
+            elif field == "url":
+                fields[field] = found[0].get("href")
+            else:
+                fields[field] = found[0].text_content()
+        product = _make_product(fields["name"], fields["price"], fields["url"])
+        if product is not None:
+            products.append(product)
+    return products
+
+
+def _parse_with_html_parser(html):
+    parser = _ProductCardParser()
+    parser.feed(html)
+    parser.close()
+    return parser.products
+
+
+def parse_costco_html(html):
+    """コストコ検索結果ページのHTMLからCostcoProduct (product_name, price, url) のリストを返す。
+
+    lxmlがあればCで実装されたパーサーとコンパイル済みXPathを、なければ
+    商品カードだけを1パスで読むhtml.parserベースのパーサーを使う。
+    """
+    if not html or not html.strip():
+        return []
+    if USE_LXML:
+        return _parse_with_lxml(html)
+    return _parse_with_html_parser(html)
+
+
+if __name__ == "__main__":
+    import time
+    import tracemalloc
+
+    from bs4 import BeautifulSoup
+
+    try:
+        from .benchmark import make_catalog, render_costco_html
+    except ImportError:
+        from benchmark import make_catalog, render_costco_html
+
+    def parse_with_soup(html):
+        # api/compare.pyの従来の実装 (比較用)
+        soup = BeautifulSoup(html, "html.parser")
+        products = []
+        for card in soup.select("div.product-card"):
+            name_element = card.select_one("a.product-card-name")
+            price_element = card.select_one("span.price")
+            link_element = card.select_one("a.product-card-link")
+            name = name_element.text.strip() if name_element else "N/A"
+            price_text = price_element.text.strip() if price_element else "N/A"
+            url = link_element["href"] if link_element and "href" in link_element.attrs else "N/A"
+            price = None
+            if price_text != "N/A":
+                try:
+                    price = float(price_text.replace("¥", "").replace(",", "").strip())
+                except ValueError:
+                    pass
+            if name != "N/A" and price is not None and url != "N/A":
+                products.append(CostcoProduct(name, price, url))
+        return products
+
+    def run(parse, html, iterations):
+        parse(html)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            parse(html)
+        elapsed = (time.perf_counter() - start) / iterations
+        tracemalloc.start()
+        parse(html)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return elapsed, peak
+
+    parsers = [("bs4 html.parser", parse_with_soup), ("single-pass html.parser", _parse_with_html_parser)]
+    if lxml_html is not None:
+        parsers.append(("lxml + XPath", _parse_with_lxml))
+
+    for cards in (24, 96, 480):
+        html = render_costco_html(make_catalog(cards)[0])
+        expected = parse_with_soup(html)
+        print(f"{cards} product cards, {len(html.encode('utf-8')) / 1024:.0f} KiB page")
+        for label, parse in parsers:
+            assert parse(html) == expected, label
+            elapsed, peak = run(parse, html, 20)
+            print(f"    {label:<24} {elapsed * 1e3:8.2f} ms/page  peak {peak / 1024:8.0f} KiB")
@@ -1,18 +1,419 @@
-
 import json
+import os
 import re
 
-def parse_costco_markdown(markdown_content):
-    products = []
-    product_pattern = re.compile(
-        r'\!\[(?P<img_alt>[^\]]+)\]\((?P<img_url>[^\)]+)\)\s*\n+'  # 画像とALTテキスト
-        r'(?:¥(?P<price>[0-9,]+)\s*\n+)?'  # 価格 (オプション)
-        r'(?:.*?\n)*?' # 価格と商品名リンクの間の任意の行 (非貪欲、複数行対応)
-        r'\[(?P<product_name>[^\]]+)\]\((?P<product_url>[^\)]+)\)' # 商品名とURL
-        , re.DOTALL
+try:
+    from .metrics import stage
+    from .product_records import CostcoProduct
+except ImportError:
+    from metrics import stage
+    from product_records import CostcoProduct
+
+# 旧実装の正規表現。互換性の確認とベンチマークのためだけに残している
+_LEGACY_PRODUCT_PATTERN = re.compile(
+    r'\!\[(?P<img_alt>[^\]]+)\]\((?P<img_url>[^\)]+)\)\s*\n+'  # 画像とALTテキスト
+    r'(?:¥(?P<price>[0-9,]+)\s*\n+)?'  # 価格 (オプション)
+    r'(?:.*?\n)*?' # 価格と商品名リンクの間の任意の行 (非貪欲、複数行対応)
+    r'\[(?P<product_name>[^\]]+)\]\((?P<product_url>[^\)]+)\)' # 商品名とURL
+    , re.DOTALL
+)
+
+# 状態遷移の中で使う単純な走査 (いずれもバックトラックしない)
+_WHITESPACE = re.compile(r'\s*')
+_PRICE_DIGITS = re.compile(r'[0-9,]*')
+_LINE_START_BRACKET = re.compile(r'^\[', re.MULTILINE)
+# 商品リンクの前の表示単価の行 (例: 1ロール当り ¥107)
+_UNIT_PRICE_LINE = re.compile(r'^[ \t]*(\d+(?:\.\d+)?[^\s\d¥]{1,8}?)当た?り[ \t]*¥([0-9,]+)[ \t]*$', re.MULTILINE)
+# リンク待ちで捨てる行のうち、続きのデータと合わせて単価の行になりうる末尾の長さ
+_MAX_PENDING_LINE = 64
+
+
+# Firecrawlの結果JSONで商品Markdownが入っているトップレベルのキー
+_FIRECRAWL_MARKDOWN_KEY = '"markdown"'
+# JSONの入れ子と文字列を追うための走査
+_JSON_TOKEN = re.compile(r'[{}\[\]"]')
+_JSON_STRING_BODY = re.compile(r'(?:[^"\\]|\\.)*', re.DOTALL)
+_JSON_STRING_VALUE = re.compile(r'\s*:\s*"')
+_JSON_COLON_PREFIX = re.compile(r'\s*(?::\s*)?')
+_JSON_HIGH_SURROGATE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}')
+
+# _bracket_link・_skip_line_breakで、判定にバッファ末尾より先のデータが必要なことを表す
+_INCOMPLETE = object()
+# リンクのラベル・URLの最大長。閉じていない'['・'('でバッファを溜め続けないよう、
+# これより長いものはリンクとみなさずに次の候補へ進む
+_MAX_LINK_TEXT = 4096
+
+
+class _NextIndex:
+    """text.find(char, start) の直近の結果を覚えておく。
+
+    検索開始位置は前方にしか進まないので、同じ区間を何度も走査せずに済む。
+    """
+
+    def __init__(self, text, char):
+        self.text = text
+        self.char = char
+        self._start = None
+        self._found = -1
+
+    def __call__(self, start):
+        if self._start is not None and self._start <= start and (self._found < 0 or start <= self._found):
+            return self._found
+        self._start = start
+        self._found = self.text.find(self.char, start)
+        return self._found
+
+
+def _bracket_link(text, start, next_bracket, next_paren, final):
+    """text[start]の'['から始まる `[ラベル](URL)` を読む。
+
+    (ラベル開始, ラベル終了, URL開始, URL終了) を返し、リンクでなければNoneを返す。
+    ラベル・URLはそれぞれ最初の']'・')'までで、空であってはならず、_MAX_LINK_TEXT文字を
+    超えてもいけない (閉じ括弧がまだ届いていなくても、超えた時点でNoneにする)。
+    final=Falseで判定にバッファの続きが必要な場合は_INCOMPLETEを返す。
+    """
+    label_end = next_bracket(start + 1)
+    if (label_end if label_end >= 0 else len(text)) - start - 1 > _MAX_LINK_TEXT:
+        return None
+    if label_end < 0 or label_end + 1 >= len(text):
+        return None if final else _INCOMPLETE
+    if label_end == start + 1 or text[label_end + 1] != "(":
+        return None
+    url_end = next_paren(label_end + 2)
+    if (url_end if url_end >= 0 else len(text)) - label_end - 2 > _MAX_LINK_TEXT:
+        return None
+    if url_end < 0:
+        return None if final else _INCOMPLETE
+    if url_end == label_end + 2:
+        return None
+    return start + 1, label_end, label_end + 2, url_end
+
+
+def _skip_line_break(text, pos, final):
+    """posから続く空白を読み、改行を含んでいれば最後の改行の次の位置を返す。含まなければ-1。
+
+    final=Falseで空白がバッファ末尾まで続く場合は_INCOMPLETEを返す。
+    """
+    end = _WHITESPACE.match(text, pos).end()
+    if end == len(text) and not final:
+        return _INCOMPLETE
+    newline = text.rfind("\n", pos, end)
+    return newline + 1 if newline >= 0 else -1
+
+
+def _make_product(product_name, price_str, product_url, unit=None):
+    product_name = product_name.strip()
+    price = int(price_str.replace(',', '')) if price_str else None
+    product_url = product_url.strip()
+
+    if product_name and product_url:
+        unit_label, unit_price = unit if unit else (None, None)
+        return CostcoProduct(product_name, price, product_url, unit_price, unit_label)
+    return None
+
+
+class CostcoMarkdownStream:
+    """コストコのMarkdownを少しずつ受け取り、確定した商品から返すパーサー。
+
+    画像 → (価格) → 行頭の商品リンク の並びを読む状態機械で、状態は
+    「画像を探す」「行頭のリンクを探す」の2つ (価格は画像の直後に読む)。
+    リンクを探す間に読み飛ばした行に表示単価があれば、その商品の単価にする。
+    判定が済んだ部分はバッファから捨てるので、保持するのは読みかけの
+    1商品分だけになる。閉じていない'['は_MAX_LINK_TEXT文字で諦めるので、
+    バッファが際限なく伸びて毎回読み直すことはなく、全体で線形時間。
+    (旧実装と違い、_MAX_LINK_TEXTより長いALT・商品名・URLはリンクとみなさない)
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._awaiting_link = False  # 画像(と価格)を読み終え、商品リンクを待っている
+        self._price_str = None
+        self._unit = None  # リンク待ちの間に見つけた表示単価 (ラベル, 価格)
+        self._mid_line = False  # バッファ先頭が行の途中 (リンク待ちで長い行を捨てた場合)
+        self._finished = False  # これ以降に商品が現れないことが確定した
+
+    def feed(self, text):
+        """Markdownの続きを渡し、新たに確定した商品のリストを返す。"""
+        self._buffer += text
+        return self._scan(final=False)
+
+    def close(self):
+        """入力の終わりを伝え、残りの商品を返す。"""
+        return self._scan(final=True)
+
+    def _scan(self, final):
+        products = []
+        if self._finished:
+            self._buffer = ""
+            return products
+
+        text = self._buffer
+        next_bracket = _NextIndex(text, "]")
+        next_paren = _NextIndex(text, ")")
+        pos = 0
+        at_line_start = True  # リンク待ちのときバッファ先頭は行頭 (_mid_lineの場合を除く)
+        while True:
+            if not self._awaiting_link:
+                # 1. 行末で終わる画像 `![ALT](URL)` を探す
+                image_start = text.find("![", pos)
+                if image_start < 0:
+                    # 末尾の'!'は次のデータと合わせて'!['になりうる
+                    pos = len(text) - 1 if text.endswith("!") and not final else len(text)
+                    break
+                image = _bracket_link(text, image_start + 1, next_bracket, next_paren, final)
+                if image is _INCOMPLETE:
+                    pos = image_start
+                    break
+                line_start = _skip_line_break(text, image[3] + 1, final) if image else -1
+                if line_start is _INCOMPLETE:
+                    pos = image_start
+                    break
+                if line_start < 0:
+                    pos = image_start + 1
+                    continue
+
+                # 2. 画像の直後の行が `¥1,234` だけなら価格として読む
+                if line_start == len(text) and not final:
+                    pos = image_start
+                    break
+                price_str = None
+                if text.startswith("¥", line_start):
+                    price_end = _PRICE_DIGITS.match(text, line_start + 1).end()
+                    if price_end == len(text) and not final:
+                        pos = image_start
+                        break
+                    if price_end > line_start + 1:
+                        after_price = _skip_line_break(text, price_end, final)
+                        if after_price is _INCOMPLETE:
+                            pos = image_start
+                            break
+                        if after_price >= 0:
+                            price_str = text[line_start + 1:price_end]
+                            line_start = after_price
+
+                self._awaiting_link = True
+                self._price_str = price_str
+                pos = line_start
+                at_line_start = True
+
+            # 3. 行頭から始まる最初の商品リンク `[商品名](URL)` を探す
+            if self._mid_line:
+                newline = text.find("\n", pos)
+                if newline < 0:
+                    pos = len(text)
+                    break
+                pos = newline + 1
+                self._mid_line = False
+            candidate = _LINE_START_BRACKET.search(text, pos)
+            if candidate is not None:
+                self._find_unit_price(text, pos, candidate.start())
+            if candidate is None:
+                if final:
+                    # これ以降に商品リンクはないので、後続の画像も商品にはならない
+                    self._finished = True
+                    pos = len(text)
+                    break
+                # 行頭の'['がないので残りはすべて捨てる。捨てた最後の行が途中なら
+                # 次のデータの先頭は行頭ではない。ただし短い行の途中は単価の行の
+                # 前半かもしれないので、次のデータと合わせて読み直す
+                newline = text.rfind("\n", pos)
+                if newline >= 0:
+                    self._find_unit_price(text, pos, newline + 1)
+                    line_start = newline + 1
+                else:
+                    line_start = pos if at_line_start else -1
+                if line_start >= 0 and len(text) - line_start <= _MAX_PENDING_LINE:
+                    pos = line_start
+                    break
+                self._mid_line = line_start != len(text)
+                pos = len(text)
+                break
+            link = _bracket_link(text, candidate.start(), next_bracket, next_paren, final)
+            if link is _INCOMPLETE:
+                pos = candidate.start()
+                break
+            if link is None:
+                # 次の候補は必ず改行の後にあるので、行の途中から検索しても問題ない
+                pos = candidate.start() + 1
+                at_line_start = False
+                continue
+
+            name_start, name_end, url_start, url_end = link
+            product = _make_product(text[name_start:name_end], self._price_str, text[url_start:url_end], self._unit)
+            if product:
+                products.append(product)
+            self._awaiting_link = False
+            self._price_str = None
+            self._unit = None
+            pos = url_end + 1
+
+        self._buffer = text[pos:]
+        return products
+
+    def _find_unit_price(self, text, start, end):
+        """text[start:end] (行単位) の最初の表示単価を、まだ見つけていなければ覚える。"""
+        if self._unit is None:
+            match = _UNIT_PRICE_LINE.search(text, start, end)
+            if match:
+                self._unit = (match.group(1), int(match.group(2).replace(',', '')))
+
+
+def iter_costco_markdown(pieces):
+    """Markdownの断片を順に受け取り、商品を1件ずつ返すジェネレーター。"""
+    stream = CostcoMarkdownStream()
+    for piece in pieces:
+        yield from stream.feed(piece)
+    yield from stream.close()
+
+
+def _read_blocks(path, block_size):
+    with open(path, 'r', encoding='utf-8') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return
+            yield block
+
+
+def iter_costco_markdown_file(path, block_size=64 * 1024):
+    """Markdownファイルを少しずつ読み込みながら商品を返す。"""
+    return iter_costco_markdown(_read_blocks(path, block_size))
+
+
+def _iter_chunk_texts(directory, block_size):
+    paths = sorted(
+        (name for name in os.listdir(directory) if re.fullmatch(r'chunk_\d+\.md', name)),
+        key=lambda name: int(name[6:-3])
     )
+    for i, name in enumerate(paths):
+        # split_markdownは行区切りの改行を落として分割しているので、チャンク間に改行を戻す
+        if i > 0:
+            yield '\n'
+        yield from _read_blocks(os.path.join(directory, name), block_size)
+
+
+def iter_costco_markdown_chunks(directory, block_size=64 * 1024):
+    """split_markdownが出力した chunk_1.md, chunk_2.md, ... を番号順に読みながら商品を返す。"""
+    return iter_costco_markdown(_iter_chunk_texts(directory, block_size))
+
 
-    for match in product_pattern.finditer(markdown_content):
+def _decode_json_string_pieces(blocks):
+    """JSON文字列リテラルの中身 (開始の'"'の直後から) を少しずつデコードして返す。"""
+    pending = ""
+    for block in blocks:
+        pending += block
+        # エスケープされていない'"'で文字列が終わる
+        end = -1
+        search_from = 0
+        while True:
+            quote = pending.find('"', search_from)
+            if quote < 0:
+                break
+            backslash_start = quote
+            while backslash_start > 0 and pending[backslash_start - 1] == '\\':
+                backslash_start -= 1
+            if (quote - backslash_start) % 2 == 0:
+                end = quote
+                break
+            search_from = quote + 1
+        if end >= 0:
+            yield json.loads('"' + pending[:end] + '"')
+            return
+        # エスケープ列 (サロゲートペアの\uXXXX\uXXXXを含む) の途中で切らないよう、
+        # 末尾12文字にかかるバックスラッシュの連続より前までをデコードする。
+        # その直前が上位サロゲートなら、下位と分けないようにそれも残す
+        cut = len(pending)
+        backslash = pending.find('\\', max(0, len(pending) - 12))
+        if backslash >= 0:
+            cut = backslash
+            while cut > 0 and pending[cut - 1] == '\\':
+                cut -= 1
+            if cut >= 6 and _JSON_HIGH_SURROGATE.fullmatch(pending, cut - 6, cut):
+                cut -= 6
+                while cut > 0 and pending[cut - 1] == '\\':
+                    cut -= 1
+        if cut > 0:
+            yield json.loads('"' + pending[:cut] + '"')
+            pending = pending[cut:]
+    raise ValueError("unterminated JSON string")
+
+
+def _iter_firecrawl_markdown(blocks):
+    """トップレベルのオブジェクトの"markdown"の値だけを少しずつデコードして返す。
+
+    文字列と{}・[]の入れ子を追い、深さ1のキーだけを見るので、metadataの中などに
+    ある"markdown"キーや、値としての"markdown"は使わない。読みかけの文字列は
+    キーの候補 (深さ1で"markdown"以下の長さ) のときだけ保持する。
+    """
+    blocks = iter(blocks)
+    text = ""
+    pos = 0
+    depth = 0
+    string_start = None  # 読みかけの文字列の開始位置。キーの候補でなければ-1
+    for block in blocks:
+        text += block
+        while True:
+            if string_start is None:
+                token = _JSON_TOKEN.search(text, pos)
+                if token is None:
+                    pos = len(text)
+                    break
+                pos = token.end()
+                if token.group() in "{[":
+                    depth += 1
+                    continue
+                if token.group() in "}]":
+                    depth -= 1
+                    continue
+                string_start = token.start() if depth == 1 else -1
+            # エスケープされていない'"'で文字列が終わる (末尾のバックスラッシュは続きと合わせて読む)
+            end = _JSON_STRING_BODY.match(text, pos).end()
+            if end == len(text) or text[end] != '"':
+                pos = end
+                break
+            pos = end + 1
+            if string_start >= 0 and text[string_start:pos] == _FIRECRAWL_MARKDOWN_KEY:
+                value = _JSON_STRING_VALUE.match(text, pos)
+                if value:
+                    yield from _decode_json_string_pieces(_prepend(text[value.end():], blocks))
+                    return
+                if _JSON_COLON_PREFIX.match(text, pos).end() == len(text):
+                    # キーかどうか (続く':'と'"') は次のデータを見ないと分からない
+                    pos = string_start
+                    string_start = None
+                    break
+            string_start = None
+        if string_start is not None and string_start >= 0 and pos - string_start > len(_FIRECRAWL_MARKDOWN_KEY):
+            string_start = -1
+        keep = string_start if string_start is not None and string_start >= 0 else pos
+        text = text[keep:]
+        pos -= keep
+        if string_start is not None and string_start >= 0:
+            string_start = 0
+
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
+
+
+def iter_costco_markdown_firecrawl(path, block_size=64 * 1024):
+    """Firecrawlの結果JSONから"markdown"の値だけを少しずつデコードしながら商品を返す。
+
+    json.loadでファイル全体とMarkdown文字列をメモリに載せずに済む。
+    """
+    return iter_costco_markdown(_iter_firecrawl_markdown(_read_blocks(path, block_size)))
+
+
+def parse_costco_markdown(markdown_content):
+    with stage("costco_parse"):
+        return list(iter_costco_markdown([markdown_content]))
+
+
+def _parse_costco_markdown_regex(markdown_content):
+    """旧実装 (正規表現版)。新しいパーサーとの照合用。"""
+    products = []
+    for match in _LEGACY_PRODUCT_PATTERN.finditer(markdown_content):
         product_name = match.group('product_name').strip()
         price_str = match.group('price')
         price = int(price_str.replace(',', '')) if price_str else None
@@ -26,3 +427,12 @@ def parse_costco_markdown(markdown_content):
             })
     return products
 
+
+if __name__ == '__main__':
+    # 動作確認: markdown_chunks/ の商品を読み込んで表示する。
+    # テストは tests/test_costco_parser.py、速度の計測は benchmark.py (parser, malformed) を参照
+    chunk_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'markdown_chunks')
+    products = list(iter_costco_markdown_chunks(chunk_dir))
+    for product in products[:5]:
+        print(product)
+    print(f"[INFO] {len(products)} 件の商品を読み込みました。")
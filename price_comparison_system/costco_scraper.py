@@ -1,86 +1,182 @@
-
+import math
+import os
 import requests
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor
 
-def scrape_costco_products(query, pages=1, items_per_page=24, delay=1.5):
-    all_items = []
-    API_URL = "https://search.costco.com/api/apps/www_costco_com/query/www_costco_com_navigation"
-    headers = {
-        "Host": "search.costco.com",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:140.0) Gecko/20100101 Firefox/140.0",
-        "Accept": "application/json",
-        "Accept-Language": "en-US,en;q=0.5",
-        "Accept-Encoding": "gzip, deflate, br, zstd",
-        "Referer": "https://www.costco.com/",
-        "Content-Type": "application/json",
-        "Origin": "https://www.costco.com",
-        "DNT": "1",
-        "Sec-GPC": "1",
-        "Connection": "keep-alive",
-        "Sec-Fetch-Dest": "empty",
-        "Sec-Fetch-Mode": "cors",
-        "Sec-Fetch-Site": "same-site",
-        "Pragma": "no-cache",
-        "Cache-Control": "no-cache"
-    }
+try:
+    from .http_session import get_session
+    from .rate_limiter import TokenBucket, backoff_delay, parse_retry_after
+    from .metrics import stage, count
+    from .product_records import CostcoOnlineProduct, json_default
+except ImportError:
+    from http_session import get_session
+    from rate_limiter import TokenBucket, backoff_delay, parse_retry_after
+    from metrics import stage, count
+    from product_records import CostcoOnlineProduct, json_default
 
-    for page in range(pages):
-        start = page * items_per_page
-        params = {
-            "expoption": "def",
-            "q": query,
-            "locale": "en-US",
-            "start": start,
-            "expand": "false",
-            "userLocation": "WA",
-            "loc": "*",
-            "whloc": "1-wh",
-            "rows": items_per_page,
-            "chdcategory": "true",
-            "chdheader": "true"
-        }
+API_URL = os.getenv("COSTCO_API_URL", "https://search.costco.com/api/apps/www_costco_com/query/www_costco_com_navigation")
+HEADERS = {
+    "Host": "search.costco.com",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:140.0) Gecko/20100101 Firefox/140.0",
+    "Accept": "application/json",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Referer": "https://www.costco.com/",
+    "Content-Type": "application/json",
+    "Origin": "https://www.costco.com",
+    "DNT": "1",
+    "Sec-GPC": "1",
+    "Connection": "keep-alive",
+    "Sec-Fetch-Dest": "empty",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Site": "same-site",
+    "Pragma": "no-cache",
+    "Cache-Control": "no-cache"
+}
 
-        print(f"[INFO] Scraping Costco page {page + 1} (start={start})...")
+# Default request rate against search.costco.com (requests/second) and burst size
+COSTCO_REQUESTS_PER_SECOND = float(os.getenv("COSTCO_REQUESTS_PER_SECOND", "2"))
+COSTCO_BURST = int(os.getenv("COSTCO_BURST", "2"))
+# Retries for 429 / 5xx responses before a page is given up
+MAX_RETRIES = 3
 
-        try:
-            response = requests.get(API_URL, headers=headers, params=params)
-            if response.status_code != 200:
-                print(f"[ERROR] Costco page {page + 1} failed with status {response.status_code}")
-                break
-
-            data = response.json()
-            products = data.get("response", {}).get("docs", [])
-
-            if not products:
-                print(f"[WARNING] No products found on Costco page {page + 1}")
-                break
-
-            for product in products:
-                all_items.append({
-                    "source": "Costco Online",
-                    "product_name": product.get("item_product_name"),
-                    "price": product.get("item_location_pricing_salePrice") or product.get("item_location_pricing_listPrice"),
-                    "item_number": product.get("item_number"),
-                    "member_only": product.get("item_member_only"),
-                    "stock_status": product.get("item_location_stockStatus"),
-                    "url": f"https://www.costco.com/product/{product.get('item_number')}" # Construct URL if not directly available
-                })
-            time.sleep(delay)
 
+def _fetch_page(query, page, items_per_page, bucket, max_retries):
+    """Fetch one result page. Returns the parsed JSON, or None if the page failed."""
+    start = page * items_per_page
+    params = {
+        "expoption": "def",
+        "q": query,
+        "locale": "en-US",
+        "start": start,
+        "expand": "false",
+        "userLocation": "WA",
+        "loc": "*",
+        "whloc": "1-wh",
+        "rows": items_per_page,
+        "chdcategory": "true",
+        "chdheader": "true"
+    }
+
+    for attempt in range(max_retries + 1):
+        bucket.acquire()
+        print(f"[INFO] Scraping Costco page {page + 1} (start={start})...")
+        try:
+            with stage("costco_fetch"):
+                response = get_session().get(API_URL, headers=HEADERS, params=params)
         except requests.exceptions.RequestException as e:
             print(f"[ERROR] Request failed: {e}")
-            break
+            return None
+        count("costco.requests")
+        count("costco.bytes", len(response.content))
+
+        if response.status_code == 200:
+            bucket.recover()
+            try:
+                with stage("costco_parse"):
+                    return response.json()
+            except ValueError as e:
+                # An HTML error page or truncated body instead of JSON
+                print(f"[ERROR] Costco page {page + 1} returned invalid JSON: {e}")
+                return None
+
+        if (response.status_code == 429 or response.status_code >= 500) and attempt < max_retries:
+            # Adaptive backoff: slow the whole fetcher down, then retry this page
+            bucket.throttle()
+            count("costco.retries")
+            delay = backoff_delay(attempt, retry_after=parse_retry_after(response.headers.get("Retry-After")))
+            print(f"[WARNING] Costco page {page + 1} returned {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
 
+        print(f"[ERROR] Costco page {page + 1} failed with status {response.status_code}")
+        return None
+    return None
+
+
+def _to_items(products):
+    # Slotted records with interned source/stock status instead of one dict per product
+    return [CostcoOnlineProduct(
+        source="Costco Online",
+        product_name=product.get("item_product_name"),
+        price=product.get("item_location_pricing_salePrice") or product.get("item_location_pricing_listPrice"),
+        item_number=product.get("item_number"),
+        member_only=product.get("item_member_only"),
+        stock_status=product.get("item_location_stockStatus"),
+        url=f"https://www.costco.com/product/{product.get('item_number')}" # Construct URL if not directly available
+    ) for product in products]
+
+
+def scrape_costco_products(query, pages=1, items_per_page=24, delay=None, max_workers=4,
+                           requests_per_second=None, burst=None, max_retries=MAX_RETRIES):
+    """Scrape up to `pages` result pages, fetching them concurrently under a token-bucket rate limit.
+
+    The first page is fetched alone to read numFound, which decides how many
+    further pages exist. Those are then fetched in parallel, paced by the
+    bucket (requests_per_second, or 1/delay for the old fixed-delay callers).
+    Results keep page order and, as before, stop at the first failed or
+    empty page.
+    """
+    if requests_per_second is None:
+        requests_per_second = 1.0 / delay if delay else COSTCO_REQUESTS_PER_SECOND
+    bucket = TokenBucket(requests_per_second, burst or COSTCO_BURST)
+
+    if pages <= 0:
+        return []
+
+    first = _fetch_page(query, 0, items_per_page, bucket, max_retries)
+    if first is None:
+        return []
+    response_data = first.get("response", {})
+    first_docs = response_data.get("docs", [])
+    if not first_docs:
+        print("[WARNING] No products found on Costco page 1")
+        return []
+
+    # Plan the fan-out from numFound instead of probing page by page
+    num_found = response_data.get("numFound")
+    if num_found is not None:
+        page_count = min(pages, math.ceil(num_found / items_per_page))
+    elif len(first_docs) < items_per_page:
+        page_count = 1
+    else:
+        page_count = pages
+
+    page_docs = [first_docs]
+    if page_count > 1:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = [
+                executor.submit(_fetch_page, query, page, items_per_page, bucket, max_retries)
+                for page in range(1, page_count)
+            ]
+            for page, future in enumerate(futures, start=1):
+                data = future.result()
+                docs = data.get("response", {}).get("docs", []) if data else []
+                if not docs:
+                    if data is not None:
+                        print(f"[WARNING] No products found on Costco page {page + 1}")
+                    # Result set exhausted (or page failed): later pages are not needed
+                    for pending in futures[page:]:
+                        pending.cancel()
+                    break
+                page_docs.append(docs)
+                if len(docs) < items_per_page:
+                    for pending in futures[page:]:
+                        pending.cancel()
+                    break
+
+    all_items = []
+    for docs in page_docs:
+        all_items.extend(_to_items(docs))
     return all_items
 
 if __name__ == "__main__":
     # Example usage
     search_query = "Apple AirPods Pro"
     costco_products = scrape_costco_products(search_query, pages=1)
-    print(json.dumps(costco_products, indent=2, ensure_ascii=False))
+    print(json.dumps(costco_products, indent=2, ensure_ascii=False, default=json_default))
 
     with open("costco_products.json", "w", encoding="utf-8") as f:
-        json.dump(costco_products, f, indent=2, ensure_ascii=False)
+        json.dump(costco_products, f, indent=2, ensure_ascii=False, default=json_default)
     print(f"Costco products saved to costco_products.json")
-
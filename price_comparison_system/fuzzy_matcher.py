@@ -0,0 +1,202 @@
+from array import array
+import heapq
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict, namedtuple
+
+# 文字n-gramの長さ。日本語の商品名は2文字でも十分に識別できる
+FUZZY_NGRAM_SIZE = 2
+# 全商品のこの割合より多くに出現するn-gramは候補の絞り込みに使わない (スコアへの寄与も小さい)
+MAX_DF_RATIO = 0.05
+# 数量 (例: 5箱 x 12パック) がまったく一致しない候補の信頼度に掛ける係数。
+# 一部だけ一致する場合は一致の割合に応じてこの値と1の間になる
+QUANTITY_MISMATCH_PENALTY = 0.5
+# これ未満の信頼度はマッチとみなさない
+DEFAULT_MIN_CONFIDENCE = 0.3
+
+# 商品名の正規化済みシグネチャ。textはn-gram用の文字列、quantitiesは数量の集合
+Signature = namedtuple("Signature", ["text", "quantities"])
+
+_UNIT_ALIASES = [
+    ("ミリリットル", "ml"), ("リットル", "l"), ("キログラム", "kg"), ("キロ", "kg"), ("グラム", "g"),
+    ("センチ", "cm"), ("メートル", "m"), ("×", "x"), ("✕", "x"), ("*", "x"),
+]
+_SEPARATORS = re.compile(r"[\s\-_/・,、。()\[\]{}「」『』【】<>\"'!?:;|+]+")
+# 数字と単位の間の空白を詰める (180 枚 -> 180枚)
+_NUMBER_UNIT_SPACE = re.compile(r"(\d)\s+(?=[^\sx\d])")
+# 数量: 数字 + 単位/助数詞 (5箱, 12パック, 180枚, 1.5kg, 30ロール)
+_QUANTITY = re.compile(r"(\d+(?:\.\d+)?)(ml|kg|g|l|cm|m|[^\sx\d\.]{1,3}?)(?=[\sx]|$|\d)")
+
+
+def _to_katakana(text):
+    # ひらがな (U+3041..U+3096) をカタカナに揃える
+    return "".join(chr(ord(c) + 0x60) if "ぁ" <= c <= "ゖ" else c for c in text)
+
+
+def make_signature(name):
+    """商品名をNFKC・小文字・カタカナ・単位表記で正規化したシグネチャにする。"""
+    text = unicodedata.normalize("NFKC", name or "").lower()
+    text = _to_katakana(text)
+    for alias, unit in _UNIT_ALIASES:
+        text = text.replace(alias, unit)
+    text = _NUMBER_UNIT_SPACE.sub(r"\1", text)
+    text = " ".join(_SEPARATORS.split(text)).strip()
+    quantities = frozenset(number.rstrip("0").rstrip(".") + unit if "." in number else number + unit
+                           for number, unit in _QUANTITY.findall(text))
+    return Signature(text, quantities)
+
+
+def _ngrams(text, n):
+    # 語の境界をまたぐn-gramも含める (空白は1文字として扱う)
+    padded = f" {text} "
+    return Counter(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+def _weights(counts, idf):
+    """(1 + log tf) * idf をL2正規化した重みの辞書。"""
+    weights = {}
+    for gram, tf in counts.items():
+        gram_idf = idf.get(gram)
+        if gram_idf:
+            weights[gram] = (1.0 + math.log(tf)) * gram_idf
+    norm = math.sqrt(sum(w * w for w in weights.values()))
+    if norm:
+        for gram in weights:
+            weights[gram] /= norm
+    return weights
+
+
+class FuzzyProductIndex:
+    """Amazon商品名の文字n-gram TF-IDF転置インデックス。
+
+    商品名は構築時に一度だけシグネチャへ正規化する。検索ではクエリの珍しい
+    n-gramのポスティングだけを辿って候補を集め、上位の候補だけ完全なコサイン
+    類似度で採点し直すので、全件との総当たりはしない。数量が食い違う候補は
+    信頼度を下げる。
+    """
+
+    def __init__(self, names, ngram_size=FUZZY_NGRAM_SIZE, max_df_ratio=MAX_DF_RATIO):
+        self.ngram_size = ngram_size
+        self.signatures = [make_signature(name) for name in names]
+        grams = [_ngrams(signature.text, ngram_size) for signature in self.signatures]
+
+        document_frequency = Counter()
+        for counts in grams:
+            document_frequency.update(counts.keys())
+        total = len(self.signatures)
+        self._idf = {gram: math.log((1 + total) / (1 + df)) + 1.0 for gram, df in document_frequency.items()}
+        # 出現頻度の高すぎるn-gramは候補の絞り込みに使わない
+        self._max_df = max(1, int(total * max_df_ratio))
+        self._document_frequency = document_frequency
+
+        # n-gram -> (商品IDの配列, 重みの配列)。タプルのリストよりずっと小さい
+        self._postings = {gram: (array("i"), array("f")) for gram in document_frequency}
+        for product_id, counts in enumerate(grams):
+            for gram, weight in _weights(counts, self._idf).items():
+                ids, weights = self._postings[gram]
+                ids.append(product_id)
+                weights.append(weight)
+        self._doc_weights = {}  # 再採点した商品の重みベクトル (遅延計算)
+
+    @classmethod
+    def from_products(cls, products, key="product_name", **options):
+        if hasattr(products, "column"):
+            # ProductTableなら列をそのまま使う
+            return cls(products.column(key), **options)
+        return cls([product.get(key) for product in products], **options)
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def _document_weights(self, product_id):
+        weights = self._doc_weights.get(product_id)
+        if weights is None:
+            text_grams = _ngrams(self.signatures[product_id].text, self.ngram_size)
+            weights = self._doc_weights[product_id] = _weights(text_grams, self._idf)
+        return weights
+
+    def search(self, query, top_k=5, min_confidence=0.0):
+        """queryに似た商品を [(商品ID, 信頼度), ...] の信頼度の高い順で最大top_k件返す。"""
+        signature = query if isinstance(query, Signature) else make_signature(query)
+        query_weights = _weights(_ngrams(signature.text, self.ngram_size), self._idf)
+        if not query_weights:
+            return []
+
+        # 珍しいn-gramから順にポスティングを辿り、部分スコアで候補を集める。
+        # ありふれたn-gramしかないクエリでも、最も珍しいものだけは必ず使う
+        scores = defaultdict(float)
+        for gram in sorted(query_weights, key=self._document_frequency.__getitem__):
+            if scores and self._document_frequency[gram] > self._max_df:
+                break
+            weight = query_weights[gram]
+            ids, weights = self._postings[gram]
+            for product_id, doc_weight in zip(ids, weights):
+                scores[product_id] += weight * doc_weight
+
+        # 部分スコア上位の候補だけを完全なコサイン類似度で採点し直す
+        shortlist = heapq.nlargest(max(top_k * 10, 50), scores, key=scores.__getitem__)
+        results = []
+        for product_id in shortlist:
+            doc_weights = self._document_weights(product_id)
+            confidence = min(1.0, sum(w * doc_weights.get(g, 0.0) for g, w in query_weights.items()))
+            other = self.signatures[product_id].quantities
+            if signature.quantities and other:
+                overlap = len(signature.quantities & other) / len(signature.quantities | other)
+                confidence *= QUANTITY_MISMATCH_PENALTY + (1 - QUANTITY_MISMATCH_PENALTY) * overlap
+            if confidence >= min_confidence:
+                results.append((product_id, round(confidence, 4)))
+        return heapq.nlargest(top_k, results, key=lambda item: item[1])
+
+    def best_match(self, query, min_confidence=DEFAULT_MIN_CONFIDENCE):
+        """最も似た商品の (商品ID, 信頼度)。min_confidence以上の候補がなければNone。"""
+        results = self.search(query, top_k=1, min_confidence=min_confidence)
+        return results[0] if results else None
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    amazon_names = [
+        "エルモア ティッシュペーパー 400枚(200組) 5箱×12パック 日本製",
+        "クリネックス ティシュー 180組 10箱入",
+        "カークランド シグネチャー バスティッシュ トイレットペーパー 2枚重ね 30ロール",
+        "ハホニコ ヘアタオル ターバン ブラシ セット",
+        "クレシア ハンドタオル ソフト 200枚 16パック",
+        "エルモア ティッシュ 5箱 x 3パック",
+    ]
+    index = FuzzyProductIndex(amazon_names)
+    queries = [
+        "エルモア ティッシュ 400枚 5箱 x 12パック",
+        "クリネックスティッシュー 180枚 x 10箱",
+        "カークランドシグネチャートイレットペーパー ２枚重ね 30ロール",
+        "ﾊﾎﾆｺ タオル1枚, ターバン1枚, カラミーブラシ セット",
+    ]
+    for query in queries:
+        print(query)
+        for product_id, confidence in index.search(query, top_k=2):
+            print(f"    {confidence:.3f}  {amazon_names[product_id]}")
+
+    # 10万件の合成カタログでの構築時間と検索時間
+    random.seed(0)
+    kana = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン"
+    brands = ["".join(random.choice(kana) for _ in range(random.randint(3, 6))) for _ in range(2000)]
+    words = ["ティッシュ", "ペーパー", "カークランド", "シグネチャー", "トイレット", "ロール", "ハンドタオル", "クリネックス",
+             "エルモア", "コーヒー", "オーガニック", "ナッツ", "ミックス", "洗剤", "詰め替え", "tissue", "coffee", "organic"]
+    units = ["枚", "箱", "パック", "ロール", "g", "kg", "ml", "個"]
+
+    def make_name():
+        name = " ".join([random.choice(brands)] + random.sample(words, random.randint(2, 4)))
+        return f"{name} {random.randint(1, 500)}{random.choice(units)} x {random.randint(1, 24)}{random.choice(units)}"
+
+    for size in (10_000, 100_000):
+        names = [make_name() for _ in range(size)]
+        start = time.perf_counter()
+        big_index = FuzzyProductIndex(names)
+        build = time.perf_counter() - start
+        sample = random.sample(names, 200)
+        start = time.perf_counter()
+        hits = sum(1 for name in sample if big_index.best_match(name) is not None)
+        per_query = (time.perf_counter() - start) / len(sample)
+        print(f"{size:>7} titles: build {build:.1f}s, top-k search {per_query * 1e3:.2f}ms/query, {hits}/{len(sample)} self-matches")
@@ -0,0 +1,71 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+# --- 接続設定 --- #
+# (接続タイムアウト, 読み取りタイムアウト) 秒。呼び出し側でtimeoutを渡した場合はそちらを優先する
+DEFAULT_TIMEOUT = (
+    float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05")),
+    float(os.getenv("HTTP_READ_TIMEOUT", "10")),
+)
+# 個別設定のないホストのコネクションプールサイズ
+DEFAULT_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+# ホストごとのコネクションプールサイズ
+HOST_POOL_SIZES = {
+    "api.amazon.com": 2,  # LWAトークン更新のみ
+    "search.costco.com": 8,
+    "www.costco.co.jp": 8,
+}
+
+# --- グローバル変数 (ウォームスタート間で共有するセッション) --- #
+_session = None
+_session_lock = threading.Lock()
+
+
+class _PooledSession(requests.Session):
+    """timeout未指定のリクエストにDEFAULT_TIMEOUTを適用するセッション。"""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+
+def _mount_host(session, host, pool_size):
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount(f"https://{host}/", adapter)
+    session.mount(f"http://{host}/", adapter)
+
+
+def get_session():
+    """プロセス内で共有するkeep-aliveセッションを返す。
+
+    初回呼び出し時に作成し、以降はサーバーレス関数のウォームスタートを
+    含めて同じコネクションプールを再利用する。
+    """
+    global _session
+
+    if _session is not None:
+        return _session
+
+    with _session_lock:
+        if _session is None:
+            session = _PooledSession()
+            # デコード可能な圧縮形式だけを要求する (brotli等がインストールされていればbrも含まれる)
+            session.headers.update(make_headers(keep_alive=True, accept_encoding=True))
+            default_adapter = HTTPAdapter(pool_connections=DEFAULT_POOL_SIZE, pool_maxsize=DEFAULT_POOL_SIZE)
+            session.mount("https://", default_adapter)
+            session.mount("http://", default_adapter)
+            for host, pool_size in HOST_POOL_SIZES.items():
+                _mount_host(session, host, pool_size)
+            _session = session
+    return _session
+
+
+def register_host(host, pool_size):
+    """ホスト専用のコネクションプールサイズを設定する。"""
+    with _session_lock:
+        HOST_POOL_SIZES[host] = pool_size
+        if _session is not None:
+            _mount_host(_session, host, pool_size)
@@ -0,0 +1,269 @@
+import json
+
+try:
+    from .price_comparator import DEFAULT_THRESHOLD_RULES, matches_threshold_rules
+    from .price_history import COSTCO, AMAZON, DEFAULT_MAX_AGE, costco_product_key, amazon_product_key
+    from .product_matcher import ProductIndex
+except ImportError:
+    from price_comparator import DEFAULT_THRESHOLD_RULES, matches_threshold_rules
+    from price_history import COSTCO, AMAZON, DEFAULT_MAX_AGE, costco_product_key, amazon_product_key
+    from product_matcher import ProductIndex
+
+
+def _costco_key(product):
+    return costco_product_key(product) or product.get("url") or product.get("product_name")
+
+
+def _amazon_key(product):
+    return amazon_product_key(product) or product.get("url") or product.get("product_name")
+
+
+class IncrementalComparator:
+    """マッチ済みのコストコ↔Amazonペアを保持し、価格が変わったペアだけを再計算する比較エンジン。
+
+    マッチングは商品の追加時に、追加した商品の分だけ商品名のインデックスで行う。
+    observe()で価格の観測を受け取ると、その商品を含むペアがダーティになり、
+    recompute()でダーティなペアだけの価格差と抽出ルールを評価し直して、
+    前回との差分 (entered/left/changed) を返す。
+    結果の内容と順序はcompare_pricesと同じ。
+    """
+
+    def __init__(self, costco_products, amazon_products, rules=DEFAULT_THRESHOLD_RULES, require_all=False):
+        self.rules = rules
+        self.require_all = require_all
+        self._costco = {}  # キー -> 商品
+        self._amazon = {}
+        self._costco_order = []  # コストコ商品の追加順 (_costco_indexの商品ID順)
+        self._amazon_order = []  # Amazon商品の追加順 (compare_pricesのマッチ順)
+        # 商品名のインデックス。商品の追加時はそのまま追記し、作り直さない
+        self._costco_index = ProductIndex([])
+        self._amazon_index = ProductIndex([])
+        self._pairs_by_costco = {}  # コストコキー -> [Amazonキー, ...]
+        self._pairs_by_amazon = {}  # Amazonキー -> [コストコキー, ...]
+        self._results = {}  # (コストコキー, Amazonキー) -> 抽出ルールを満たす比較結果
+        self._dirty = set()
+
+        self.add_products(AMAZON, amazon_products)
+        self.add_products(COSTCO, costco_products)
+        self.recompute()
+
+    def add_products(self, source, products):
+        """商品を追加してマッチングし、新しいペアをダーティにする。既存の商品は価格の観測として扱う。"""
+        new_products = []
+        for product in products:
+            key = _costco_key(product) if source == COSTCO else _amazon_key(product)
+            if not key:
+                continue
+            catalog = self._costco if source == COSTCO else self._amazon
+            if key in catalog:
+                self.observe(source, key, product.get("price"))
+                continue
+            catalog[key] = dict(product)
+            new_products.append(key)
+
+        if source == COSTCO:
+            # 新しいコストコ商品は、その商品名を含むAmazon商品をインデックスで探す
+            for costco_key in new_products:
+                costco_name = self._costco[costco_key].get("product_name")
+                self._costco_order.append(costco_key)
+                self._costco_index.add(costco_name)
+                matched = [self._amazon_order[i] for i in self._amazon_index.find_substring_matches(costco_name)] if costco_name else []
+                self._pairs_by_costco[costco_key] = matched
+                for amazon_key in matched:
+                    self._pairs_by_amazon[amazon_key].append(costco_key)
+                self._dirty.update((costco_key, amazon_key) for amazon_key in matched)
+        else:
+            # 新しいAmazon商品は、その商品名に含まれるコストコ商品名をインデックスで探す
+            # (既存のコストコ商品を全件走査しない)
+            for amazon_key in new_products:
+                amazon_name = self._amazon[amazon_key].get("product_name")
+                self._amazon_order.append(amazon_key)
+                self._amazon_index.add(amazon_name)
+                matched = [self._costco_order[i] for i in self._costco_index.find_names_within(amazon_name)] if self._costco_order else []
+                for costco_key in matched:
+                    self._pairs_by_costco[costco_key].append(amazon_key)
+                self._pairs_by_amazon[amazon_key] = matched
+                self._dirty.update((costco_key, amazon_key) for costco_key in matched)
+
+    def observe(self, source, key, price):
+        """商品の価格の観測を1件受け取る。価格が変わっていればその商品のペアをダーティにする。"""
+        catalog = self._costco if source == COSTCO else self._amazon
+        product = catalog.get(key)
+        if product is None or product.get("price") == price:
+            return
+        product["price"] = price
+        if source == COSTCO:
+            self._dirty.update((key, amazon_key) for amazon_key in self._pairs_by_costco[key])
+        else:
+            self._dirty.update((costco_key, key) for costco_key in self._pairs_by_amazon[key])
+
+    def observe_products(self, source, products):
+        key_of = _costco_key if source == COSTCO else _amazon_key
+        for product in products:
+            self.observe(source, key_of(product), product.get("price"))
+
+    def observe_history(self, store, since):
+        """価格履歴DBでsince以降に観測された価格を取り込む。"""
+        for source in (COSTCO, AMAZON):
+            for key, price in store.observations_since(source, since):
+                self.observe(source, key, price)
+
+    def refresh_from_history(self, store, source, fetch, max_age=DEFAULT_MAX_AGE):
+        """価格履歴DBで期限切れの商品だけをfetchで取り直し、最新の価格を取り込んで再計算する。
+
+        fetchはPriceHistoryStore.refresh_staleと同じ (商品キーのリスト → 商品キー → 商品情報)。
+        期限内の商品はDBの価格を使う。recompute()と同じ差分を返す。
+        """
+        key_of = costco_product_key if source == COSTCO else amazon_product_key
+        catalog = self._costco if source == COSTCO else self._amazon
+        # 価格履歴DBのキーを持つ商品だけが対象 (URLや商品名で代用したキーは除く)
+        keys = [key for key, product in catalog.items() if key_of(product) == key]
+        if keys:
+            for key, latest in store.refresh_stale(source, keys, fetch, max_age).items():
+                self.observe(source, key, latest["price"])
+        return self.recompute()
+
+    @property
+    def dirty_count(self):
+        return len(self._dirty)
+
+    def _compare_pair(self, costco_key, amazon_key):
+        # compare_pricesの1ペア分と同じ計算
+        costco_product = self._costco[costco_key]
+        amazon_product = self._amazon[amazon_key]
+        costco_price = costco_product.get("price")
+        amazon_price = amazon_product.get("price")
+        if costco_price is None or amazon_price is None or amazon_price == 0:
+            return None
+
+        price_difference = costco_price - amazon_price
+        percentage_difference = (price_difference / amazon_price) * 100
+        if not matches_threshold_rules(percentage_difference, self.rules, self.require_all):
+            return None
+        return {
+            "costco_product_name": costco_product.get("product_name"),
+            "costco_price": costco_price,
+            "costco_url": costco_product.get("url"),
+            "amazon_product_name": amazon_product.get("product_name"),
+            "amazon_price": amazon_price,
+            "amazon_url": amazon_product.get("url"),
+            "price_difference": price_difference,
+            "percentage_difference": round(percentage_difference, 2)
+        }
+
+    def recompute(self):
+        """ダーティなペアだけを再評価し、{"entered", "left", "changed"} の差分を返す。
+
+        entered: 新たに抽出ルールを満たした結果、left: 満たさなくなった (前回の) 結果、
+        changed: 引き続き満たしているが価格や価格差が変わった結果。
+        """
+        delta = {"entered": [], "left": [], "changed": []}
+        dirty, self._dirty = self._dirty, set()
+        for pair in dirty:
+            previous = self._results.get(pair)
+            current = self._compare_pair(*pair)
+            if current is None:
+                if previous is not None:
+                    del self._results[pair]
+                    delta["left"].append(previous)
+            elif previous is None:
+                self._results[pair] = current
+                delta["entered"].append(current)
+            elif current != previous:
+                self._results[pair] = current
+                delta["changed"].append(current)
+        return delta
+
+    def results(self):
+        """現在抽出ルールを満たしている結果をcompare_pricesと同じ順序で返す。"""
+        results = []
+        for costco_key, amazon_keys in self._pairs_by_costco.items():
+            for amazon_key in amazon_keys:
+                result = self._results.get((costco_key, amazon_key))
+                if result is not None:
+                    results.append(result)
+        return results
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    try:
+        from .price_comparator import compare_prices
+    except ImportError:
+        from price_comparator import compare_prices
+
+    random.seed(0)
+    product_count = 10_000
+    change_count = 50
+    costco_products = [
+        {"product_name": f"商品{i:05d} セット", "price": random.randint(500, 20000), "url": f"https://www.costco.co.jp/p/{i}"}
+        for i in range(product_count)
+    ]
+    amazon_products = [
+        {"product_name": f"{p['product_name']} (Amazon)", "price": round(p["price"] * random.uniform(0.6, 1.5)), "asin": f"B{i:09d}", "url": f"amazon.co.jp/dp/B{i:09d}"}
+        for i, p in enumerate(costco_products)
+    ]
+
+    start = time.perf_counter()
+    comparator = IncrementalComparator(costco_products, amazon_products)
+    build = time.perf_counter() - start
+    assert comparator.results() == compare_prices(costco_products, amazon_products)
+
+    # 1時間ごとの更新を想定: 一部の商品の価格だけが変わる
+    changed = random.sample(range(product_count), change_count)
+    for i in changed:
+        amazon_products[i]["price"] = round(costco_products[i]["price"] * random.uniform(0.6, 1.5))
+
+    start = time.perf_counter()
+    full = compare_prices(costco_products, amazon_products)
+    full_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    comparator.observe_products(AMAZON, [amazon_products[i] for i in changed])
+    delta = comparator.recompute()
+    incremental_time = time.perf_counter() - start
+
+    assert comparator.results() == full
+    print(f"{product_count} pairs, {change_count} price changes")
+    print(f"initial build: {build * 1e3:.1f}ms")
+    print(f"full compare_prices: {full_time * 1e3:.1f}ms")
+    print(f"incremental: {incremental_time * 1e3:.2f}ms ({full_time / incremental_time:.0f}x)")
+    print(json.dumps({name: len(items) for name, items in delta.items()}))
+
+    # 新しいAmazon商品の追加: コストコ側のインデックスで照合するので、時間はカタログの大きさによらない
+    added = [
+        {"product_name": f"{costco_products[i]['product_name']} 新モデル", "price": 100, "asin": f"N{i:09d}", "url": f"amazon.co.jp/dp/N{i:09d}"}
+        for i in random.sample(range(product_count), 100)
+    ]
+    # 最初の1件ではコストコ商品名の逆引き (find_names_within用) を作る
+    start = time.perf_counter()
+    comparator.add_products(AMAZON, added[:1])
+    first_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for product in added[1:]:
+        comparator.add_products(AMAZON, [product])
+    add_time = (time.perf_counter() - start) / (len(added) - 1)
+    comparator.recompute()
+    amazon_products += added
+    assert comparator.results() == compare_prices(costco_products, amazon_products)
+    print(f"add one Amazon product: first {first_time * 1e3:.1f}ms, then {add_time * 1e6:.0f}us each")
+
+    # 価格履歴DBの更新経路: 期限切れのASINだけを取り直し、価格が変わったペアだけを再計算する
+    from price_history import PriceHistoryStore
+    store = PriceHistoryStore(":memory:")
+    store.upsert_observations(AMAZON, amazon_products[:product_count // 2])  # 残りは未観測 (期限切れ扱い)
+    fetched = []
+
+    def fetch(asins):
+        fetched.extend(asins)
+        return {asin: {"asin": asin, "product_name": None, "price": 100, "url": None} for asin in asins}
+
+    delta = comparator.refresh_from_history(store, AMAZON, fetch)
+    for product in amazon_products:
+        if product["asin"] in fetched:
+            product["price"] = 100
+    assert comparator.results() == compare_prices(costco_products, amazon_products)
+    print(f"refresh from history: fetched {len(fetched)} stale ASINs,",
+          json.dumps({name: len(items) for name, items in delta.items()}))
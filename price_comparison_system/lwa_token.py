@@ -0,0 +1,132 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import requests
+
+try:
+    from .http_session import get_session
+    from .metrics import count
+except ImportError:
+    from http_session import get_session
+    from metrics import count
+
+# ベンチマーク用のスタブサーバーなどに向ける場合は環境変数で差し替える
+LWA_TOKEN_URL = os.getenv("LWA_TOKEN_URL", "https://api.amazon.com/auth/o2/token")
+# トークンのファイルキャッシュ。空文字を設定するとファイルキャッシュを無効化する
+DEFAULT_CACHE_PATH = os.getenv("SP_API_TOKEN_CACHE", os.path.join(tempfile.gettempdir(), "sp_api_lwa_token.json"))
+# expires_inからこの秒数を差し引いた時刻を有効期限とみなす
+EXPIRY_MARGIN_SECONDS = 60
+# 有効期限のこの秒数前からバックグラウンドで先行更新する
+REFRESH_AHEAD_SECONDS = 300
+
+
+class LwaTokenManager:
+    """LWAアクセストークンを管理する。
+
+    更新処理は常に1つだけ実行され (single-flight)、期限切れの間に来た他の
+    呼び出しはその完了を待つ。有効期限が近づくと古いトークンを返しつつ
+    バックグラウンドで先行更新する。取得したトークンはファイルにも保存し、
+    コールドスタート時のLWAへの往復を省く。
+    """
+
+    def __init__(self, client_id, client_secret, refresh_token, token_url=LWA_TOKEN_URL, cache_path=DEFAULT_CACHE_PATH):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_token = refresh_token
+        self.token_url = token_url
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._refreshed = threading.Condition(self._lock)
+        self._refreshing = False
+        self._access_token = None
+        self._expires_at = 0.0  # time.time()基準
+        self._load_cache()
+
+    def _is_valid(self, now):
+        return self._access_token is not None and now < self._expires_at
+
+    def get_token(self):
+        """有効なアクセストークンを返す。取得できない場合はNoneを返す。"""
+        with self._lock:
+            now = time.time()
+            if self._is_valid(now):
+                if now >= self._expires_at - REFRESH_AHEAD_SECONDS and not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh, daemon=True).start()
+                return self._access_token
+
+            if self._refreshing:
+                # 実行中の更新を待ち、その結果を共有する
+                while self._refreshing:
+                    self._refreshed.wait()
+                return self._access_token if self._is_valid(time.time()) else None
+
+            self._refreshing = True
+
+        self._refresh()
+        with self._lock:
+            return self._access_token if self._is_valid(time.time()) else None
+
+    def _refresh(self):
+        """LWAからトークンを取得する。呼び出し前に_refreshingをTrueにしておくこと。"""
+        try:
+            token_data = self._request_token()
+            if token_data:
+                access_token = token_data["access_token"]
+                expires_at = time.time() + token_data["expires_in"] - EXPIRY_MARGIN_SECONDS
+                with self._lock:
+                    self._access_token = access_token
+                    self._expires_at = expires_at
+                self._save_cache(access_token, expires_at)
+        finally:
+            with self._lock:
+                self._refreshing = False
+                self._refreshed.notify_all()
+
+    def _request_token(self):
+        print("[INFO] LWAアクセストークンを更新しています...")
+        count("lwa_token.refresh")
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        data = {
+            "grant_type": "refresh_token",
+            "refresh_token": self.refresh_token,
+            "client_id": self.client_id,
+            "client_secret": self.client_secret
+        }
+
+        try:
+            response = get_session().post(self.token_url, headers=headers, data=data)
+            response.raise_for_status()
+            token_data = response.json()
+            print("[INFO] LWAアクセストークンの更新に成功しました。")
+            return token_data
+        except requests.exceptions.RequestException as e:
+            print(f"[ERROR] LWAアクセストークンの取得に失敗しました: {e}")
+            return None
+
+    def _load_cache(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        # 別のクライアントIDで保存されたトークンは使わない
+        if cached.get("client_id") == self.client_id and cached.get("expires_at", 0) > time.time():
+            self._access_token = cached.get("access_token")
+            self._expires_at = cached["expires_at"]
+
+    def _save_cache(self, access_token, expires_at):
+        if not self.cache_path:
+            return
+        tmp_path = f"{self.cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"client_id": self.client_id, "access_token": access_token, "expires_at": expires_at}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"[WARNING] LWAアクセストークンのキャッシュ保存に失敗しました: {e}")
@@ -1,10 +1,21 @@
 
 import json
+from collections import namedtuple
 import pandas as pd
 from costco_scraper import scrape_costco_products
 from amazon_api_client import get_amazon_product_info
+from vectorized_comparator import compare_price_arrays
+from fuzzy_matcher import FuzzyProductIndex
+from price_comparator import MATCH_MODE, MATCH_MIN_CONFIDENCE
+from price_history import COSTCO, AMAZON, open_store_from_env
+from product_records import ProductTable, CostcoOnlineProduct
 
-def match_products(costco_products, amazon_products_data):
+# マッチした商品の組。商品はコピーせず、元のレコード (またはProductTableの行) を参照する
+MatchedPair = namedtuple("MatchedPair", ["costco", "amazon", "confidence"])
+
+def match_products(costco_products, amazon_products_data, match_mode=None):
+    if (match_mode or MATCH_MODE) == "fuzzy":
+        return _fuzzy_match_products(costco_products, amazon_products_data)
     matched_products = []
     # 簡易的な商品名マッチング
     # 実際にはより高度なマッチングロジック（JANコード、部分一致、類似度計算など）が必要
@@ -15,50 +26,65 @@ def match_products(costco_products, amazon_products_data):
             # ここでは単純にキーワードが含まれているかでマッチング
             # 例: Costcoの商品名がAmazonの商品名に含まれている、またはその逆
             if c_name and a_name and (c_name in a_name or a_name in c_name):
-                matched_products.append({
-                    'costco_name': c_prod['product_name'],
-                    'costco_price': c_prod['price'],
-                    'costco_url': c_prod['url'],
-                    'amazon_name': a_prod['product_name'],
-                    'amazon_price': a_prod['price'],
-                    'amazon_url': a_prod['url'],
-                    'asin': a_prod['asin']
-                })
+                matched_products.append(MatchedPair(c_prod, a_prod, None))
                 break # Amazon側で見つかったら次のCostco商品へ
     return matched_products
 
-def calculate_price_difference(matched_products, min_diff_percent=20, max_diff_percent=25):
-    results = []
-    for item in matched_products:
-        if item['costco_price'] is None or item['amazon_price'] is None:
+def _fuzzy_match_products(costco_products, amazon_products_data):
+    # 正規化した商品名の類似度で、Costco商品ごとに最も近いAmazon商品を1件選ぶ
+    amazon_index = FuzzyProductIndex.from_products(amazon_products_data)
+    matched_products = []
+    for c_prod in costco_products:
+        if not c_prod['product_name']:
             continue
-
-        costco_price = float(item['costco_price'])
-        amazon_price = float(item['amazon_price'])
-
-        if costco_price == 0:
+        match = amazon_index.best_match(c_prod['product_name'], min_confidence=MATCH_MIN_CONFIDENCE)
+        if match is None:
             continue
+        matched_products.append(MatchedPair(c_prod, amazon_products_data[match[0]], match[1]))
+    return matched_products
 
-        price_diff_percent = ((amazon_price - costco_price) / costco_price) * 100
-
-        if min_diff_percent <= price_diff_percent <= max_diff_percent:
-            results.append({
-                'costco_name': item['costco_name'],
-                'costco_price': costco_price,
-                'costco_url': item['costco_url'],
-                'amazon_name': item['amazon_name'],
-                'amazon_price': amazon_price,
-                'amazon_url': item['amazon_url'],
-                'price_difference_percent': round(price_diff_percent, 2)
-            })
+def calculate_price_difference(matched_products, min_diff_percent=20, max_diff_percent=25):
+    # コストコがAmazonより min_diff_percent〜max_diff_percent% 安いペアを抽出する。
+    # 価格差(%)はprice_comparatorと同じ (コストコ価格 - Amazon価格) / Amazon価格 * 100 なので、
+    # 範囲は -max_diff_percent 〜 -min_diff_percent になる
+    # 価格は列(配列)として一括計算し、範囲内のペアだけを結果の行にする
+    comparison = compare_price_arrays(
+        [pair.costco['price'] for pair in matched_products],
+        [pair.amazon['price'] for pair in matched_products],
+        rules=((">=", -max_diff_percent), ("<=", -min_diff_percent)),
+        require_all=True
+    )
+    results = []
+    for i, percent in zip(comparison['index'].tolist(), comparison['percentage_difference'].tolist()):
+        # 結果の行は範囲内に残ったペアの分だけ作る
+        costco, amazon, _ = matched_products[i]
+        results.append({
+            'costco_name': costco['product_name'],
+            'costco_price': float(costco['price']),
+            'costco_url': costco['url'],
+            'amazon_name': amazon['product_name'],
+            'amazon_price': float(amazon['price']),
+            'amazon_url': amazon['url'],
+            'percentage_difference': percent
+        })
     return results
 
 def main():
     search_query = "Apple AirPods Pro" # 検索したい商品クエリ
 
-    print(f"[INFO] コストコオンラインから商品情報を取得中: {search_query}...")
-    costco_products = scrape_costco_products(search_query, pages=1)
-    print(f"[INFO] コストコオンラインから {len(costco_products)} 件の商品を取得しました。")
+    # 価格履歴DB (PRICE_HISTORY_DBを設定したときだけ使う)。同じ検索語の結果が新しければ再スクレイピングしない
+    history = open_store_from_env()
+    costco_products = history.cached_search(COSTCO, search_query) if history else None
+    if costco_products is not None:
+        print(f"[INFO] 価格履歴DBから {len(costco_products)} 件のコストコ商品を読み込みました。")
+    else:
+        print(f"[INFO] コストコオンラインから商品情報を取得中: {search_query}...")
+        costco_products = scrape_costco_products(search_query, pages=1)
+        print(f"[INFO] コストコオンラインから {len(costco_products)} 件の商品を取得しました。")
+        if history:
+            history.record_search(COSTCO, search_query, costco_products)
+    # 以降のマッチング・価格差計算は商品を詰め直さず、このテーブルの行をそのまま参照する
+    costco_products = ProductTable.from_records(costco_products, CostcoOnlineProduct)
 
     # Amazon PA-APIの認証情報が設定されているか確認
     
@@ -83,6 +109,8 @@ def main():
     # 暫定的に、Amazonの商品データは空として処理を進めます。
     amazon_products = [] # ここにAmazonから取得した商品データが入る想定
     print(f"[INFO] Amazonから {len(amazon_products)} 件の商品を取得しました。(認証情報が設定されている場合のみ)")
+    if history:
+        history.upsert_observations(AMAZON, amazon_products)
 
     # 商品マッチング
     # 実際には、コストコの商品名からAmazonのASINを検索し、そのASINを使って情報を取得する必要があります。
@@ -93,7 +121,7 @@ def main():
 
     # 価格差計算とフィルタリング
     filtered_results = calculate_price_difference(matched, min_diff_percent=20, max_diff_percent=25)
-    print(f"[INFO] 価格差20-25%の範囲でフィルタリングされた商品: {len(filtered_results)} 件")
+    print(f"[INFO] コストコが20-25%安い商品: {len(filtered_results)} 件")
 
     # 結果の出力
     if filtered_results:
@@ -0,0 +1,174 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+# 1にするとAPIのすべてのリクエストを計測し、内訳をログに出力する
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+
+_current_trace = contextvars.ContextVar("price_comparison_trace", default=None)
+
+
+class Trace:
+    """1リクエスト分のステージ別の所要時間とカウンター。スレッドセーフ。"""
+
+    def __init__(self, name=None):
+        self.name = name
+        self.started = time.perf_counter()
+        self._stages = {}  # ステージ名 -> [回数, 合計秒, 最大秒]
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage_name, seconds):
+        with self._lock:
+            entry = self._stages.get(stage_name)
+            if entry is None:
+                self._stages[stage_name] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                if seconds > entry[2]:
+                    entry[2] = seconds
+
+    def count(self, counter_name, value=1):
+        with self._lock:
+            self._counters[counter_name] = self._counters.get(counter_name, 0) + value
+
+    def to_dict(self):
+        """所要時間はミリ秒。ステージは並列実行や入れ子を含むので合計は全体時間と一致しない。"""
+        with self._lock:
+            return {
+                "name": self.name,
+                "total_ms": round((time.perf_counter() - self.started) * 1000, 2),
+                "stages": {
+                    stage_name: {"calls": calls, "total_ms": round(total * 1000, 2), "max_ms": round(longest * 1000, 2)}
+                    for stage_name, (calls, total, longest) in self._stages.items()
+                },
+                "counters": dict(self._counters),
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+
+class _Stage:
+    __slots__ = ("_trace", "_name", "_start")
+
+    def __init__(self, trace, name):
+        self._trace = trace
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._trace.record(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class _NullStage:
+    """計測していないときのstage()。何もしない。"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    """with stage("sigv4_sign"): ... の区間の所要時間を現在のトレースに記録する。"""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NULL_STAGE
+    return _Stage(trace, name)
+
+
+def count(name, value=1):
+    """現在のトレースのカウンターを加算する。計測していなければ何もしない。"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.count(name, value)
+
+
+def record(name, seconds):
+    """計測済みの時間 (待ち時間など) を現在のトレースに記録する。"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record(name, seconds)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+class tracing:
+    """with tracing("compare") as trace: の中の処理を計測する。enabled=Falseならtraceは None。"""
+
+    def __init__(self, name=None, enabled=True):
+        self._trace = Trace(name) if enabled else None
+        self._token = None
+
+    def __enter__(self):
+        if self._trace is not None:
+            self._token = _current_trace.set(self._trace)
+        return self._trace
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._token is not None:
+            _current_trace.reset(self._token)
+        return False
+
+
+def bind(fn):
+    """現在のトレースを引き継いでfnを実行する関数を返す (スレッドプールへの投入用)。
+
+    submitのたびに呼ぶこと。Contextは同時に複数のスレッドで実行できないので、
+    呼び出しごとにコピーする。
+    """
+    if _current_trace.get() is None:
+        return fn
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    iterations = 1_000_000
+
+    def bare():
+        for _ in range(iterations):
+            pass
+
+    def instrumented():
+        for _ in range(iterations):
+            with stage("noop"):
+                pass
+
+    for label, fn, enabled in (("bare loop", bare, False), ("stage() disabled", instrumented, False), ("stage() enabled", instrumented, True)):
+        with tracing("bench", enabled=enabled):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+        print(f"{label:<18} {elapsed / iterations * 1e9:6.0f} ns/iteration")
+
+    # スレッドプールへの引き継ぎ
+    def lookup(i):
+        with stage("lookup"):
+            time.sleep(0.01)
+        count("lookups")
+        count("bytes", 1024)
+
+    with tracing("request") as trace:
+        with stage("fan_out"), ThreadPoolExecutor(max_workers=4) as executor:
+            for future in [executor.submit(bind(lookup), i) for i in range(8)]:
+                future.result()
+    print(trace.to_json())
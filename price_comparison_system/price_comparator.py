@@ -1,52 +1,91 @@
 
 import json
+import os
 
-def compare_prices(costco_products, amazon_products):
-    comparison_results = []
+try:
+    from .fuzzy_matcher import FuzzyProductIndex, DEFAULT_MIN_CONFIDENCE
+    from .metrics import stage
+    from .product_matcher import ProductIndex
+    from .vectorized_comparator import DEFAULT_THRESHOLD_RULES, compare_price_arrays, matches_threshold_rules
+except ImportError:
+    from fuzzy_matcher import FuzzyProductIndex, DEFAULT_MIN_CONFIDENCE
+    from metrics import stage
+    from product_matcher import ProductIndex
+    from vectorized_comparator import DEFAULT_THRESHOLD_RULES, compare_price_arrays, matches_threshold_rules
 
-    for costco_product in costco_products:
-        costco_name = costco_product.get("product_name")
-        costco_price = costco_product.get("price")
-        costco_url = costco_product.get("url")
+# 商品名のマッチング方式
+# substring: 小文字化した商品名の部分一致 (従来どおり)
+# fuzzy: 正規化した商品名の類似度で最も近い1件 (結果にmatch_confidenceが付く)
+MATCH_MODE = os.getenv("MATCH_MODE", "substring")
+MATCH_MIN_CONFIDENCE = float(os.getenv("MATCH_MIN_CONFIDENCE", str(DEFAULT_MIN_CONFIDENCE)))
+
+# 抽出ルール (DEFAULT_THRESHOLD_RULES, matches_threshold_rules) と価格差の計算は
+# vectorized_comparatorにまとめてある。既存の呼び出し元のためにここからも読み込める
+
+def compare_prices(costco_products, amazon_products, match_mode=None):
+    with stage("compare"):
+        return _compare_prices(costco_products, amazon_products, match_mode or MATCH_MODE)
+
+def compare_pairs(pairs):
+    """マッチング済みの (コストコ商品, Amazon商品) の組を商品名を確かめずにそのまま比較する。
 
-        if not costco_name or costco_price is None:
-            continue
+    検索結果の先頭をそのコストコ商品の対応とみなす場合など、呼び出し側で組を決めているときに使う。
+    """
+    with stage("compare"):
+        return _compare_pairs([(costco_product, amazon_product, None) for costco_product, amazon_product in pairs])
 
-        # Amazonの商品を検索（ここではモックデータを使用）
-        # 実際にはamazon_sp_api_client.pyのsearch_amazon_productsを呼び出す
-        # 商品名の部分一致でマッチングを試みる
-        matching_amazon_products = [
-            p for p in amazon_products 
-            if costco_name.lower() in p.get("product_name", "").lower()
-        ]
+def _find_matches(amazon_index, costco_name, match_mode):
+    """マッチしたAmazon商品の [(商品ID, 信頼度), ...]。部分一致の信頼度はNone。"""
+    if match_mode == "fuzzy":
+        match = amazon_index.best_match(costco_name, min_confidence=MATCH_MIN_CONFIDENCE)
+        return [match] if match else []
+    return [(i, None) for i in amazon_index.find_substring_matches(costco_name)]
 
-        for amazon_product in matching_amazon_products:
-            amazon_name = amazon_product.get("product_name")
-            amazon_price = amazon_product.get("price")
-            amazon_url = amazon_product.get("url")
+def _compare_prices(costco_products, amazon_products, match_mode):
+    # Amazon商品名の転置インデックスを一度だけ構築する
+    index_class = FuzzyProductIndex if match_mode == "fuzzy" else ProductIndex
+    with stage("matching"):
+        amazon_index = index_class.from_products(amazon_products)
 
-            if amazon_price is None or amazon_price == 0:
+    # 商品名の部分一致(または類似度)でマッチしたペアを集める (インデックスで候補を絞り込む)
+    pairs = []
+    with stage("matching"):
+        for costco_product in costco_products:
+            costco_name = costco_product.get("product_name")
+            if not costco_name or costco_product.get("price") is None:
                 continue
+            for amazon_id, confidence in _find_matches(amazon_index, costco_name, match_mode):
+                pairs.append((costco_product, amazon_products[amazon_id], confidence))
+    return _compare_pairs(pairs)
 
-            # 価格差の計算
-            # (コストコ価格 - Amazon価格) / Amazon価格 * 100
-            price_difference = costco_price - amazon_price
-            percentage_difference = (price_difference / amazon_price) * 100
-
-            # 20%以上高いか、25%以上安い場合を抽出
-            # percentage_difference >= 20: コストコがAmazonより20%以上高い
-            # percentage_difference <= -25: コストコがAmazonより25%以上安い
-            if percentage_difference >= 20 or percentage_difference <= -25:
-                comparison_results.append({
-                    "costco_product_name": costco_name,
-                    "costco_price": costco_price,
-                    "costco_url": costco_url,
-                    "amazon_product_name": amazon_name,
-                    "amazon_price": amazon_price,
-                    "amazon_url": amazon_url,
-                    "price_difference": price_difference,
-                    "percentage_difference": round(percentage_difference, 2)
-                })
+def _compare_pairs(pairs):
+    """(コストコ商品, Amazon商品, 信頼度) の組を比較し、抽出ルールを満たす結果を組の順に返す。"""
+    # 価格差の計算と、20%以上高いか25%以上安いペアの抽出はまとめて配列で行う
+    # (コストコ価格 - Amazon価格) / Amazon価格 * 100
+    comparison = compare_price_arrays(
+        [costco_product.get("price") for costco_product, _, _ in pairs],
+        [amazon_product.get("price") for _, amazon_product, _ in pairs],
+    )
+
+    comparison_results = []
+    # 結果の行は抽出されたペアの分だけ作る
+    for i, percentage_difference in zip(comparison["index"].tolist(), comparison["percentage_difference"].tolist()):
+        costco_product, amazon_product, confidence = pairs[i]
+        costco_price = costco_product.get("price")
+        amazon_price = amazon_product.get("price")
+        result = {
+            "costco_product_name": costco_product.get("product_name"),
+            "costco_price": costco_price,
+            "costco_url": costco_product.get("url"),
+            "amazon_product_name": amazon_product.get("product_name"),
+            "amazon_price": amazon_price,
+            "amazon_url": amazon_product.get("url"),
+            "price_difference": costco_price - amazon_price,
+            "percentage_difference": percentage_difference
+        }
+        if confidence is not None:
+            result["match_confidence"] = confidence
+        comparison_results.append(result)
     return comparison_results
 
 if __name__ == '__main__':
@@ -71,3 +110,7 @@ if __name__ == '__main__':
     results = compare_prices(dummy_costco_products, dummy_amazon_products)
     print(json.dumps(results, ensure_ascii=False, indent=2))
 
+    # 類似度マッチングでは部分一致しない商品名同士も比較できる
+    results = compare_prices(dummy_costco_products, dummy_amazon_products, match_mode="fuzzy")
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
@@ -1,9 +1,13 @@
 
 import json
 import os
-from price_comparison_system.costco_parser import parse_costco_markdown
-from price_comparison_system.amazon_sp_api_client import search_amazon_products, get_amazon_competitive_price
+from price_comparison_system.costco_parser import iter_costco_markdown_firecrawl
+from price_comparison_system.amazon_sp_api_client import search_amazon_products, get_amazon_competitive_prices
+from price_comparison_system.incremental_comparator import IncrementalComparator
 from price_comparison_system.price_comparator import compare_prices
+from price_comparison_system.price_history import COSTCO, AMAZON, open_store_from_env
+from price_comparison_system.product_records import ProductTable, CostcoProduct
+from price_comparison_system.result_ranking import annotate_unit_prices, top_k
 
 def run_price_comparison(costco_search_term):
     print(f"Searching Costco for: {costco_search_term}")
@@ -16,16 +20,14 @@ def run_price_comparison(costco_search_term):
         print(f"Error: Firecrawl output file not found at {firecrawl_output_file}")
         return []
 
+    # 2. コストコのMarkdownコンテンツを解析
+    # JSON全体を読み込まず、"markdown"の値を少しずつデコードしながら商品を取り出し、
+    # 商品ごとの辞書を作らずに列指向のテーブルへ詰める
     try:
-        with open(firecrawl_output_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        costco_markdown_content = data.get('markdown', '')
+        costco_products = ProductTable.from_records(iter_costco_markdown_firecrawl(firecrawl_output_file), CostcoProduct)
     except Exception as e:
         print(f"Error reading Firecrawl output: {e}")
         return []
-
-    # 2. コストコのMarkdownコンテンツを解析
-    costco_products = parse_costco_markdown(costco_markdown_content)
     print(f"Found {len(costco_products)} products on Costco.")
 
     # 3. Amazonの商品を検索（認証情報がないためダミーデータを使用）
@@ -45,9 +47,27 @@ def run_price_comparison(costco_search_term):
     print(f"Found {len(amazon_products)} dummy products on Amazon.")
 
     # 4. 価格比較
-    comparison_results = compare_prices(costco_products, amazon_products)
+    # PRICE_HISTORY_DBを設定していれば、価格履歴DBに今回の観測を記録する (キーのない商品は記録されない)
+    history = open_store_from_env()
+    if history:
+        history.record_search(COSTCO, costco_search_term, costco_products)
+        history.upsert_observations(AMAZON, [p for p in amazon_products if p.get("price") is not None])
+        # 価格のないAmazon商品は、DBの価格が期限切れのものだけSP-APIで取り直し、
+        # 価格が変わったペアだけを比較し直す
+        comparator = IncrementalComparator(costco_products, amazon_products)
+        comparator.refresh_from_history(history, AMAZON, lambda asins: get_amazon_competitive_prices(asins)[0])
+        comparison_results = comparator.results()
+        history.close()
+    else:
+        comparison_results = compare_prices(costco_products, amazon_products)
     print(f"Found {len(comparison_results)} price differences of 20-25% or more.")
 
+    # 5. コストコの表示単価 (なければ商品名の数量から計算) を付け、コストコが安い上位を表示
+    annotate_unit_prices(comparison_results, costco_products)
+    for result in top_k(comparison_results, 5):
+        print(f"  {result['percentage_difference']:+.1f}%  {result['costco_product_name']}"
+              f" ({result['costco_unit_price']} 円/{result['unit']})")
+
     return comparison_results
 
 if __name__ == '__main__':
@@ -0,0 +1,269 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+COSTCO = "costco"
+AMAZON = "amazon"
+
+# 価格を再取得するまでの既定の有効期間 (秒)
+DEFAULT_MAX_AGE = float(os.getenv("PRICE_HISTORY_MAX_AGE", "21600"))
+
+_COSTCO_PRODUCT_ID = re.compile(r"/p/([^/?#]+)")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS price_observations (
+    source TEXT NOT NULL,
+    product_key TEXT NOT NULL,
+    observed_at REAL NOT NULL,
+    price REAL,
+    PRIMARY KEY (source, product_key, observed_at)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS products (
+    source TEXT NOT NULL,
+    product_key TEXT NOT NULL,
+    product_name TEXT,
+    url TEXT,
+    last_price REAL,
+    last_observed_at REAL NOT NULL,
+    PRIMARY KEY (source, product_key)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS products_last_observed ON products (source, last_observed_at);
+
+CREATE TABLE IF NOT EXISTS searches (
+    source TEXT NOT NULL,
+    query TEXT NOT NULL,
+    product_keys TEXT NOT NULL,
+    searched_at REAL NOT NULL,
+    PRIMARY KEY (source, query)
+) WITHOUT ROWID;
+"""
+
+
+def costco_product_key(product):
+    """コストコ商品のキー。item_numberがなければURL末尾の /p/<id> を使う。"""
+    item_number = product.get("item_number")
+    if item_number:
+        return str(item_number)
+    match = _COSTCO_PRODUCT_ID.search(product.get("url") or "")
+    return match.group(1) if match else None
+
+
+def amazon_product_key(product):
+    return product.get("asin")
+
+
+_KEY_FUNCTIONS = {COSTCO: costco_product_key, AMAZON: amazon_product_key}
+# cached_searchで商品キーを返すときの、元の商品情報でのフィールド名
+_KEY_FIELDS = {COSTCO: "item_number", AMAZON: "asin"}
+
+
+class PriceHistoryStore:
+    """コストコ・Amazonの価格観測をSQLiteに蓄積するストア。
+
+    観測は (ソース, 商品キー, 観測時刻) で保存し、商品ごとの最新値は
+    productsテーブルに持つので、期限切れの商品だけを再取得できる。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def upsert_observations(self, source, products, observed_at=None):
+        """商品リストの価格をまとめて記録し、記録した件数を返す。キーのない商品は無視する。"""
+        observed_at = time.time() if observed_at is None else observed_at
+        key_of = _KEY_FUNCTIONS[source]
+        rows = []
+        for product in products:
+            key = key_of(product)
+            if key:
+                rows.append((source, key, product.get("product_name"), product.get("url"), product.get("price"), observed_at))
+        if not rows:
+            return 0
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO price_observations (source, product_key, observed_at, price) VALUES (?, ?, ?, ?)",
+                [(source, key, at, price) for source, key, _, _, price, at in rows],
+            )
+            self._conn.executemany(
+                "INSERT INTO products (source, product_key, product_name, url, last_price, last_observed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (source, product_key) DO UPDATE SET"
+                "  product_name = COALESCE(excluded.product_name, product_name),"
+                "  url = COALESCE(excluded.url, url),"
+                "  last_price = excluded.last_price,"
+                "  last_observed_at = excluded.last_observed_at"
+                " WHERE excluded.last_observed_at >= last_observed_at",
+                rows,
+            )
+            self._conn.commit()
+        return len(rows)
+
+    def history(self, source, product_key, since=None, until=None):
+        """商品の価格履歴を [(観測時刻, 価格), ...] の時刻順で返す。"""
+        query = "SELECT observed_at, price FROM price_observations WHERE source = ? AND product_key = ?"
+        params = [source, product_key]
+        if since is not None:
+            query += " AND observed_at >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND observed_at < ?"
+            params.append(until)
+        with self._lock:
+            return self._conn.execute(query + " ORDER BY observed_at", params).fetchall()
+
+    def latest(self, source, product_keys):
+        """商品キー → 最新の {product_name, url, price, observed_at} の辞書を返す。"""
+        product_keys = list(product_keys)
+        result = {}
+        with self._lock:
+            # SQLiteの変数上限を超えないよう分割して問い合わせる
+            for i in range(0, len(product_keys), 500):
+                batch = product_keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                for key, name, url, price, observed_at in self._conn.execute(
+                    "SELECT product_key, product_name, url, last_price, last_observed_at FROM products"
+                    f" WHERE source = ? AND product_key IN ({placeholders})",
+                    [source, *batch],
+                ):
+                    result[key] = {"product_name": name, "url": url, "price": price, "observed_at": observed_at}
+        return result
+
+    def observations_since(self, source, since):
+        """since以降に観測された商品の (商品キー, 最新価格) を返す。"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT product_key, last_price FROM products WHERE source = ? AND last_observed_at > ?",
+                (source, since),
+            ).fetchall()
+
+    def stale_keys(self, source, product_keys, max_age=DEFAULT_MAX_AGE, now=None):
+        """未観測、または最後の観測からmax_age秒以上経った商品キーを入力順で返す。"""
+        now = time.time() if now is None else now
+        product_keys = list(dict.fromkeys(product_keys))
+        latest = self.latest(source, product_keys)
+        return [key for key in product_keys if key not in latest or latest[key]["observed_at"] <= now - max_age]
+
+    def refresh_stale(self, source, product_keys, fetch, max_age=DEFAULT_MAX_AGE):
+        """期限切れの商品だけをfetchで再取得して記録し、全商品の最新値を返す。
+
+        fetchは商品キーのリストを受け取り、商品キー → 商品情報(dict)の辞書を返す関数。
+        """
+        product_keys = list(product_keys)
+        stale = self.stale_keys(source, product_keys, max_age)
+        if stale:
+            fetched = fetch(stale)
+            self.upsert_observations(source, fetched.values())
+        return self.latest(source, product_keys)
+
+    def record_search(self, source, query, products, observed_at=None):
+        """検索結果の商品を記録し、検索語 → 商品キーの対応も保存する。"""
+        observed_at = time.time() if observed_at is None else observed_at
+        products = list(products)
+        self.upsert_observations(source, products, observed_at)
+        key_of = _KEY_FUNCTIONS[source]
+        product_keys = [key for key in map(key_of, products) if key]
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO searches (source, query, product_keys, searched_at) VALUES (?, ?, ?, ?)",
+                (source, query, json.dumps(product_keys), observed_at),
+            )
+            self._conn.commit()
+
+    def cached_search(self, source, query, max_age=DEFAULT_MAX_AGE, now=None):
+        """max_age秒以内に記録した検索結果があれば商品リストを返す。なければNoneを返す。
+
+        商品はスクレイピング・検索結果と同じフィールド名 (コストコはitem_number、
+        Amazonはasin) で返すので、取得し直した結果と同じように扱える。
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT product_keys, searched_at FROM searches WHERE source = ? AND query = ?",
+                (source, query),
+            ).fetchone()
+        if row is None or row[1] <= now - max_age:
+            return None
+        product_keys = json.loads(row[0])
+        latest = self.latest(source, product_keys)
+        key_field = _KEY_FIELDS[source]
+        return [
+            {key_field: key, "product_name": latest[key]["product_name"], "price": latest[key]["price"], "url": latest[key]["url"]}
+            for key in product_keys if key in latest
+        ]
+
+    def compact(self, source=None):
+        """価格が前後の観測と変わらない中間の観測を削除し、削除件数を返す。
+
+        価格が変わった時点と、その価格が最後に確認された時点だけが残る。
+        """
+        where = "WHERE source = ?" if source else ""
+        params = [source] if source else []
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM price_observations WHERE (source, product_key, observed_at) IN ("
+                " SELECT source, product_key, observed_at FROM ("
+                "  SELECT source, product_key, observed_at, price,"
+                "   LAG(price) OVER w AS previous_price,"
+                "   LEAD(price) OVER w AS next_price,"
+                "   LEAD(observed_at) OVER w AS next_observed_at"
+                f"  FROM price_observations {where}"
+                "  WINDOW w AS (PARTITION BY source, product_key ORDER BY observed_at)"
+                " ) WHERE next_observed_at IS NOT NULL AND previous_price IS price AND next_price IS price"
+                ")",
+                params,
+            )
+            self._conn.commit()
+            return cursor.rowcount
+
+
+def open_store_from_env(default_path=None):
+    """PRICE_HISTORY_DB (未設定ならdefault_path) のストアを開く。どちらもなければNoneを返す。"""
+    path = os.getenv("PRICE_HISTORY_DB", default_path)
+    if not path:
+        return None
+    try:
+        return PriceHistoryStore(path)
+    except sqlite3.Error as e:
+        print(f"[WARNING] 価格履歴DBを開けませんでした: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    store = PriceHistoryStore(":memory:")
+    products = [
+        {"product_name": "KINO ペーパー トレイ 4枚 x 10セット", "price": 2298, "url": "https://www.costco.co.jp/c/KINO-Paper-Trays-4-Pieces-x-10-Sets/p/24097"},
+        {"product_name": "エルモア ティッシュ 5箱 x 12パック", "price": 3998, "item_number": "58392", "url": None},
+    ]
+    for day, price in enumerate([2298, 2298, 2298, 1998, 1998, 2298]):
+        products[0]["price"] = price
+        store.upsert_observations(COSTCO, products, observed_at=day * 86400.0)
+
+    print(store.history(COSTCO, "24097"))
+    print(f"compacted: {store.compact()}")
+    print(store.history(COSTCO, "24097"))
+    print(store.stale_keys(COSTCO, ["24097", "58392", "99999"], max_age=86400, now=5.5 * 86400))
+
+    store.record_search(COSTCO, "ティッシュ", products, observed_at=5 * 86400.0)
+    print(store.cached_search(COSTCO, "ティッシュ", max_age=86400, now=5.5 * 86400))
+    print(store.cached_search(COSTCO, "ティッシュ", max_age=86400, now=7 * 86400))
+
+    # 一括upsertの速度
+    bulk = [{"product_name": f"商品{i}", "price": 1000 + i % 7, "item_number": str(i)} for i in range(10000)]
+    start = time.perf_counter()
+    for run in range(10):
+        store.upsert_observations(COSTCO, bulk, observed_at=10 * 86400.0 + run)
+    elapsed = time.perf_counter() - start
+    print(f"upsert: {len(bulk) * 10} observations in {elapsed:.2f}s, compacted {store.compact(COSTCO)}")
@@ -0,0 +1,159 @@
+from collections import defaultdict
+
+# 転置インデックスに使う文字n-gramの長さ
+NGRAM_SIZE = 3
+
+
+def _ngrams(text, n):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class ProductIndex:
+    """Amazon商品名の文字n-gram転置インデックス。
+
+    商品名は構築時に一度だけ小文字化する。検索では最も出現頻度の低いn-gramの
+    ポスティングリストから候補を絞り込み、部分一致を確認するので全件走査しない。
+    """
+
+    def __init__(self, names, ngram_size=NGRAM_SIZE):
+        self.ngram_size = ngram_size
+        self._names = [(name or "").lower() for name in names]
+        self._postings = defaultdict(list)  # n-gram -> 商品IDの昇順リスト
+        self._char_postings = defaultdict(list)  # n未満の短いクエリ用
+        # 商品名ごとに最も出現頻度の低いn-gram (n文字未満の名前はその名前) -> 商品ID。
+        # find_names_withinを初めて呼んだときに作る (compare_pricesの構築時間を増やさない)
+        self._anchors = None
+        for product_id, name in enumerate(self._names):
+            self._index_name(product_id, name)
+
+    def _index_name(self, product_id, name):
+        for gram in _ngrams(name, self.ngram_size):
+            self._postings[gram].append(product_id)
+        for char in set(name):
+            self._char_postings[char].append(product_id)
+
+    def _add_anchor(self, product_id, name):
+        if not name:
+            return
+        if len(name) < self.ngram_size:
+            anchor = name
+        else:
+            anchor = min(_ngrams(name, self.ngram_size), key=lambda gram: len(self._postings[gram]))
+        self._anchors[anchor].append(product_id)
+
+    def add(self, name):
+        """商品名を1件追加して商品IDを返す。インデックスを作り直さずに済む。"""
+        product_id = len(self._names)
+        name = (name or "").lower()
+        self._names.append(name)
+        self._index_name(product_id, name)
+        if self._anchors is not None:
+            self._add_anchor(product_id, name)
+        return product_id
+
+    @classmethod
+    def from_products(cls, products, key="product_name", ngram_size=NGRAM_SIZE):
+        if hasattr(products, "column"):
+            # ProductTableなら列をそのまま使う
+            return cls(products.column(key), ngram_size)
+        return cls([product.get(key) for product in products], ngram_size)
+
+    def __len__(self):
+        return len(self._names)
+
+    def _candidates(self, query):
+        if not query:
+            return range(len(self._names))
+        if len(query) >= self.ngram_size:
+            grams = _ngrams(query, self.ngram_size)
+            postings = self._postings
+        else:
+            grams = set(query)
+            postings = self._char_postings
+        rarest = None
+        for gram in grams:
+            posting = postings.get(gram)
+            if not posting:
+                return []
+            if rarest is None or len(posting) < len(rarest):
+                rarest = posting
+        return rarest
+
+    def find_substring_matches(self, query):
+        """queryを部分文字列として含む商品IDを昇順で返す (従来の `in` 判定と同じ結果)。"""
+        query = (query or "").lower()
+        names = self._names
+        return [product_id for product_id in self._candidates(query) if query in names[product_id]]
+
+    def find_names_within(self, text):
+        """textに部分文字列として含まれる (空でない) 商品名の商品IDを昇順で返す。
+
+        find_substring_matchesの逆向き。textに含まれる商品名なら、その名前のn-gramはすべて
+        textにも現れる。商品名を1つのn-gram (追加時に最も出現頻度の低いもの) で引けるように
+        してあるので、textの各位置から始まるn文字以下の文字列だけを調べればよく、全件走査しない。
+        """
+        text = (text or "").lower()
+        names = self._names
+        if self._anchors is None:
+            self._anchors = defaultdict(list)
+            for product_id, name in enumerate(names):
+                self._add_anchor(product_id, name)
+        anchors = self._anchors
+        candidates = set()
+        for start in range(len(text)):
+            for end in range(start + 1, min(start + self.ngram_size, len(text)) + 1):
+                candidates.update(anchors.get(text[start:end], ()))
+        return sorted(product_id for product_id in candidates if names[product_id] in text)
+
+    def find_token_matches(self, query):
+        """queryの空白区切りの語をすべて含む商品IDを昇順で返す (語順は問わない)。"""
+        tokens = (query or "").lower().split()
+        if not tokens:
+            return []
+        # 最も長い語で候補を絞り込み、残りの語で確認する
+        tokens.sort(key=len, reverse=True)
+        names = self._names
+        return [
+            product_id for product_id in self._candidates(tokens[0])
+            if all(token in names[product_id] for token in tokens)
+        ]
+
+    def match(self, query, compat=True):
+        """compat=Trueなら従来の部分一致ルール、Falseなら語単位のルールで照合する。"""
+        return self.find_substring_matches(query) if compat else self.find_token_matches(query)
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    random.seed(0)
+    words = ["ティッシュ", "ペーパー", "カークランド", "シグネチャー", "トイレット", "ロール", "箱", "パック",
+             "tissue", "paper", "kirkland", "organic", "coffee", "beans", "1kg", "x", "12", "30", "5", "24"]
+
+    def make_name():
+        return " ".join(random.choice(words) for _ in range(random.randint(3, 8)))
+
+    query_count = 200
+    print(f"{'catalog':>8} {'build':>9} {'scan/query':>12} {'index/query':>12} {'speedup':>8}")
+    for size in (1_000, 10_000, 100_000):
+        amazon_names = [make_name() for _ in range(size)]
+        queries = [" ".join(random.choice(amazon_names).split()[:random.randint(1, 3)]) for _ in range(query_count)]
+
+        start = time.perf_counter()
+        index = ProductIndex(amazon_names)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        expected = []
+        for query in queries:
+            q = query.lower()
+            expected.append([i for i, name in enumerate(amazon_names) if q in name.lower()])
+        scan = (time.perf_counter() - start) / query_count
+
+        start = time.perf_counter()
+        actual = [index.find_substring_matches(query) for query in queries]
+        indexed = (time.perf_counter() - start) / query_count
+
+        assert actual == expected
+        print(f"{size:>8} {build:>8.2f}s {scan * 1e3:>10.2f}ms {indexed * 1e3:>10.2f}ms {scan / indexed:>7.1f}x")
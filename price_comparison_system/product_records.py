@@ -0,0 +1,388 @@
+import math
+import sys
+from array import array
+
+# 価格が欠けていることを表す整数列の値
+_MISSING_INT = -(2 ** 63)
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class ProductRecord:
+    """商品1件のレコード。__slots__で辞書より小さく、辞書と同じように読み書きできる。
+
+    get() / [] / []= / keys() / items() に対応しているので、これまで商品辞書を
+    受け取っていた関数にそのまま渡せる。JSONにするときはto_dict() (または
+    json.dumpsのdefault=json_default) で辞書に戻す。フィールドはサブクラスの
+    __slots__の順で、to_dict()のキーの順序もこれに従う。
+    """
+
+    __slots__ = ()
+    # 同じ値が大量に繰り返されるフィールド。sys.internで1つの文字列を共有する
+    _interned = ()
+
+    def _set(self, field, value):
+        setattr(self, field, _intern(value) if field in self._interned else value)
+
+    @classmethod
+    def from_dict(cls, product):
+        return cls(*(product.get(field) for field in cls.__slots__))
+
+    def get(self, key, default=None):
+        if key in self.__slots__:
+            return getattr(self, key)
+        return default
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        self._set(key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def keys(self):
+        return self.__slots__
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.__slots__]
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        if isinstance(other, ProductRecord):
+            return type(self) is type(other) and self.items() == other.items()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class CostcoProduct(ProductRecord):
+    """コストコのMarkdown (Firecrawl) から読んだ商品。
+
+    unit_price / unit_labelは「1ロール当り ¥107」のような表示単価 (107, "1ロール")。
+    """
+
+    __slots__ = ("product_name", "price", "url", "unit_price", "unit_label")
+
+    def __init__(self, product_name=None, price=None, url=None, unit_price=None, unit_label=None):
+        self.product_name = product_name
+        self.price = price
+        self.url = url
+        self.unit_price = unit_price
+        self.unit_label = unit_label
+
+
+class CostcoOnlineProduct(ProductRecord):
+    """コストコオンラインの検索APIから取得した商品。"""
+
+    __slots__ = ("source", "product_name", "price", "item_number", "member_only", "stock_status", "url")
+    _interned = ("source", "stock_status")
+
+    def __init__(self, source=None, product_name=None, price=None, item_number=None, member_only=None,
+                 stock_status=None, url=None):
+        self.source = _intern(source)
+        self.product_name = product_name
+        self.price = price
+        self.item_number = item_number
+        self.member_only = member_only
+        self.stock_status = _intern(stock_status)
+        self.url = url
+
+
+class AmazonProduct(ProductRecord):
+    """SP-APIのCatalog Itemsで検索したAmazonの商品。"""
+
+    __slots__ = ("source", "asin", "product_name", "url", "price")
+    _interned = ("source",)
+
+    def __init__(self, source=None, asin=None, product_name=None, url=None, price=None):
+        self.source = _intern(source)
+        self.asin = asin
+        self.product_name = product_name
+        self.url = url
+        self.price = price
+
+
+class ProductRow:
+    """ProductTableの1行のビュー。値はコピーせず、テーブルの列を直接読み書きする。"""
+
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def get(self, key, default=None):
+        if key in self._table.columns:
+            return self._table.value(key, self._index)
+        return default
+
+    def __getitem__(self, key):
+        if key not in self._table.columns:
+            raise KeyError(key)
+        return self._table.value(key, self._index)
+
+    def __setitem__(self, key, value):
+        self._table.set_value(key, self._index, value)
+
+    def __contains__(self, key):
+        return key in self._table.columns
+
+    def keys(self):
+        return self._table.columns
+
+    def items(self):
+        return [(column, self._table.value(column, self._index)) for column in self._table.columns]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, ProductRecord, ProductRow)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"ProductRow({self.to_dict()!r})"
+
+
+class ProductTable:
+    """同じ種類の商品を列ごとに持つテーブル。
+
+    価格は整数 (またはfloat) の配列、source・stock_statusのように値の種類が少ない
+    列はカテゴリ番号の配列と値の一覧、それ以外の列は値のリストで持つので、
+    商品ごとの辞書やオブジェクトを作らない。行はProductRowのビューとして読め、
+    compare_pricesなど商品辞書のリストを受け取る関数にそのまま渡せる。
+    """
+
+    CATEGORICAL_COLUMNS = ("source", "stock_status", "member_only")
+
+    def __init__(self, record_type=CostcoProduct):
+        self.record_type = record_type
+        self.columns = record_type.__slots__
+        self._lists = {}
+        self._codes = {}  # カテゴリ列 -> array('H') のカテゴリ番号
+        self._categories = {}  # カテゴリ列 -> (値のリスト, 値 -> 番号)
+        for column in self.columns:
+            if column == "price":
+                continue
+            if column in self.CATEGORICAL_COLUMNS:
+                self._codes[column] = array("H")
+                self._categories[column] = ([None], {None: 0})
+            else:
+                self._lists[column] = []
+        self._prices = array("q")
+        self._prices_exported = False  # price_array()のビューが価格列を参照している
+        self._length = 0
+
+    @classmethod
+    def from_records(cls, products, record_type=None):
+        """商品 (レコード・辞書・行ビュー) の並びからテーブルを作る。ジェネレーターも受け取れる。"""
+        products = iter(products)
+        first = next(products, None)
+        if record_type is None:
+            record_type = type(first) if isinstance(first, ProductRecord) else CostcoProduct
+        table = cls(record_type)
+        if first is not None:
+            table.append(first)
+            table.extend(products)
+        return table
+
+    def __len__(self):
+        return self._length
+
+    def _category_code(self, column, value):
+        values, codes = self._categories[column]
+        code = codes.get(value)
+        if code is None:
+            value = _intern(value)
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    def _append_price(self, price):
+        if self._prices_exported:
+            # ビューが参照しているarrayは大きさを変えられない (BufferError) ので、
+            # 列をコピーしてから追加する。以前のビューはコピー前の値のまま残る
+            self._prices = array(self._prices.typecode, self._prices)
+            self._prices_exported = False
+        prices = self._prices
+        if prices.typecode == "q":
+            if price is None:
+                prices.append(_MISSING_INT)
+                return
+            if type(price) is int and price != _MISSING_INT:
+                prices.append(price)
+                return
+            # floatが来たら列全体をfloatに切り替える (欠損はNaN)
+            self._prices = prices = array("d", (math.nan if p == _MISSING_INT else float(p) for p in prices))
+        prices.append(math.nan if price is None else float(price))
+
+    def append(self, product):
+        get = product.get
+        for column, values in self._lists.items():
+            values.append(get(column))
+        for column, codes in self._codes.items():
+            value = get(column)
+            code = self._categories[column][1].get(value)
+            codes.append(self._category_code(column, value) if code is None else code)
+        self._append_price(get("price"))
+        self._length += 1
+
+    def extend(self, products):
+        for product in products:
+            self.append(product)
+
+    def value(self, column, index):
+        if column == "price":
+            price = self._prices[index]
+            if self._prices.typecode == "q":
+                return None if price == _MISSING_INT else price
+            return None if price != price else price
+        values = self._lists.get(column)
+        if values is not None:
+            return values[index]
+        return self._categories[column][0][self._codes[column][index]]
+
+    def set_value(self, column, index, value):
+        if column not in self.columns:
+            raise KeyError(column)
+        if column == "price":
+            if self._prices.typecode == "q" and (value is None or type(value) is int):
+                self._prices[index] = _MISSING_INT if value is None else value
+            else:
+                if self._prices.typecode == "q":
+                    self._prices = array("d", (math.nan if p == _MISSING_INT else float(p) for p in self._prices))
+                self._prices[index] = math.nan if value is None else float(value)
+        elif column in self._lists:
+            self._lists[column][index] = value
+        else:
+            self._codes[column][index] = self._category_code(column, value)
+
+    def column(self, name):
+        """列の値のリスト (価格はNoneを含むリスト)。"""
+        if name == "price":
+            return [self.value("price", i) for i in range(self._length)]
+        values = self._lists.get(name)
+        if values is not None:
+            return values
+        categories = self._categories[name][0]
+        return [categories[code] for code in self._codes[name]]
+
+    def price_array(self):
+        """価格列をコピーせずにNumPy配列 (float64、欠損はNaN) として返す。
+
+        配列は価格列のビューなので、set_valueでの価格の変更はそのまま見える。
+        この後にappend・extendで行を追加すると価格列はコピーされ、返した配列は
+        追加前の行数・値のままになる (新しい行を含めるには再度呼び出す)。
+        """
+        import numpy as np
+        if self._prices.typecode == "q":
+            self._prices = array("d", (math.nan if p == _MISSING_INT else float(p) for p in self._prices))
+        self._prices_exported = True
+        return np.frombuffer(self._prices, dtype=np.float64)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("ProductTable index out of range")
+        return ProductRow(self, index)
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield ProductRow(self, index)
+
+    def record(self, index):
+        """index行目をレコードとして取り出す。"""
+        return self.record_type(*(self.value(column, index) for column in self.columns))
+
+    def to_dicts(self):
+        return [self[index].to_dict() for index in range(self._length)]
+
+
+def json_default(obj):
+    """json.dumps(..., default=json_default) でレコード・行・テーブルを辞書に戻す。"""
+    if isinstance(obj, (ProductRecord, ProductRow)):
+        return obj.to_dict()
+    if isinstance(obj, ProductTable):
+        return obj.to_dicts()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if __name__ == "__main__":
+    import json
+    import random
+    import time
+    import tracemalloc
+
+    size = 100_000
+    random.seed(0)
+    # コストコ検索APIのレスポンスに似たJSON。読み込むたびに文字列は商品ごとに別になる
+    payload = json.dumps([
+        {"item_product_name": f"カークランド 商品{i:06d}", "item_location_pricing_salePrice": random.randint(100, 50000),
+         "item_number": str(1000000 + i), "item_member_only": random.random() < 0.3,
+         "item_location_stockStatus": random.choice(["IN_STOCK", "OUT_OF_STOCK", "LOW_STOCK"])}
+        for i in range(size)
+    ], ensure_ascii=False)
+
+    def convert(doc, make):
+        return make(
+            "Costco Online", doc["item_product_name"], doc["item_location_pricing_salePrice"], doc["item_number"],
+            doc["item_member_only"], doc["item_location_stockStatus"], f"https://www.costco.co.jp/p/{doc['item_number']}",
+        )
+
+    fields = CostcoOnlineProduct.__slots__
+
+    def build_dicts():
+        return [convert(doc, lambda *row: dict(zip(fields, row))) for doc in json.loads(payload)]
+
+    def build_records():
+        return [convert(doc, CostcoOnlineProduct) for doc in json.loads(payload)]
+
+    def build_table():
+        return ProductTable.from_records(convert(doc, CostcoOnlineProduct) for doc in json.loads(payload))
+
+    print(f"{size:,} Costco products")
+    results = {}
+    for label, build in (("dicts", build_dicts), ("slotted records", build_records), ("columnar table", build_table)):
+        start = time.perf_counter()
+        build()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        products = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[label] = products
+        print(f"    {label:<16} {current / 1024 / 1024:7.1f} MiB  ({current / size:4.0f} B/product, built in {elapsed:.2f}s)")
+
+    dicts, records, table = results["dicts"], results["slotted records"], results["columnar table"]
+    assert records == dicts
+    assert [table[i] for i in range(0, size, 997)] == dicts[::997]
+    assert json.dumps([table[0], records[1]], default=json_default, ensure_ascii=False) == json.dumps(dicts[:2], ensure_ascii=False)
+    print(f"    distinct strings kept for source: {len(table._categories['source'][0]) - 1}, "
+          f"stock_status: {len(table._categories['stock_status'][0]) - 1}")
+
+    # price_array()のビューを取った後も行を追加・価格を変更できること
+    view = table.price_array()
+    table.set_value("price", 0, 123)
+    assert view[0] == 123
+    table.append(records[1])
+    assert len(table.price_array()) == len(view) + 1 and table[size]["price"] == records[1]["price"]
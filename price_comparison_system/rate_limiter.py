@@ -0,0 +1,88 @@
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """スレッドセーフなトークンバケット。
+
+    rate (トークン/秒) で補充され、最大burst個まで貯まる。throttle()で
+    一時的に補充速度を下げ、recover()で設定値まで少しずつ戻す (AIMD)。
+    """
+
+    def __init__(self, rate, burst=1, min_rate=None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.min_rate = float(min_rate) if min_rate is not None else self.max_rate / 16
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1, timeout=None):
+        """トークンを取得できるまで待つ。timeout秒以内に取得できなければFalseを返す。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def throttle(self, factor=0.5):
+        """429や5xxを受けたときに補充速度を下げ、貯まっているトークンも捨てる。"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate * factor)
+            self._tokens = min(self._tokens, 0.0)
+
+    def recover(self, step=None):
+        """成功したリクエストごとに補充速度を設定値へ向けて少しずつ戻す。"""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + (step if step is not None else self.max_rate / 8))
+
+    def set_rate(self, rate, burst=None):
+        """設定値そのものを変更する (サーバーから上限が通知された場合など)。"""
+        with self._lock:
+            self._refill(time.monotonic())
+            throttled = self.rate < self.max_rate
+            self.max_rate = float(rate)
+            # 速度を落としている最中ならその速度を維持し、そうでなければ新しい設定値に合わせる
+            self.rate = min(self.rate, self.max_rate) if throttled else self.max_rate
+            self.min_rate = min(self.min_rate, self.max_rate)
+            if burst is not None:
+                self.burst = float(burst)
+                self._tokens = min(self._tokens, self.burst)
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0, retry_after=None):
+    """attempt回目 (0始まり) のリトライまでの待ち時間。ジッター付き指数バックオフ。
+
+    サーバーがRetry-Afterを返した場合はそれより短くはしない。
+    """
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def parse_retry_after(value):
+    """Retry-Afterヘッダー (秒数) を解釈する。解釈できなければNoneを返す。"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,175 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# --- レスポンスキャッシュ設定 --- #
+# 比較結果をそのまま返す期間 (秒)
+DEFAULT_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+# TTL切れ後、裏で再計算しながら古い結果を返してよい期間 (秒)
+DEFAULT_STALE_TTL = float(os.getenv("RESPONSE_CACHE_STALE_TTL", "600"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+
+HIT = "HIT"
+STALE = "STALE"
+MISS = "MISS"
+
+
+def make_etag(body):
+    """レスポンス本文(bytes)から強いETagを作る。"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Matchヘッダーがetagに一致するか (弱いETag・複数指定・* に対応)。"""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag == etag or tag == "W/" + etag for tag in candidates)
+
+
+def cache_control(ttl=DEFAULT_TTL, stale_ttl=DEFAULT_STALE_TTL):
+    """CDN(s-maxage)とブラウザ向けのCache-Controlヘッダー値。"""
+    return f"public, max-age=0, s-maxage={int(ttl)}, stale-while-revalidate={int(stale_ttl)}"
+
+
+class _InFlight:
+    """計算中のキー。同じキーの後続リクエストはこの完了を待って結果を共有する。"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """キーごとのレスポンスキャッシュ (TTL + stale-while-revalidate + リクエスト集約)。
+
+    - TTL内: キャッシュした値を返す (HIT)
+    - TTL切れでもstale_ttl内: 古い値を返し、裏で1回だけ再計算する (STALE)
+    - それ以外: 計算する。同じキーの同時リクエストは1回の計算を共有する (MISS)
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, stale_ttl=DEFAULT_STALE_TTL, max_entries=DEFAULT_MAX_ENTRIES, cacheable=None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        # 値をキャッシュしてよいか判定する関数 (部分的な結果を保存しないため等)
+        self.cacheable = cacheable or (lambda value: True)
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._inflight = {}  # key -> _InFlight
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "refreshes": 0}
+
+    def get_or_compute(self, key, compute):
+        """(値, HIT/STALE/MISS) を返す。computeは引数なしで値を返す関数。"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                age = now - stored_at
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return value, HIT
+                if age < self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self._stats["stale_hits"] += 1
+                    if key not in self._inflight:
+                        self._inflight[key] = _InFlight()
+                        self._stats["refreshes"] += 1
+                        threading.Thread(target=self._run, args=(key, compute), daemon=True).start()
+                    return value, STALE
+
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                inflight = self._inflight[key] = _InFlight()
+                leader = True
+                self._stats["misses"] += 1
+            else:
+                leader = False
+                self._stats["coalesced"] += 1
+
+        if leader:
+            self._run(key, compute)
+        else:
+            inflight.done.wait()
+        if inflight.error is not None:
+            raise inflight.error
+        return inflight.value, MISS
+
+    def peek(self, key):
+        """TTL内の値があれば返す。なければNone (計算は行わない)。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] >= self.ttl:
+                return None
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """外部で計算した値を保存する (ストリーミングで組み立てた結果など)。"""
+        if not self.cacheable(value):
+            return
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _run(self, key, compute):
+        inflight = self._inflight[key]
+        try:
+            inflight.value = compute()
+        except Exception as e:
+            inflight.error = e
+        with self._lock:
+            if inflight.error is None and self.cacheable(inflight.value):
+                self._store(key, inflight.value)
+            del self._inflight[key]
+        inflight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), inflight=len(self._inflight))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    calls = []
+
+    def slow_compare():
+        calls.append(time.monotonic())
+        time.sleep(0.2)
+        return {"results": len(calls)}
+
+    cache = ResponseCache(ttl=0.5, stale_ttl=1.0)
+
+    # 同じキーワードへの同時リクエスト20件 -> 計算は1回
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        statuses = list(executor.map(lambda _: cache.get_or_compute("ティッシュ", slow_compare)[1], range(20)))
+    print(f"20 concurrent requests: {len(calls)} computation(s), {time.perf_counter() - start:.2f}s, {statuses.count(MISS)} MISS")
+
+    print(cache.get_or_compute("ティッシュ", slow_compare))  # HIT
+    time.sleep(0.6)
+    print(cache.get_or_compute("ティッシュ", slow_compare))  # STALE (裏で再計算)
+    time.sleep(0.3)
+    print(cache.get_or_compute("ティッシュ", slow_compare))  # 再計算後のHIT
+    print(cache.stats())
+
+    body = b'{"keyword": "tissue", "results": []}'
+    etag = make_etag(body)
+    print(etag, etag_matches(f'W/{etag}, "other"', etag), cache_control())
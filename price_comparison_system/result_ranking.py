@@ -0,0 +1,234 @@
+import base64
+import binascii
+import heapq
+import json
+import math
+import os
+import re
+import unicodedata
+
+# 並び順: コストコが安い順に価格差(%) / 価格差(円)、単位ごとのコストコの単価の安い順
+SORT_KEYS = ("percentage", "savings", "unit_price")
+DEFAULT_SORT = "percentage"
+DEFAULT_PAGE_SIZE = int(os.getenv("RESULT_PAGE_SIZE", "20"))
+MAX_PAGE_SIZE = int(os.getenv("RESULT_MAX_PAGE_SIZE", "100"))
+
+# 数量の単位・助数詞。kgとl(リットル)はgとmlに揃える
+_UNITS = "kg|g|ml|l|ロール|枚|組|個|本|袋|箱|パック|缶|冊|錠|粒|食|包|セット|巻|足|ケース|カプセル|回分"
+_BASE_UNITS = {"kg": ("g", 1000), "l": ("ml", 1000)}
+# 「5箱 x 12パック」のような掛け算は1つ目の単位で数える (12パック x 5箱 = 60箱)。
+# 「2枚重ね」は数量ではない
+_QUANTITY = re.compile(
+    rf"(\d+(?:\.\d+)?)\s*({_UNITS})(?:\s*[x×*]\s*(\d+(?:\.\d+)?)\s*({_UNITS}))?(?![a-z]|重ね)"
+)
+
+
+def _normalize(text):
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def _to_base_unit(amount, unit):
+    base_unit, factor = _BASE_UNITS.get(unit, (unit, 1))
+    return amount * factor, base_unit
+
+
+def extract_quantity(product_name):
+    """商品名から総数量を (数量, 単位) で返す。読み取れなければNone。
+
+    「80枚 x 10冊」は (800, "枚")、「1.5kg」は (1500, "g")。掛け算の表記があれば
+    それを、なければ商品名の最後の数量を使う。
+    """
+    matches = list(_QUANTITY.finditer(_normalize(product_name)))
+    if not matches:
+        return None
+    chains = [match for match in matches if match.group(3)]
+    match = chains[-1] if chains else matches[-1]
+    amount = float(match.group(1)) * (float(match.group(3)) if match.group(3) else 1.0)
+    if amount <= 0:
+        return None
+    return _to_base_unit(amount, match.group(2))
+
+
+def parse_unit_label(unit_label):
+    """コストコの「1ロール当り」「100g当り」の数量部分を (数量, 単位) にする。"""
+    match = _QUANTITY.match(_normalize(unit_label).strip())
+    if match is None or match.group(3) or float(match.group(1)) <= 0:
+        return None
+    return _to_base_unit(float(match.group(1)), match.group(2))
+
+
+def normalized_unit_price(price, product_name=None, unit_price=None, unit_label=None):
+    """1単位あたりの価格を (円, 単位) で返す。求められなければNone。
+
+    コストコが表示している単価 (unit_price / unit_label) があればそれを、なければ
+    価格を商品名から読んだ総数量で割った値を使う。単位はgとmlに揃える。
+    """
+    if unit_price is not None and unit_label:
+        parsed = parse_unit_label(unit_label)
+        if parsed is not None:
+            amount, unit = parsed
+            return round(unit_price / amount, 4), unit
+    if price is None or not product_name:
+        return None
+    quantity = extract_quantity(product_name)
+    if quantity is None:
+        return None
+    amount, unit = quantity
+    return round(price / amount, 4), unit
+
+
+def annotate_unit_prices(results, costco_products=()):
+    """比較結果の各行にコストコの単価 costco_unit_price と単位 unit を付けて返す。
+
+    costco_productsを渡すと、URLが一致する商品の表示単価 (unit_price / unit_label) を使う。
+    """
+    printed = {
+        product.get("url"): (product.get("unit_price"), product.get("unit_label"))
+        for product in costco_products if product.get("unit_price") is not None
+    }
+    for result in results:
+        unit_price, unit_label = printed.get(result.get("costco_url"), (None, None))
+        normalized = normalized_unit_price(result.get("costco_price"), result.get("costco_product_name"), unit_price, unit_label)
+        result["costco_unit_price"], result["unit"] = normalized if normalized else (None, None)
+    return results
+
+
+def normalize_unit(unit):
+    """APIで指定された単位をannotate_unit_pricesと同じ表記にする (kg -> g, L -> ml)。"""
+    unit = _normalize(unit).strip()
+    return _BASE_UNITS.get(unit, (unit, 1))[0]
+
+
+def _unit_price(result):
+    """結果の (単価, 単位)。annotate_unit_pricesの値がなければ商品名から求める。"""
+    if result.get("costco_unit_price") is not None:
+        return result["costco_unit_price"], result.get("unit")
+    return normalized_unit_price(result.get("costco_price"), result.get("costco_product_name")) or (None, None)
+
+
+def _unit_ranks(results):
+    """単位 -> 並び順。結果の多い単位から順に並べ、同数なら単位名の順。"""
+    counts = {}
+    for result in results:
+        unit_price, unit = _unit_price(result)
+        if unit_price is not None:
+            counts[unit] = counts.get(unit, 0) + 1
+    ordered = sorted(counts, key=lambda unit: (-counts[unit], unit))
+    return {unit: rank for rank, unit in enumerate(ordered)}
+
+
+def _sort_value(result, sort_by, unit_ranks=None):
+    """小さいほど上位になる値 (タプル)。値がない結果は最後に回す。
+
+    percentage・savingsは符号付きで、コストコがAmazonより安い (価格差が負の)
+    結果ほど上位になる。コストコの方が高い結果は下位になる。
+    unit_priceは単位ごとにまとめ (unit_ranksの順)、その中で単価の安い順にする。
+    円/gと円/ロールのように単位の違う単価どうしは比べない。
+    """
+    if sort_by == "percentage":
+        value = result.get("percentage_difference")
+        return (math.inf if value is None else value,)
+    if sort_by == "savings":
+        value = result.get("price_difference")
+        return (math.inf if value is None else value,)
+    unit_price, unit = _unit_price(result)
+    if unit_price is None:
+        return (math.inf, math.inf)
+    return (unit_ranks.get(unit, math.inf) if unit_ranks else 0, unit_price)
+
+
+def encode_cursor(sort_by, sort_value, index, unit=None):
+    values = [None if value == math.inf else value for value in sort_value]
+    raw = json.dumps([sort_by, unit, values, index], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, sort_by, unit=None):
+    """カーソルを (並び順の値, 位置) に戻す。不正・並び順や単位の違うカーソルはValueError。"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, cursor_unit, values, index = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError):
+        raise ValueError("invalid cursor")
+    if cursor_sort != sort_by or cursor_unit != unit or not isinstance(index, int) or not isinstance(values, list) \
+            or not all(value is None or isinstance(value, (int, float)) for value in values):
+        raise ValueError("invalid cursor")
+    return tuple(math.inf if value is None else value for value in values), index
+
+
+def rank_page(results, sort_by=DEFAULT_SORT, limit=DEFAULT_PAGE_SIZE, cursor=None, unit=None):
+    """並び順の上位limit件、次のページのカーソル (最後のページならNone)、対象の件数を返す。
+
+    全件を並べ替えず、カーソルより後ろの結果からlimit+1件だけを大きさ制限付きの
+    ヒープで選ぶ。同じ値の結果は元の順序で並べる。カーソルには直前のページの
+    最後の結果の (並び順の値, 位置) が入っているので、サーバー側に状態を持たない。
+    unitを指定するとunit_priceの並びをその単位の結果だけに絞る。
+    """
+    if sort_by not in SORT_KEYS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_KEYS)}")
+    if unit is not None and sort_by != "unit_price":
+        raise ValueError("unit can only be used with sort=unit_price")
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    unit_ranks = None
+    if sort_by == "unit_price":
+        unit = normalize_unit(unit) if unit else None
+        unit_ranks = {unit: 0} if unit else _unit_ranks(results)
+    candidates = [(result, index) for index, result in enumerate(results)
+                  if unit is None or _unit_price(result)[1] == unit]
+    ranked = ((_sort_value(result, sort_by, unit_ranks), index) for result, index in candidates)
+    if cursor:
+        after = decode_cursor(cursor, sort_by, unit)
+        ranked = (entry for entry in ranked if entry > after)
+    top = heapq.nsmallest(limit + 1, ranked)
+    next_cursor = encode_cursor(sort_by, *top[limit - 1], unit) if len(top) > limit else None
+    return [results[index] for _, index in top[:limit]], next_cursor, len(candidates)
+
+
+def top_k(results, k, sort_by=DEFAULT_SORT):
+    """並び順の上位k件。"""
+    return rank_page(results, sort_by, k)[0]
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    for name in ["カークランドシグネチャートイレットペーパー ２枚重ね 30ロール", "パステルカラーペーパー 80枚 x 10冊",
+                 "エルモア ティッシュ 400枚(200組) 5箱×12パック", "オーガニック ナッツ 1.13kg", "高価格商品X"]:
+        print(f"{name}: {extract_quantity(name)}")
+    print(normalized_unit_price(3198, unit_price=107, unit_label="1ロール"), normalized_unit_price(1280, unit_price=128, unit_label="100g"))
+
+    # 10万件の比較結果から上位20件を選ぶ (全件ソートとの比較)
+    random.seed(0)
+    results = []
+    for i in range(100_000):
+        amazon_price = random.randint(500, 20000)
+        costco_price = round(amazon_price * random.uniform(0.5, 1.6))
+        results.append({
+            "costco_product_name": f"商品{i} {random.randint(1, 60)}{random.choice(['ロール', '枚', 'kg'])}",
+            "costco_price": costco_price,
+            "costco_url": f"https://www.costco.co.jp/p/{i}", "price_difference": costco_price - amazon_price,
+            "percentage_difference": round((costco_price - amazon_price) / amazon_price * 100, 2),
+        })
+    annotate_unit_prices(results)
+    for sort_by in SORT_KEYS:
+        start = time.perf_counter()
+        page, cursor, _ = rank_page(results, sort_by, 20)
+        heap_time = time.perf_counter() - start
+        start = time.perf_counter()
+        unit_ranks = _unit_ranks(results)
+        expected = sorted(range(len(results)), key=lambda i: (_sort_value(results[i], sort_by, unit_ranks), i))[:40]
+        sort_time = time.perf_counter() - start
+        second, _, _ = rank_page(results, sort_by, 20, cursor)
+        assert page + second == [results[i] for i in expected]
+        print(f"{sort_by:<10} top-20 heap {heap_time * 1e3:6.1f}ms, full sort {sort_time * 1e3:6.1f}ms, next cursor {cursor}")
+
+    # 単位の違う単価は比べない: 単位ごとにまとまり、単位を指定するとその単位だけになる
+    page, _, _ = rank_page(results, "unit_price", 100)
+    units = [result["unit"] for result in page]
+    assert units == sorted(units, key=_unit_ranks(results).__getitem__)
+    grams, cursor, total = rank_page(results, "unit_price", 50, unit="KG")
+    assert {result["unit"] for result in grams} == {"g"} and total == sum(result["unit"] == "g" for result in results)
+    assert rank_page(results, "unit_price", 50, cursor, unit="g")[0][0]["costco_unit_price"] >= grams[-1]["costco_unit_price"]
+    # コストコが安い (価格差が負の) 結果が上位
+    assert all(result["percentage_difference"] < 0 for result in top_k(results, 20))
@@ -0,0 +1,184 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+try:
+    from .product_records import json_default
+except ImportError:
+    from product_records import json_default
+
+# --- キャッシュ設定 --- #
+# 検索結果の有効期間 (秒)
+DEFAULT_TTL = float(os.getenv("SEARCH_CACHE_TTL", "3600"))
+# 検索結果が0件だった場合の有効期間 (秒)
+DEFAULT_NEGATIVE_TTL = float(os.getenv("SEARCH_CACHE_NEGATIVE_TTL", "600"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "2048"))
+DEFAULT_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+
+def normalize_keywords(keywords):
+    """全角・半角や大文字・小文字、空白の違いを吸収したキーワードを返す。"""
+    return " ".join(unicodedata.normalize("NFKC", str(keywords)).lower().split())
+
+
+def make_key(keywords, marketplace_id, page_size):
+    return f"{marketplace_id}|{page_size}|{normalize_keywords(keywords)}"
+
+
+class MemoryBackend:
+    """プロセス内のLRUストア。エントリ数とバイト数の両方で上限を設ける。"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        """値を保存し、追い出したエントリ数を返す。"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, value)
+            self._bytes += len(value)
+            evicted = 0
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                evicted += 1
+            return evicted
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+class SQLiteBackend:
+    """SQLiteファイルに保存するLRUストア。ウォームリスタートをまたいで結果を保持する。"""
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS search_cache ("
+            " key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS search_cache_lru ON search_cache (last_access)")
+        self._conn.commit()
+
+    def get(self, key, now):
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM search_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at <= now:
+                self._conn.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+            else:
+                self._conn.execute("UPDATE search_cache SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return bytes(value) if expires_at > now else None
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_cache (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), expires_at, time.time()),
+            )
+            evicted = 0
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM search_cache").fetchone()
+            if count > self.max_entries or total > self.max_bytes:
+                # 最終アクセスの古い順に上限内へ収まるまで削除する
+                for old_key, size in self._conn.execute("SELECT key, size FROM search_cache ORDER BY last_access").fetchall():
+                    if count <= self.max_entries and total <= self.max_bytes:
+                        break
+                    self._conn.execute("DELETE FROM search_cache WHERE key = ?", (old_key,))
+                    count -= 1
+                    total -= size
+                    evicted += 1
+            self._conn.commit()
+            return evicted
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM search_cache")
+            self._conn.commit()
+
+
+class SearchCache:
+    """キーワード検索結果のTTLキャッシュ。0件の結果も短いTTLでキャッシュする。
+
+    値はJSONとして保存し、取り出すたびに新しいオブジェクトを返すので
+    呼び出し側で結果を書き換えてもキャッシュには影響しない。
+    """
+
+    def __init__(self, backend=None, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._stats = {"hits": 0, "negative_hits": 0, "misses": 0, "evictions": 0}
+        self._stats_lock = threading.Lock()
+
+    def get(self, key):
+        """キャッシュされた結果を返す。未登録・期限切れの場合はNoneを返す。"""
+        value = self.backend.get(key, time.time())
+        with self._stats_lock:
+            if value is None:
+                self._stats["misses"] += 1
+                return None
+            result = json.loads(value)
+            self._stats["hits" if result else "negative_hits"] += 1
+            return result
+
+    def set(self, key, result):
+        ttl = self.ttl if result else self.negative_ttl
+        if ttl <= 0:
+            return
+        value = json.dumps(result, ensure_ascii=False, default=json_default).encode("utf-8")
+        evicted = self.backend.set(key, value, time.time() + ttl)
+        with self._stats_lock:
+            self._stats["evictions"] += evicted
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def clear(self):
+        self.backend.clear()
+
+
+def create_cache_from_env():
+    """SEARCH_CACHE_BACKEND (memory / sqlite) に応じたキャッシュを作成する。"""
+    backend_name = os.getenv("SEARCH_CACHE_BACKEND", "memory")
+    if backend_name == "sqlite":
+        path = os.getenv("SEARCH_CACHE_PATH", os.path.join(tempfile.gettempdir(), "sp_api_search_cache.sqlite3"))
+        try:
+            return SearchCache(SQLiteBackend(path))
+        except sqlite3.Error as e:
+            print(f"[WARNING] SQLite検索キャッシュを開けませんでした。メモリキャッシュを使用します: {e}")
+    return SearchCache(MemoryBackend())
@@ -0,0 +1,134 @@
+import datetime
+import functools
+import hashlib
+import hmac
+import urllib.parse
+
+ALGORITHM = "AWS4-HMAC-SHA256"
+USER_AGENT = "PriceComparisonSystem/1.0 (Language=Python)"
+# GETリクエストなどボディが空の場合のペイロードハッシュ
+EMPTY_PAYLOAD_HASH = hashlib.sha256(b"").hexdigest()
+
+
+def _hmac_sha256(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+@functools.lru_cache(maxsize=256)
+def _canonical_uri(path):
+    return urllib.parse.quote(path)
+
+
+def _canonical_querystring(query_params):
+    return "&".join(
+        urllib.parse.quote(k, safe="~") + "=" + urllib.parse.quote(str(v), safe="~")
+        for k, v in sorted(query_params.items())
+    )
+
+
+class SigV4Signer:
+    """AWS SigV4署名器。
+
+    署名キーは日付・リージョン・サービスが変わったときだけ導出し直し、
+    ヘッダーブロックやクレデンシャルスコープの固定部分は生成時に組み立てておく。
+    """
+
+    signed_headers = "host;user-agent;x-amz-date"
+
+    def __init__(self, access_key_id, secret_access_key, region, host, service="execute-api"):
+        self.access_key_id = access_key_id
+        self.region = region
+        self.host = host
+        self.service = service
+        self._secret_key = f"AWS4{secret_access_key}".encode("utf-8")
+        self._scope_suffix = f"/{region}/{service}/aws4_request"
+        self._canonical_headers_prefix = f"host:{host}\nuser-agent:{USER_AGENT}\nx-amz-date:"
+        # (date_stamp, signing_key)。タプルの差し替えはアトミックなのでロック不要
+        self._cached_key = (None, None)
+
+    def signing_key(self, date_stamp):
+        """date_stamp (YYYYMMDD) の署名キーを返す。同じ日付ならキャッシュを使う。"""
+        cached_date, cached_key = self._cached_key
+        if cached_date == date_stamp:
+            return cached_key
+
+        key = _hmac_sha256(self._secret_key, date_stamp)
+        key = _hmac_sha256(key, self.region)
+        key = _hmac_sha256(key, self.service)
+        key = _hmac_sha256(key, "aws4_request")
+        self._cached_key = (date_stamp, key)
+        return key
+
+    def sign(self, method, path, query_params, body="", now=None):
+        """署名済みのリクエストヘッダーを返す。"""
+        t = now or datetime.datetime.utcnow()
+        amz_date = t.strftime("%Y%m%dT%H%M%SZ")
+        date_stamp = amz_date[:8]
+
+        # 1. Canonical Requestの作成
+        payload_hash = hashlib.sha256(body.encode("utf-8")).hexdigest() if body else EMPTY_PAYLOAD_HASH
+        canonical_request = (
+            f"{method}\n{_canonical_uri(path)}\n{_canonical_querystring(query_params)}\n"
+            f"{self._canonical_headers_prefix}{amz_date}\n\n{self.signed_headers}\n{payload_hash}"
+        )
+
+        # 2. String to Signの作成
+        credential_scope = date_stamp + self._scope_suffix
+        string_to_sign = (
+            f"{ALGORITHM}\n{amz_date}\n{credential_scope}\n"
+            f"{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
+        )
+
+        # 3. 署名の計算 (キャッシュ済みの署名キーを使用)
+        signature = hmac.new(self.signing_key(date_stamp), string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+
+        # 4. ヘッダーの構築
+        return {
+            "host": self.host,
+            "user-agent": USER_AGENT,
+            "x-amz-date": amz_date,
+            "Authorization": (
+                f"{ALGORITHM} Credential={self.access_key_id}/{credential_scope}, "
+                f"SignedHeaders={self.signed_headers}, Signature={signature}"
+            ),
+        }
+
+
+if __name__ == "__main__":
+    import timeit
+
+    def legacy_sign(method, path, query_params, body, access_key_id, secret_access_key, region, host, t):
+        """リファクタリング前の_sign_requestと同じ手順 (毎回キーを導出する)。"""
+        service = "execute-api"
+        amz_date = t.strftime("%Y%m%dT%H%M%SZ")
+        date_stamp = t.strftime("%Y%m%d")
+        canonical_uri = urllib.parse.quote(path)
+        sorted_query = sorted(query_params.items())
+        canonical_querystring = "&".join([urllib.parse.quote(k, safe="~") + "=" + urllib.parse.quote(str(v), safe="~") for k, v in sorted_query])
+        canonical_headers = f"host:{host}\nuser-agent:{USER_AGENT}\nx-amz-date:{amz_date}\n"
+        signed_headers = "host;user-agent;x-amz-date"
+        payload_hash = hashlib.sha256(body.encode("utf-8")).hexdigest() if body else hashlib.sha256(b"").hexdigest()
+        canonical_request = f"{method}\n{canonical_uri}\n{canonical_querystring}\n{canonical_headers}\n{signed_headers}\n{payload_hash}"
+        credential_scope = f"{date_stamp}/{region}/{service}/aws4_request"
+        string_to_sign = f"{ALGORITHM}\n{amz_date}\n{credential_scope}\n{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
+        signing_key = _hmac_sha256(f"AWS4{secret_access_key}".encode("utf-8"), date_stamp)
+        signing_key = _hmac_sha256(signing_key, region)
+        signing_key = _hmac_sha256(signing_key, service)
+        signing_key = _hmac_sha256(signing_key, "aws4_request")
+        signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+        return f"{ALGORITHM} Credential={access_key_id}/{credential_scope}, SignedHeaders={signed_headers}, Signature={signature}"
+
+    args = ("GET", "/catalog/2020-12-01/items",
+            {"keywords": "ティッシュペーパー", "marketplaceIds": "A1VC38T7YXB528", "includedData": "summaries,attributes", "pageSize": 10},
+            "")
+    creds = ("AKIDEXAMPLE", "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY", "us-west-2", "sellingpartnerapi-fe.amazon.com")
+    now = datetime.datetime(2025, 10, 14, 12, 0, 0)
+    signer = SigV4Signer(*creds)
+
+    assert signer.sign(*args, now=now)["Authorization"] == legacy_sign(*args, *creds, now)
+
+    n = 20000
+    before = timeit.timeit(lambda: legacy_sign(*args, *creds, now), number=n) / n
+    after = timeit.timeit(lambda: signer.sign(*args, now=now), number=n) / n
+    print(f"legacy  : {before * 1e6:.1f} us/signature")
+    print(f"cached  : {after * 1e6:.1f} us/signature ({before / after:.2f}x)")
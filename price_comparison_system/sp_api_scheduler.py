@@ -0,0 +1,228 @@
+import os
+import threading
+import time
+
+import requests
+
+try:
+    from .rate_limiter import TokenBucket, backoff_delay, parse_retry_after
+    from .metrics import count, record
+except ImportError:
+    from rate_limiter import TokenBucket, backoff_delay, parse_retry_after
+    from metrics import count, record
+
+# --- SP-APIのオペレーションごとの既定レート (リクエスト/秒, バースト) --- #
+# 実際の上限はレスポンスのx-amzn-RateLimit-Limitヘッダーで更新する
+DEFAULT_OPERATION_LIMITS = {
+    "searchCatalogItems": (2.0, 2),
+    "getCompetitivePricing": (0.5, 1),
+}
+# 未知のオペレーションに使うレート
+FALLBACK_LIMIT = (1.0, 1)
+# 429・5xxを受けたときのリトライ回数
+DEFAULT_MAX_RETRIES = int(os.getenv("SP_API_MAX_RETRIES", "5"))
+# トークン待ちの上限 (秒)。超えたらQueueTimeoutを送出する
+DEFAULT_MAX_QUEUE_WAIT = float(os.getenv("SP_API_MAX_QUEUE_WAIT", "30"))
+
+RATE_LIMIT_HEADER = "x-amzn-RateLimit-Limit"
+
+
+class QueueTimeout(requests.exceptions.RequestException):
+    """レート制限の待ち行列でmax_queue_wait秒以内に順番が来なかった。"""
+
+
+class DeadlineExceeded(QueueTimeout):
+    """呼び出し側の期限 (deadline) までに順番が来なかった。"""
+
+
+class _OperationState:
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class SpApiScheduler:
+    """SP-APIのオペレーションごとにトークンバケットでリクエストを調停するスケジューラー。
+
+    呼び出し側はsubmit()でオペレーション名と送信関数を渡す。トークンがなければ
+    失敗させずに待ち行列に並べ、429や5xxにはバケットの速度を落としたうえで
+    ジッター付き指数バックオフでリトライする。x-amzn-RateLimit-Limitヘッダーが
+    返ってきたらそのオペレーションのレートを更新する。
+    deadlineを渡すと、待ち行列での待ちもリトライもその時刻までで打ち切るので、
+    応答を諦めたリクエストのスレッドがトークンを使い続けることはない。
+    """
+
+    def __init__(self, limits=None, max_retries=DEFAULT_MAX_RETRIES, max_queue_wait=DEFAULT_MAX_QUEUE_WAIT):
+        self.limits = dict(DEFAULT_OPERATION_LIMITS if limits is None else limits)
+        self.max_retries = max_retries
+        self.max_queue_wait = max_queue_wait
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def _state(self, operation):
+        with self._lock:
+            state = self._operations.get(operation)
+            if state is None:
+                rate, burst = self.limits.get(operation, FALLBACK_LIMIT)
+                state = self._operations[operation] = _OperationState(rate, burst)
+            return state
+
+    def _acquire(self, operation, state, deadline=None):
+        with self._lock:
+            state.queue_depth += 1
+            state.max_queue_depth = max(state.max_queue_depth, state.queue_depth)
+        start = time.monotonic()
+        timeout = self.max_queue_wait
+        if deadline is not None:
+            # 期限を過ぎていれば、すぐに使えるトークンがあるときだけ送る
+            timeout = max(0.0, min(timeout, deadline - start))
+        try:
+            acquired = state.bucket.acquire(timeout=timeout)
+        finally:
+            waited = time.monotonic() - start
+            record("sp_api_queue_wait", waited)
+            with self._lock:
+                state.queue_depth -= 1
+                state.wait_total += waited
+                state.wait_max = max(state.wait_max, waited)
+                if not acquired:
+                    state.timeouts += 1
+        if not acquired:
+            if timeout < self.max_queue_wait:
+                raise DeadlineExceeded(f"{operation}: request deadline passed while waiting for the rate limit")
+            raise QueueTimeout(f"{operation}: rate-limit queue wait exceeded {self.max_queue_wait}s")
+
+    def _update_rate(self, state, response):
+        limit = response.headers.get(RATE_LIMIT_HEADER)
+        try:
+            rate = float(limit)
+        except (TypeError, ValueError):
+            return
+        if rate > 0 and rate != state.bucket.max_rate:
+            state.bucket.set_rate(rate)
+
+    def submit(self, operation, send, deadline=None):
+        """レート制限に従ってsend()を呼び、レスポンスを返す。
+
+        sendは引数なしでrequests.Responseを返す関数 (リトライのたびに呼ばれるので
+        署名はその中で行う)。リトライしても429・5xxのままならそのレスポンスを返す。
+        deadline (time.monotonic()の値) を渡すと、それまでにトークンを取得できなければ
+        DeadlineExceededを送出し、バックオフ後に期限を過ぎるリトライはしない。
+        """
+        state = self._state(operation)
+        for attempt in range(self.max_retries + 1):
+            self._acquire(operation, state, deadline)
+            with self._lock:
+                state.requests += 1
+            response = send()
+            count("sp_api.requests")
+            count("sp_api.bytes", len(response.content))
+            self._update_rate(state, response)
+
+            status = response.status_code
+            if status == 429 or status >= 500:
+                with self._lock:
+                    if status == 429:
+                        state.throttled += 1
+                        count("sp_api.throttled")
+                    if attempt < self.max_retries:
+                        state.retries += 1
+                        count("sp_api.retries")
+                if attempt < self.max_retries:
+                    state.bucket.throttle()
+                    delay = backoff_delay(attempt, retry_after=parse_retry_after(response.headers.get("Retry-After")))
+                    if deadline is not None and time.monotonic() + delay >= deadline:
+                        print(f"[WARNING] SP-API {operation} が {status} を返しました。期限までにリトライできないため諦めます")
+                        return response
+                    print(f"[WARNING] SP-API {operation} が {status} を返しました。{delay:.1f}秒後にリトライします")
+                    time.sleep(delay)
+                    continue
+                return response
+
+            state.bucket.recover()
+            return response
+        return response
+
+    def stats(self):
+        """オペレーションごとのレート・待ち行列の深さ・待ち時間などを返す。"""
+        with self._lock:
+            return {
+                operation: {
+                    "rate": state.bucket.rate,
+                    "max_rate": state.bucket.max_rate,
+                    "burst": state.bucket.burst,
+                    "queue_depth": state.queue_depth,
+                    "max_queue_depth": state.max_queue_depth,
+                    "requests": state.requests,
+                    "throttled": state.throttled,
+                    "retries": state.retries,
+                    "timeouts": state.timeouts,
+                    "wait_total": round(state.wait_total, 3),
+                    "wait_max": round(state.wait_max, 3),
+                    "wait_avg": round(state.wait_total / state.requests, 3) if state.requests else 0.0,
+                }
+                for operation, state in self._operations.items()
+            }
+
+
+if __name__ == "__main__":
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+
+    class FakeResponse:
+        def __init__(self, status_code, headers):
+            self.status_code = status_code
+            self.headers = headers
+            self.content = b""
+
+    # 1秒あたり5件を超えると429を返す擬似SP-API
+    server_lock = threading.Lock()
+    server_window = []
+
+    def fake_send():
+        with server_lock:
+            now = time.monotonic()
+            server_window[:] = [t for t in server_window if now - t < 1.0]
+            if len(server_window) >= 5:
+                return FakeResponse(429, {RATE_LIMIT_HEADER: "5.0"})
+            server_window.append(now)
+            return FakeResponse(200, {RATE_LIMIT_HEADER: "5.0"})
+
+    # 並列20件・スケジューラーなしの場合
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        raw = list(executor.map(lambda _: fake_send().status_code, range(20)))
+    print(f"without scheduler: {raw.count(429)} of 20 requests throttled")
+
+    time.sleep(1.1)
+    scheduler = SpApiScheduler(limits={"searchCatalogItems": (2.0, 2)}, max_queue_wait=10)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        statuses = list(executor.map(lambda _: scheduler.submit("searchCatalogItems", fake_send).status_code, range(20)))
+    print(f"with scheduler: {statuses.count(200)} of 20 succeeded in {time.monotonic() - start:.1f}s")
+    print(json.dumps(scheduler.stats(), indent=2))
+
+    # 期限付き: 2件/秒のバケットに20件を並べても、1秒の期限で待ちを打ち切る
+    def submit_with_deadline(deadline):
+        try:
+            return scheduler.submit("searchCatalogItems", fake_send, deadline=deadline).status_code
+        except DeadlineExceeded:
+            return "deadline"
+
+    time.sleep(1.1)
+    scheduler = SpApiScheduler(limits={"searchCatalogItems": (2.0, 2)}, max_queue_wait=10)
+    start = time.monotonic()
+    deadline = start + 1.0
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        outcomes = list(executor.map(lambda _: submit_with_deadline(deadline), range(20)))
+    elapsed = time.monotonic() - start
+    # 429を受けても期限までにリトライできなければ、そのレスポンスを返す
+    print(f"with a 1s deadline: {outcomes.count(200)} sent, {outcomes.count(429)} not retried, "
+          f"{outcomes.count('deadline')} gave up in the queue, all done in {elapsed:.1f}s")
+    assert set(outcomes) <= {200, 429, "deadline"} and elapsed < 1.5
@@ -0,0 +1,110 @@
+import operator
+
+import numpy as np
+
+# 価格差(%)の抽出ルール: (演算子, 閾値) のタプル
+# percentage_difference >= 20: コストコがAmazonより20%以上高い
+# percentage_difference <= -25: コストコがAmazonより25%以上安い
+DEFAULT_THRESHOLD_RULES = ((">=", 20), ("<=", -25))
+
+_RULE_OPERATORS = {">=": operator.ge, ">": operator.gt, "<=": operator.le, "<": operator.lt}
+
+
+def matches_threshold_rules(percentage_difference, rules=DEFAULT_THRESHOLD_RULES, require_all=False):
+    """価格差(%)が抽出ルールを満たすか判定する。
+
+    require_all=Falseならいずれか、Trueならすべてのルールを満たすときに真。
+    数値にもNumPy配列にも使え、配列の場合は真偽値のマスクを返す。
+    """
+    result = None
+    for op, threshold in rules:
+        mask = _RULE_OPERATORS[op](percentage_difference, threshold)
+        if result is None:
+            result = mask
+        else:
+            result = (result & mask) if require_all else (result | mask)
+    return result
+
+
+def compare_price_arrays(costco_prices, amazon_prices, rules=DEFAULT_THRESHOLD_RULES, require_all=False):
+    """マッチ済みペアの価格を列(配列)のまま一括比較する。
+
+    価格差(%)はどの経路でも (コストコ価格 - Amazon価格) / Amazon価格 * 100。
+    負ならコストコの方が安い。
+
+    価格がNone/NaNのペアやAmazon価格が0のペアは除外する。ルールを満たしたペアの
+    入力上の位置と価格差・価格差(%)を配列で返し、行ごとの辞書は作らない。
+    """
+    costco = np.asarray(costco_prices, dtype=np.float64)
+    amazon = np.asarray(amazon_prices, dtype=np.float64)
+
+    price_difference = costco - amazon
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percentage_difference = price_difference / amazon * 100
+
+    valid = np.isfinite(percentage_difference) & (amazon != 0)
+    mask = valid & matches_threshold_rules(percentage_difference, rules, require_all)
+    index = np.flatnonzero(mask)
+
+    return {
+        "index": index,
+        "price_difference": price_difference[index],
+        "percentage_difference": np.round(percentage_difference[index], 2),
+    }
+
+
+if __name__ == "__main__":
+    import time
+
+    pair_count = 100_000
+    rng = np.random.default_rng(0)
+    costco_prices = rng.integers(100, 20000, pair_count).astype(float)
+    amazon_prices = costco_prices * rng.uniform(0.5, 1.6, pair_count)
+    amazon_prices[rng.integers(0, pair_count, 500)] = np.nan  # 価格取得に失敗したペア
+    costco_list = costco_prices.tolist()
+    amazon_list = [None if np.isnan(p) else p for p in amazon_prices.tolist()]
+
+    def legacy_comparator_loop():
+        # price_comparator.compare_pricesの価格差計算部分
+        results = []
+        for costco_price, amazon_price in zip(costco_list, amazon_list):
+            if amazon_price is None or amazon_price == 0:
+                continue
+            price_difference = costco_price - amazon_price
+            percentage_difference = (price_difference / amazon_price) * 100
+            if percentage_difference >= 20 or percentage_difference <= -25:
+                results.append({"price_difference": price_difference, "percentage_difference": round(percentage_difference, 2)})
+        return results
+
+    def legacy_band_loop():
+        # main_comparison.calculate_price_differenceの価格差計算部分 (コストコが20〜25%安い)
+        results = []
+        for costco_price, amazon_price in zip(costco_list, amazon_list):
+            if costco_price is None or amazon_price is None or amazon_price == 0:
+                continue
+            percentage_difference = ((costco_price - amazon_price) / amazon_price) * 100
+            if -25 <= percentage_difference <= -20:
+                results.append({"percentage_difference": round(percentage_difference, 2)})
+        return results
+
+    def timed(fn, repeat=5):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - start)
+        return best, result
+
+    band = {"rules": ((">=", -25), ("<=", -20)), "require_all": True}
+    cases = [
+        ("comparator (>=20% or <=-25%)", legacy_comparator_loop, {}),
+        ("band (-25%..-20%)", legacy_band_loop, band),
+    ]
+    print(f"{pair_count} pairs (numpy: list input / array input)")
+    for label, loop, options in cases:
+        loop_time, loop_result = timed(loop)
+        list_time, list_result = timed(lambda: compare_price_arrays(costco_list, amazon_list, **options))
+        array_time, _ = timed(lambda: compare_price_arrays(costco_prices, amazon_prices, **options))
+        assert len(loop_result) == len(list_result["index"])
+        print(f"{label:<32} loop {loop_time * 1e3:6.1f}ms  numpy {list_time * 1e3:5.1f}ms / {array_time * 1e3:4.1f}ms"
+              f"  ({loop_time / list_time:.1f}x / {loop_time / array_time:.1f}x)")
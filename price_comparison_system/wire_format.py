@@ -0,0 +1,262 @@
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# --- 圧縮設定 --- #
+# gzipは5前後で圧縮率がほぼ頭打ちになり、それ以上は時間だけが増える
+GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "5"))
+# brotliは11が最小だが遅すぎるので、gzip 5と同程度の時間で小さくなる5を使う
+BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", "5"))
+# これより小さい本文は圧縮しない (ヘッダーとCPU時間の分で割に合わない)
+COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", "1024"))
+# 形式・圧縮ごとにエンコードした本文を覚えておく件数 (ETagと形式の組ごとに1件)
+VARIANT_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_VARIANT_CACHE_MAX_ENTRIES", "512"))
+
+JSON = "json"
+MSGPACK = "msgpack"
+CONTENT_TYPES = {
+    JSON: "application/json; charset=utf-8",
+    MSGPACK: "application/msgpack",
+}
+# resultsの形: 行ごとの辞書のリスト / 列名 -> 値のリスト
+ROWS = "rows"
+COLUMNS = "columns"
+LAYOUTS = (ROWS, COLUMNS)
+
+# 呼び出しごとにエンコーダーを作らないよう使い回す
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def dumps_json(data):
+    """日本語を\\uXXXXにせず、区切りの空白も入れないUTF-8のJSON (bytes)。
+
+    json.dumps(data).encode()より1〜2割遅い (1000件で約0.5〜1ms。非ASCIIの文字列を
+    組み立ててからUTF-8に変換するため)。その代わり本文は約26%、gzip後も約6%小さい。
+    本文はレンダリングごとに1回しか作らないので、転送量の方を優先している。
+    """
+    return _json_encoder.encode(data).encode("utf-8")
+
+
+def to_columns(rows):
+    """辞書のリストを {キー: 値のリスト} にする。キーは行ごとに繰り返さない。
+
+    キーの順序は最初に現れた順で、その行にないキーの値はNone。
+    """
+    fields = {}
+    for row in rows:
+        for key in row:
+            if key not in fields:
+                fields[key] = None
+    return {field: [row.get(field) for row in rows] for field in fields}
+
+
+def apply_layout(data, layout=ROWS):
+    """レスポンスのresultsをlayoutの形にしたコピーを返す (rowsならそのまま)。"""
+    if layout == ROWS:
+        return data
+    if layout != COLUMNS:
+        raise ValueError(f"layout must be one of {', '.join(LAYOUTS)}")
+    columnar = dict(data)
+    columnar["results"] = to_columns(data["results"])
+    columnar["layout"] = COLUMNS
+    return columnar
+
+
+def serialize(data, media_type=JSON):
+    if media_type == MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+    return dumps_json(data)
+
+
+def compress(body, encoding):
+    """Content-Encoding (br / gzip / None) で本文を圧縮する。"""
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        # mtime=0で同じ本文からは同じバイト列になる (ETagを変えない)
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return body
+
+
+def _quality_values(header):
+    """'gzip;q=0.5, br' -> {'gzip': 0.5, 'br': 1.0}"""
+    values = {}
+    for part in (header or "").split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        values[name] = quality
+    return values
+
+
+def negotiate_encoding(accept_encoding, size=None):
+    """Accept-Encodingから使う圧縮方式を選ぶ。brotliがあれば同じ優先度ならbrを選ぶ。
+
+    sizeがCOMPRESS_MIN_BYTES未満、または受け付ける方式がなければNone。
+    """
+    if size is not None and size < COMPRESS_MIN_BYTES:
+        return None
+    offered = _quality_values(accept_encoding)
+    wildcard = offered.get("*", 0.0)
+    candidates = ["br", "gzip"] if brotli else ["gzip"]
+    best = max(candidates, key=lambda encoding: offered.get(encoding, wildcard))
+    return best if offered.get(best, wildcard) > 0 else None
+
+
+def negotiate_media_type(accept):
+    """AcceptでMessagePackが明示され、JSON以上の優先度ならMSGPACK。それ以外はJSON。
+
+    msgpackがインストールされていなければ常にJSON。
+    """
+    if msgpack is None or not accept:
+        return JSON
+    offered = _quality_values(accept)
+    packed = max(offered.get("application/msgpack", 0.0), offered.get("application/x-msgpack", 0.0))
+    plain = max(offered.get("application/json", 0.0), offered.get("*/*", 0.0), offered.get("application/*", 0.0))
+    return MSGPACK if packed > 0 and packed >= plain else JSON
+
+
+class _VariantCache:
+    """(ETag, 形式, layout, 圧縮) -> エンコード済みの本文 のLRU。
+
+    ETagは本文のハッシュなので、同じETagなら同じ本文から作った結果を使い回せる。
+    ResponseCacheのレスポンスには書き込まない。
+    """
+
+    def __init__(self, max_entries=VARIANT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_variants = _VariantCache()
+
+
+def encode_response(response, media_type=JSON, layout=ROWS, accept_encoding=None):
+    """レンダリング済みのレスポンス {'body', 'etag', ...} を送る形にする。
+
+    (本文, ETag, Content-Encoding) を返す。ETagは形式ごとに別の値になる。
+    変換・圧縮した結果はETagごとに別のキャッシュに覚えておくので、同じレスポンスは
+    形式ごとに1回だけエンコード・圧縮すればよい。responseは変更しない。
+    ETagのないレスポンス (デバッグ情報付きなど) は毎回エンコードする。
+    """
+    etag = response["etag"]
+    key = (etag, media_type, layout)
+    plain = _variants.get(key + (None,)) if etag else None
+    if plain is None:
+        if (media_type, layout) == (JSON, ROWS):
+            plain = response["body"]
+        else:
+            plain = serialize(apply_layout(json.loads(response["body"]), layout), media_type)
+            if etag:
+                _variants.put(key + (None,), plain)
+
+    encoding = negotiate_encoding(accept_encoding, len(plain))
+    if encoding is None:
+        body = plain
+    else:
+        body = _variants.get(key + (encoding,)) if etag else None
+        if body is None:
+            body = compress(plain, encoding)
+            if etag:
+                _variants.put(key + (encoding,), body)
+
+    suffix = [part for part in (layout if layout != ROWS else None, media_type if media_type != JSON else None, encoding) if part]
+    if etag and suffix:
+        etag = etag[:-1] + "-" + "-".join(suffix) + '"'
+    return body, etag, encoding
+
+
+if __name__ == "__main__":
+    import time
+
+    try:
+        from .benchmark import make_catalog
+        from .price_comparator import compare_prices
+        from .result_ranking import annotate_unit_prices
+    except ImportError:
+        from benchmark import make_catalog
+        from price_comparator import compare_prices
+        from result_ranking import annotate_unit_prices
+
+    # 1000件の比較結果のレスポンス (api/compare.pyのbuild_comparisonと同じ形)
+    costco_products, amazon_products = make_catalog(5000)
+    results = annotate_unit_prices(compare_prices(costco_products, amazon_products))[:1000]
+    data = {"keyword": "ティッシュ", "results": results, "partial": False}
+    print(f"{len(results)} results")
+
+    def timed(fn, iterations=20):
+        fn()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            value = fn()
+        return value, (time.perf_counter() - start) / iterations
+
+    variants = [("json (ensure_ascii, before)", lambda: json.dumps(data).encode("utf-8")),
+                ("json utf-8 compact", lambda: dumps_json(data)),
+                ("json columns", lambda: dumps_json(apply_layout(data, COLUMNS)))]
+    if msgpack is not None:
+        variants += [("msgpack rows", lambda: serialize(data, MSGPACK)),
+                     ("msgpack columns", lambda: serialize(apply_layout(data, COLUMNS), MSGPACK))]
+    encodings = [None, "gzip"] + (["br"] if brotli else [])
+
+    print(f"    {'format':<28} {'serialize':>10} " + " ".join(f"{encoding or 'identity':>17}" for encoding in encodings))
+    for label, encode in variants:
+        body, serialize_time = timed(encode)
+        cells = []
+        for encoding in encodings:
+            compressed, compress_time = timed(lambda: compress(body, encoding), 5)
+            cells.append(f"{len(compressed) / 1024:6.1f} KiB {compress_time * 1e3:5.1f}ms")
+        print(f"    {label:<28} {serialize_time * 1e3:8.2f}ms " + " ".join(cells))
+
+    assert json.loads(dumps_json(data)) == json.loads(json.dumps(data))
+    if msgpack is not None:
+        assert msgpack.unpackb(serialize(apply_layout(data, COLUMNS), MSGPACK)) == json.loads(dumps_json(apply_layout(data, COLUMNS)))
+    columns = apply_layout(data, COLUMNS)["results"]
+    assert [dict(zip(columns, values)) for values in zip(*columns.values())] == results
+    # 形式ごとのエンコード結果は別のキャッシュに入り、レスポンスの辞書は変わらない
+    response = {"body": dumps_json(data), "etag": '"bench"', "partial": False}
+    snapshot = dict(response)
+    first = encode_response(response, JSON, COLUMNS, "gzip")
+    assert encode_response(response, JSON, COLUMNS, "gzip")[0] is first[0]
+    assert response == snapshot and len(_variants) == 2
+    for header in ("gzip, deflate, br", "gzip;q=1.0, br;q=0.5", "identity", "*", "br;q=0", ""):
+        print(f"    Accept-Encoding {header!r:<24} -> {negotiate_encoding(header)}")
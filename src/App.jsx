@@ -1,6 +1,8 @@
 import { useState } from 'react'
 import { Button } from '@/components/ui/button.jsx'
 import { Input } from '@/components/ui/input.jsx'
+import { Label } from '@/components/ui/label.jsx'
+import { Switch } from '@/components/ui/switch.jsx'
 import { Card, CardContent, CardDescription, CardHeader, CardTitle } from '@/components/ui/card.jsx'
 import { Search, TrendingDown, TrendingUp, ExternalLink } from 'lucide-react'
 import './App.css'
@@ -10,6 +12,10 @@ function App() {
   const [loading, setLoading] = useState(false)
   const [results, setResults] = useState([])
   const [error, setError] = useState(null)
+  // 逐次表示 (NDJSON) はオプトイン。既定の通常のリクエストはETag・エッジキャッシュが効く
+  const [streaming, setStreaming] = useState(false)
+  // 締め切りで打ち切られた・一部の商品で失敗したときの情報
+  const [summary, setSummary] = useState(null)
 
   const handleSearch = async () => {
     if (!searchTerm.trim()) {
@@ -20,23 +26,45 @@ function App() {
     setLoading(true)
     setError(null)
     setResults([])
+    setSummary(null)
 
     try {
       // APIエンドポイントを呼び出す（Vercelのサーバーレス関数）
-      const response = await fetch('/api/compare', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ searchTerm }),
+      const params = new URLSearchParams({ keyword: searchTerm.trim() })
+      const response = await fetch(`/api/compare?${params}`, {
+        headers: { Accept: streaming ? 'application/x-ndjson' : 'application/json' },
       })
 
       if (!response.ok) {
         throw new Error('価格比較の取得に失敗しました')
       }
 
-      const data = await response.json()
-      setResults(data.results || [])
+      if (!streaming) {
+        const data = await response.json()
+        setResults(data.results)
+        setSummary({ partial: data.partial, errors: data.errors || [] })
+        return
+      }
+
+      // NDJSONのストリーミングモードで、Amazonの照合が終わった商品から順に表示する
+      const reader = response.body.pipeThrough(new TextDecoderStream()).getReader()
+      let buffer = ''
+      for (;;) {
+        const { value, done } = await reader.read()
+        if (done) break
+        buffer += value
+        const lines = buffer.split('\n')
+        buffer = lines.pop()
+        for (const line of lines) {
+          if (!line.trim()) continue
+          const event = JSON.parse(line)
+          if (event.type === 'result') {
+            setResults((current) => [...current, event.result])
+          } else if (event.type === 'summary') {
+            setSummary({ partial: event.partial, errors: event.errors || [] })
+          }
+        }
+      }
     } catch (err) {
       setError(err.message)
     } finally {
@@ -75,6 +103,10 @@ function App() {
                 onKeyPress={(e) => e.key === 'Enter' && handleSearch()}
                 className="flex-1"
               />
+              <Label className="whitespace-nowrap">
+                <Switch checked={streaming} onCheckedChange={setStreaming} />
+                逐次表示
+              </Label>
               <Button onClick={handleSearch} disabled={loading}>
                 <Search className="mr-2 h-4 w-4" />
                 {loading ? '検索中...' : '検索'}
@@ -92,6 +124,26 @@ function App() {
           </Card>
         )}
 
+        {/* 一部の結果が欠けている場合 */}
+        {summary && (summary.partial || summary.errors.length > 0) && (
+          <Card className="mb-8 border-yellow-500 bg-yellow-50 dark:bg-yellow-900/20">
+            <CardContent className="pt-6 text-yellow-700 dark:text-yellow-300">
+              <p>
+                {summary.partial
+                  ? '時間内に照合できなかった商品や取得に失敗した商品があるため、結果の一部のみを表示しています'
+                  : '一部の商品で照合に失敗しました'}
+              </p>
+              {summary.errors.length > 0 && (
+                <ul className="mt-2 list-disc pl-5 text-sm">
+                  {summary.errors.map((item, index) => (
+                    <li key={index}>{item.asin ? `${item.asin}: ` : ''}{item.error}</li>
+                  ))}
+                </ul>
+              )}
+            </CardContent>
+          </Card>
+        )}
+
         {/* 検索結果 */}
         {results.length > 0 && (
           <div className="space-y-4">
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# price_comparison_system をパッケージとして読み込めるようにリポジトリのルートをパスに入れる
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
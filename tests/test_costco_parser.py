@@ -0,0 +1,120 @@
+import glob
+import json
+import os
+
+import pytest
+
+from price_comparison_system.costco_parser import (
+    _MAX_LINK_TEXT,
+    CostcoMarkdownStream,
+    _parse_costco_markdown_regex,
+    iter_costco_markdown,
+    iter_costco_markdown_chunks,
+    iter_costco_markdown_file,
+    iter_costco_markdown_firecrawl,
+    parse_costco_markdown,
+)
+
+CHUNK_DIR = os.path.join(os.path.dirname(__file__), '..', 'price_comparison_system', 'markdown_chunks')
+CHUNK_PATHS = sorted(glob.glob(os.path.join(CHUNK_DIR, 'chunk_*.md')),
+                     key=lambda path: int(os.path.basename(path)[6:-3]))
+
+
+def read_chunk(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+FULL_MARKDOWN = '\n'.join(read_chunk(path) for path in CHUNK_PATHS)
+
+EDGE_CASES = {
+    'all chunks': FULL_MARKDOWN,
+    'image without link': FULL_MARKDOWN + '\n![orphan](https://example.com/a.jpg)\n\n¥1,000\n\nno link here\n',
+    'edge cases': (
+        '![a](x)  \n  ¥100\n[p](u)\n'           # 価格行の前に空白 → 価格なし
+        '![b](y)\n¥2,000 税込\n\n[q](v)\n'      # 価格行に余計な文字 → 価格なし
+        '![c](z) trailing\n[r](w)\n'            # 行末で終わらない画像 → 対象外
+        '![d](z)\n\n ![e](z)\n [s](w)\n[t](w)\n'  # 行頭でないリンクは読み飛ばす
+        '![](z)\n[u](w)\n![f](z)\n[ ](w)\n'      # 空のALT、空白だけの商品名
+        '![g\n](h\n)\n[multi\nline](i\n)\n'      # 複数行にまたがるALT・URL
+    ),
+    'unit prices': (
+        '![a](x)\n¥3,198\n通常配送料込み\n1ロール当り ¥107\n[p](u)\n'
+        '![b](y)\n¥1,280\n100g当り ¥128\n2個当り ¥999\n[q](v)\n'  # 最初の単価の行を使う
+        '![c](z)\n¥500\n' + 'x' * 100 + ' 1個当り ¥50\n[r](w)\n'      # 行の途中は単価ではない
+    ),
+}
+CASES = dict({os.path.basename(path): read_chunk(path) for path in CHUNK_PATHS}, **EDGE_CASES)
+
+
+def legacy_fields(products):
+    # 旧実装は表示単価を読まないので、共通のフィールドだけを比べる
+    return [{key: product[key] for key in ('product_name', 'price', 'url')} for product in products]
+
+
+def test_chunks_exist():
+    assert CHUNK_PATHS
+    assert parse_costco_markdown(FULL_MARKDOWN)
+
+
+@pytest.mark.parametrize('label', CASES)
+def test_matches_legacy_regex(label):
+    markdown = CASES[label]
+    assert legacy_fields(parse_costco_markdown(markdown)) == _parse_costco_markdown_regex(markdown)
+
+
+@pytest.mark.parametrize('piece_size', (1, 7, 64, 1000))
+@pytest.mark.parametrize('label', CASES)
+def test_result_does_not_depend_on_piece_boundaries(label, piece_size):
+    markdown = CASES[label]
+    pieces = [markdown[i:i + piece_size] for i in range(0, len(markdown), piece_size)]
+    assert list(iter_costco_markdown(pieces)) == parse_costco_markdown(markdown)
+
+
+def test_unit_prices():
+    products = parse_costco_markdown(EDGE_CASES['unit prices'])
+    assert [(p['unit_price'], p['unit_label']) for p in products] == \
+        [(107, '1ロール'), (128, '100g'), (None, None)]
+
+
+def test_chunk_directory_and_file():
+    expected = parse_costco_markdown(FULL_MARKDOWN)
+    assert list(iter_costco_markdown_chunks(CHUNK_DIR, block_size=100)) == expected
+    assert list(iter_costco_markdown_file(CHUNK_PATHS[0], block_size=100)) == \
+        parse_costco_markdown(read_chunk(CHUNK_PATHS[0]))
+
+
+@pytest.mark.parametrize('block_size', (1, 5, 13, 4096))
+@pytest.mark.parametrize('ensure_ascii', (True, False))
+def test_firecrawl_reads_only_top_level_markdown(tmp_path, ensure_ascii, block_size):
+    # トップレベルより前に入れ子の"markdown"キーや値としての"markdown"があっても読まない。
+    # ensure_ascii=Trueでは絵文字がサロゲートペアのエスケープになり、ブロック境界で分かれうる
+    firecrawl_path = tmp_path / 'firecrawl.json'
+    with open(firecrawl_path, 'w', encoding='utf-8') as f:
+        json.dump({'metadata': {'title': 'markdown', 'markdown': '![x](y)\n[nested](z)\n', 'tags': ['markdown', '}']},
+                   'links': [{'markdown': '"'}], 'note': 'a \\"markdown\\": "',
+                   'markdown': FULL_MARKDOWN + '\n![e](x)\n[絵文字 😀 "quoted" \\](u)\n'},
+                  f, ensure_ascii=ensure_ascii)
+    products = list(iter_costco_markdown_firecrawl(str(firecrawl_path), block_size=block_size))
+    assert products[:-1] == parse_costco_markdown(FULL_MARKDOWN)
+    assert products[-1]['product_name'] == '絵文字 😀 "quoted" \\'
+
+
+def test_overlong_link_text_is_skipped():
+    tail = '\n![img](x)\n¥100\n[p](u)\n'
+    assert parse_costco_markdown('![' + 'a' * (_MAX_LINK_TEXT + 1) + '](x)' + tail) == parse_costco_markdown(tail)
+
+
+@pytest.mark.parametrize('prefix', ('![never closed', '![a](x)\n[never closed'))
+def test_unclosed_bracket_does_not_grow_buffer(prefix):
+    stream = CostcoMarkdownStream()
+    stream.feed(prefix)
+    for _ in range(200):
+        stream.feed('y' * 99 + '\n')
+    assert len(stream._buffer) <= 100
+    stream.close()
+
+
+def test_orphan_image_is_not_a_product():
+    malformed = '![orphan](https://example.com/a.jpg)\n' + 'filler line\n' * 20
+    assert parse_costco_markdown(malformed) == []